@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from actions.partitions import get_partitions, is_partitioned, partition_media_actions
+
+
+class Command(BaseCommand):
+    help = 'Convert the media actions table to monthly partitions on action_date. Locks the table while its rows are copied'
+
+    def handle(self, *args, **options):
+        if is_partitioned():
+            self.stdout.write('Media actions are already partitioned')
+            return
+        partition_media_actions()
+        self.stdout.write(self.style.SUCCESS(f'Partitioned media actions in {len(get_partitions())} monthly partitions'))
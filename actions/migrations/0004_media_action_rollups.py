@@ -0,0 +1,53 @@
+# Generated by Django 5.2.6 on 2026-10-19 14:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Q
+from django.db.models.functions import TruncDate
+
+
+def populate_media_action_rollups(apps, schema_editor):
+    # same as actions.rollups.get_daily_counts, for all days
+    MediaAction = apps.get_model('actions', 'MediaAction')
+    MediaActionRollup = apps.get_model('actions', 'MediaActionRollup')
+
+    watches = Q(action='watch')
+    counts = (
+        MediaAction.objects.annotate(date=TruncDate('action_date'))
+        .order_by()
+        .values('media_id', 'date')
+        .annotate(
+            watches=Count('id', filter=watches),
+            likes=Count('id', filter=Q(action='like')),
+            dislikes=Count('id', filter=Q(action='dislike')),
+            unique_viewers=Count('user_id', filter=watches, distinct=True) + Count('session_key', filter=watches & Q(user=None), distinct=True),
+        )
+    )
+    MediaActionRollup.objects.bulk_create((MediaActionRollup(**row) for row in counts.iterator()), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actions', '0003_auto_20201201_0712'),
+        ('files', '0019_media_visibility'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaActionRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(db_index=True)),
+                ('watches', models.IntegerField(default=0)),
+                ('likes', models.IntegerField(default=0)),
+                ('dislikes', models.IntegerField(default=0)),
+                ('unique_viewers', models.IntegerField(default=0, help_text='users and anonymous sessions that watched the media')),
+                ('media', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='action_rollups', to='files.media')),
+            ],
+            options={
+                'unique_together': {('media', 'date')},
+            },
+        ),
+        migrations.RunPython(populate_media_action_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.6 on 2026-10-19 14:41
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actions', '0004_media_action_rollups'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mediaaction',
+            name='action_date',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 
 from files.models import Media
 from users.models import User
@@ -36,7 +37,8 @@ class MediaAction(models.Model):
     extra_info = models.TextField(blank=True, null=True)
 
     media = models.ForeignKey(Media, on_delete=models.CASCADE, related_name="mediaactions")
-    action_date = models.DateTimeField(auto_now_add=True)
+    # not auto_now_add, so that buffered actions keep the date they happened, see files.action_stream
+    action_date = models.DateTimeField(default=timezone.now)
     remote_ip = models.CharField(max_length=40, blank=True, null=True)
 
     def save(self, *args, **kwargs):
@@ -50,3 +52,25 @@ class MediaAction(models.Model):
             models.Index(fields=["user", "action", "-action_date"]),
             models.Index(fields=["session_key", "action"]),
         ]
+
+
+class MediaActionRollup(models.Model):
+    """Daily counts of the actions on a media
+
+    Kept after the raw MediaAction rows of the day are dropped by the
+    retention of actions.partitions, and read by trending queries
+    instead of scanning the raw actions
+    """
+
+    media = models.ForeignKey(Media, on_delete=models.CASCADE, related_name="action_rollups")
+    date = models.DateField(db_index=True)
+    watches = models.IntegerField(default=0)
+    likes = models.IntegerField(default=0)
+    dislikes = models.IntegerField(default=0)
+    unique_viewers = models.IntegerField(default=0, help_text="users and anonymous sessions that watched the media")
+
+    def __str__(self):
+        return f"{self.media_id} {self.date}"
+
+    class Meta:
+        unique_together = ("media", "date")
@@ -0,0 +1,156 @@
+"""Monthly range partitions of MediaAction on action_date, and retention
+
+The table is converted once with the partition_media_actions command.
+The maintain_media_actions task then creates the partitions of the next
+MEDIA_ACTION_PARTITIONS_AHEAD months and, if MEDIA_ACTIONS_RETENTION_DAYS
+is set, drops the partitions older than it. Without partitions, expired
+actions are deleted in batches instead
+"""
+
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+BATCH_SIZE = 10000
+
+
+def get_table():
+    from .models import MediaAction
+
+    return MediaAction._meta.db_table
+
+
+def add_months(month, months):
+    months = month.year * 12 + month.month - 1 + months
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def get_partition_name(month):
+    return f"{get_table()}_p{month:%Y%m}"
+
+
+def is_partitioned():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT EXISTS(SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass)", [get_table()])
+        return cursor.fetchone()[0]
+
+
+def get_partitions():
+    """Get the monthly partitions of MediaAction
+
+    Returns:
+        dict: first day of the month -> partition name
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = %s::regclass", [get_table()])
+        names = [row[0] for row in cursor.fetchall()]
+    prefix = f"{get_table()}_p"
+    return {date(int(name[-6:-2]), int(name[-2:]), 1): name for name in names if name.startswith(prefix) and name.removeprefix(prefix).isdigit()}
+
+
+def create_partitions(start, end):
+    """Create the missing monthly partitions from start to end, included
+
+    Args:
+        start: date in the first month
+        end: date in the last month
+    """
+
+    month = start.replace(day=1)
+    with connection.cursor() as cursor:
+        while month <= end:
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {get_partition_name(month)} PARTITION OF {get_table()} FOR VALUES FROM (%s) TO (%s)",
+                [f"{month} 00:00:00+00", f"{add_months(month, 1)} 00:00:00+00"],
+            )
+            month = add_months(month, 1)
+
+
+def partition_media_actions():
+    """Convert the MediaAction table to a table partitioned by month
+
+    Rows are copied to the new table in one transaction that locks
+    MediaAction, so this is meant to run during maintenance. Indexes and
+    foreign keys are recreated with their names, and the primary key
+    becomes (id, action_date), as required by Postgres
+    """
+
+    table = get_table()
+    old = f"{table}_unpartitioned"
+    sequence = f"{table}_id_partitioned_seq"
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT indexdef FROM pg_indexes WHERE tablename = %s AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass)",
+            [table, table],
+        )
+        indexes = [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'", [table])
+        foreign_keys = cursor.fetchall()
+        cursor.execute(f"SELECT min(action_date) FROM {table}")
+        first = cursor.fetchone()[0] or timezone.now()
+
+        cursor.execute(f"ALTER TABLE {table} RENAME TO {old}")
+        cursor.execute(f"CREATE TABLE {table} (LIKE {old} INCLUDING DEFAULTS) PARTITION BY RANGE (action_date)")
+        cursor.execute(f"CREATE SEQUENCE {sequence}")
+        cursor.execute(f"SELECT setval('{sequence}', COALESCE(max(id), 0) + 1, false) FROM {old}")
+        cursor.execute(f"ALTER TABLE {table} ALTER COLUMN id SET DEFAULT nextval('{sequence}')")
+        cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id")
+        create_partitions(first.date(), add_months(timezone.now().date(), settings.MEDIA_ACTION_PARTITIONS_AHEAD))
+        # catches rows outside of the monthly partitions, eg if maintain_media_actions stops running
+        cursor.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+        cursor.execute(f"INSERT INTO {table} SELECT * FROM {old}")
+        cursor.execute(f"DROP TABLE {old}")
+
+        # names of the old constraints and indexes are free now
+        cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY (id, action_date)")
+        for name, definition in foreign_keys:
+            cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition}")
+        for index in indexes:
+            cursor.execute(index)
+
+
+def drop_expired_media_actions(days):
+    """Remove the actions older than days
+
+    Partitions are dropped once all of their month is older than days,
+    otherwise actions are deleted in batches
+
+    Returns:
+        int: Number of partitions dropped or actions deleted
+    """
+
+    from .models import MediaAction
+
+    cutoff = timezone.now() - timedelta(days=days)
+    removed = 0
+    if is_partitioned():
+        with connection.cursor() as cursor:
+            for month, name in sorted(get_partitions().items()):
+                if add_months(month, 1) <= cutoff.date():
+                    cursor.execute(f"DROP TABLE {name}")
+                    removed += 1
+        return removed
+
+    while True:
+        ids = list(MediaAction.objects.filter(action_date__lt=cutoff).values_list("id", flat=True)[:BATCH_SIZE])
+        if not ids:
+            return removed
+        removed += MediaAction.objects.filter(id__in=ids).delete()[0]
+
+
+def maintain_media_actions():
+    """Create the upcoming partitions and apply the retention
+
+    Returns:
+        int: Number of partitions dropped or actions deleted
+    """
+
+    if is_partitioned():
+        today = timezone.now().date()
+        create_partitions(today, add_months(today, settings.MEDIA_ACTION_PARTITIONS_AHEAD))
+    if not settings.MEDIA_ACTIONS_RETENTION_DAYS:
+        return 0
+    return drop_expired_media_actions(settings.MEDIA_ACTIONS_RETENTION_DAYS)
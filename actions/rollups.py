@@ -0,0 +1,108 @@
+"""Daily per media rollups of MediaAction
+
+The rollup_media_actions task recomputes the rollups of the last
+MEDIA_ACTION_ROLLUP_DAYS days from the raw actions. Older days are not
+recomputed, so their rollups are kept when retention drops their actions
+"""
+
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import (
+    Count,
+    ExpressionWrapper,
+    F,
+    FloatField,
+    Func,
+    IntegerField,
+    Q,
+    Sum,
+    Value,
+)
+from django.db.models.functions import Power, TruncDate
+from django.utils import timezone
+
+
+class DaysBetween(Func):
+    arg_joiner = " - "
+    template = "(%(expressions)s)"
+    output_field = IntegerField()
+
+
+def get_daily_counts(actions):
+    """Group actions by media and day
+
+    Args:
+        actions: MediaAction queryset
+
+    Returns:
+        QuerySet: dicts of media_id, date, watches, likes, dislikes and
+            unique_viewers
+    """
+
+    watches = Q(action="watch")
+    return (
+        actions.annotate(date=TruncDate("action_date"))
+        .order_by()
+        .values("media_id", "date")
+        .annotate(
+            watches=Count("id", filter=watches),
+            likes=Count("id", filter=Q(action="like")),
+            dislikes=Count("id", filter=Q(action="dislike")),
+            unique_viewers=Count("user_id", filter=watches, distinct=True) + Count("session_key", filter=watches & Q(user=None), distinct=True),
+        )
+    )
+
+
+def rollup_media_actions(days=None):
+    """Recompute the rollups of the last days
+
+    Args:
+        days: number of days, including today. Defaults to
+            MEDIA_ACTION_ROLLUP_DAYS
+
+    Returns:
+        int: Number of rollups saved
+    """
+
+    from .models import MediaAction, MediaActionRollup
+
+    since = timezone.localdate() - timedelta(days=(days or settings.MEDIA_ACTION_ROLLUP_DAYS) - 1)
+    start = timezone.make_aware(datetime.combine(since, time.min))
+    counts = get_daily_counts(MediaAction.objects.filter(action_date__gte=start))
+    rollups = [MediaActionRollup(**row) for row in counts]
+    with transaction.atomic():
+        # a watch again moves the single watch of a user to its new day
+        MediaActionRollup.objects.filter(date__gte=since).delete()
+        MediaActionRollup.objects.bulk_create(rollups, batch_size=1000)
+    return len(rollups)
+
+
+def get_popular_media_scores(window_days, half_life_days, weights, limit):
+    """Rank listable media by their decayed rollups, with a single grouped query
+
+    The score of a media is the sum over the days of the window of its
+    weighted counts, halved every half_life_days days back
+
+    Args:
+        window_days: number of days of rollups
+        half_life_days: days after which counts weigh half
+        weights: dict of rollup field (watches, likes, dislikes,
+            unique_viewers) -> weight
+        limit: number of media returned
+
+    Returns:
+        list: (media id, score) tuples, highest score first
+    """
+
+    from .models import MediaActionRollup
+
+    today = timezone.localdate()
+    since = today - timedelta(days=window_days)
+    counts = sum((F(field) * weight for field, weight in weights.items() if weight), Value(0))
+    decay = Power(Value(0.5), DaysBetween(Value(today), "date") / Value(float(half_life_days)))
+    score = Sum(ExpressionWrapper(counts * decay, output_field=FloatField()))
+    rollups = MediaActionRollup.objects.filter(date__gte=since, media__listable=True).order_by()
+    ranked = rollups.values_list("media_id").annotate(score=score).filter(score__gt=0).order_by("-score")[:limit]
+    return list(ranked)
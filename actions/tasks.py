@@ -0,0 +1,24 @@
+from celery import shared_task as task
+from celery.utils.log import get_task_logger
+
+from . import partitions, rollups
+
+logger = get_task_logger(__name__)
+
+
+@task(name="rollup_media_actions", queue="short_tasks")
+def rollup_media_actions():
+    """Recompute the daily rollups of the recent media actions"""
+
+    saved = rollups.rollup_media_actions()
+    logger.info(f"saved {saved} media action rollups")
+    return True
+
+
+@task(name="maintain_media_actions", queue="long_tasks")
+def maintain_media_actions():
+    """Create the upcoming partitions of media actions and drop the expired ones"""
+
+    removed = partitions.maintain_media_actions()
+    logger.info(f"removed {removed} expired media action partitions or rows")
+    return True
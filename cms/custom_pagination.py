@@ -1,9 +1,18 @@
+import base64
+import binascii
+import json
 from collections import OrderedDict  # requires Python 2.7 or later
+from datetime import date
 
+from django.core.exceptions import FieldDoesNotExist, ValidationError
 from django.core.paginator import Paginator
+from django.db.models import Q
 from django.utils.functional import cached_property
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 
 class FasterDjangoPaginator(Paginator):
@@ -27,3 +36,103 @@ class FastPaginationWithoutCount(PageNumberPagination):
                 ]
             )
         )
+
+
+class KeysetPagination(BasePagination):
+    """Cursor pagination keyed on (sort field, id)
+
+    A page is fetched with a WHERE on the sort field and id of the last
+    row of the previous page, instead of an OFFSET, so with an index on
+    (field, id) deep pages cost as much as the first one. The total count
+    is only calculated for the first page, which is where the listings
+    read it from.
+    """
+
+    cursor_query_param = "cursor"
+    page_size = api_settings.PAGE_SIZE
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None, ordering="-add_date"):
+        """Get a page of queryset, ordered by ordering and then id
+
+        Args:
+            ordering: a field, or annotation, of queryset, prefixed with -
+                for descending order
+        """
+
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.field = ordering.lstrip("-")
+        self.descending = ordering.startswith("-")
+
+        cursor = self.decode_cursor(request, queryset)
+        if cursor is None:
+            self.count = queryset.count()
+            reverse = False
+        else:
+            self.count = None
+            value, id, reverse = cursor
+
+        descending = self.descending != reverse
+        prefix = "-" if descending else ""
+        queryset = queryset.order_by(f"{prefix}{self.field}", f"{prefix}id")
+        if cursor is not None:
+            lookup = "lt" if descending else "gt"
+            queryset = queryset.filter(Q(**{f"{self.field}__{lookup}": value}) | Q(**{self.field: value, f"id__{lookup}": id}))
+
+        results = list(queryset[: self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[: self.page_size]
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+        self.page = results
+        return results
+
+    def decode_cursor(self, request, queryset):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            value, id, reverse = json.loads(base64.urlsafe_b64decode(encoded.encode("ascii")))
+            try:
+                value = queryset.model._meta.get_field(self.field).to_python(value)
+            except FieldDoesNotExist:
+                # an annotation, eg the search rank
+                pass
+            return value, int(id), bool(reverse)
+        except (TypeError, ValueError, ValidationError, UnicodeEncodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, obj, reverse):
+        value = getattr(obj, self.field)
+        if isinstance(value, date):
+            value = value.isoformat()
+        encoded = base64.urlsafe_b64encode(json.dumps([value, obj.id, reverse]).encode("ascii")).decode("ascii")
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], True)
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict(
+                [
+                    ("count", self.count),
+                    ("next", self.get_next_link()),
+                    ("previous", self.get_previous_link()),
+                    ("results", data),
+                ]
+            )
+        )
@@ -94,7 +94,8 @@ MAX_CHARS_FOR_COMMENT = 10000  # so that it doesn't end up huge
 TIMESTAMP_IN_TIMEBAR = False  # shows timestamped comments in the timebar for videos
 ALLOW_MENTION_IN_COMMENTS = False  # allowing to mention other users with @ in the comments
 
-# valid options: content, author
+# valid options: content, author, calculated. calculated needs the packages
+# of requirements-full.txt
 RELATED_MEDIA_STRATEGY = "content"
 
 # Whether or not to generate a sitemap.xml listing the pages on the site (default: False)
@@ -203,6 +204,73 @@ RUNNING_STATE_STALE = 60 * 60 * 2
 
 FRIENDLY_TOKEN_LEN = 9
 
+# media_count of users, categories and tags is recomputed in batches,
+# at most this many seconds after a change
+MEDIA_COUNTS_DELAY = 10
+# same for the search vector of media
+SEARCH_INDEX_DELAY = 10
+# and for the media that users can see through permissions and RBAC groups,
+# kept short as listings of shared media depend on it
+MEDIA_VISIBILITY_DELAY = 2
+# views, likes and dislikes are counted in Redis and added to media at most
+# this many seconds after an action, see files.action_counts
+ACTION_COUNTS_DELAY = 30
+# watch, like and dislike actions are buffered in a Redis stream and saved
+# in batches this many seconds after they happen, see files.action_stream.
+# The stream keeps about the last MAXLEN actions if they are not consumed
+MEDIA_ACTIONS_DELAY = 10
+MEDIA_ACTIONS_STREAM_MAXLEN = 1000000
+# daily rollups of media actions, recomputed for the last days only, see
+# actions.rollups
+MEDIA_ACTION_ROLLUP_DAYS = 2
+# monthly partitions of media actions created in advance, once converted with
+# the partition_media_actions command, see actions.partitions
+MEDIA_ACTION_PARTITIONS_AHEAD = 3
+# days raw media actions are kept, their rollups are kept forever. Likes and
+# reports older than this are forgotten, so users can like or report again.
+# None keeps them forever
+MEDIA_ACTIONS_RETENTION_DAYS = None
+
+# popular media of the recommended section, ranked every hour from the daily
+# rollups of the last WINDOW_DAYS days. Counts are weighted and weigh half
+# every HALF_LIFE_DAYS days back
+POPULAR_MEDIA_WINDOW_DAYS = 30 * 6
+POPULAR_MEDIA_HALF_LIFE_DAYS = 7
+POPULAR_MEDIA_WEIGHTS = {"watches": 1, "unique_viewers": 0, "likes": 5, "dislikes": 0}
+POPULAR_MEDIA_LIMIT = 50
+
+# trending media, show=trending, see files.trending. Weights of the actions
+# and seconds after which they count half
+TRENDING_WEIGHTS = {"watch": 1, "like": 5}
+TRENDING_HALF_LIFE = 60 * 60 * 24
+
+# related media of the content strategy are precomputed, see files.related.
+# Lists are rebuilt at most this many seconds after a media changes, and keep
+# this many ids, more than shown so that they can be sampled
+RELATED_MEDIA_DELAY = 60
+RELATED_MEDIA_STORED = 200
+# days after which lists are rebuilt, to include media added since
+RELATED_MEDIA_MAX_AGE = 7
+
+# related media of the calculated strategy, see files.recommendations. Days
+# of watches and likes used, minimum number of users that watched both media,
+# and number of media whose similarities are computed at once
+RELATED_MEDIA_CALCULATED_DAYS = 180
+RELATED_MEDIA_CALCULATED_MIN_COWATCH = 2
+RELATED_MEDIA_CALCULATED_CHUNK = 500
+
+# seconds responses to anonymous API requests for media, categories and
+# tags are cached, see files.response_cache. 0 disables it
+RESPONSE_CACHE_TIMEOUT = 60
+
+# seconds the listing fragments of a media are cached, see files.cards.
+# They are invalidated when the media or its author is saved
+MEDIA_CARD_TIMEOUT = 60 * 60 * 24
+
+# search as you type suggestions, number returned and seconds cached per prefix
+SEARCH_SUGGEST_LIMIT = 10
+SEARCH_SUGGEST_CACHE_TIMEOUT = 60
+
 # for videos, after that duration get split into chunks
 # and encoded independently
 CHUNKIZE_VIDEO_DURATION = 60 * 5
@@ -238,6 +306,12 @@ UPLOAD_MAX_FILES_NUMBER = 100
 CONCURRENT_UPLOADS = True
 CHUNKS_DONE_PARAM_NAME = "done"
 FILE_STORAGE = "django.core.files.storage.DefaultStorage"
+# seconds the manifest of a chunked upload is kept, an interrupted
+# upload can be resumed within this time
+UPLOAD_SESSION_TIMEOUT = 60 * 60 * 24
+# read finished chunked uploads once, as the first step of media_init, to
+# calculate the md5 and cut long videos in chunks with the same read
+UPLOAD_INGEST = True
 
 X_FRAME_OPTIONS = "ALLOWALL"
 EMAIL_BACKEND = "djcelery_email.backends.CeleryEmailBackend"
@@ -438,12 +512,49 @@ CELERY_BEAT_SCHEDULE = {
     },
     "get_list_of_popular_media": {
         "task": "get_list_of_popular_media",
-        "schedule": crontab(minute=1, hour="*/10"),
+        "schedule": crontab(minute=10),
     },
     "update_listings_thumbnails": {
         "task": "update_listings_thumbnails",
         "schedule": crontab(minute=2, hour="*/30"),
     },
+    # picks up any changes left if a scheduled run was lost
+    "update_media_counts": {
+        "task": "update_media_counts",
+        "schedule": crontab(minute="*/10"),
+    },
+    "update_search_vectors": {
+        "task": "update_search_vectors",
+        "schedule": crontab(minute="*/10"),
+    },
+    "update_media_visibility": {
+        "task": "update_media_visibility",
+        "schedule": crontab(minute="*/10"),
+    },
+    "flush_action_counts": {
+        "task": "flush_action_counts",
+        "schedule": crontab(minute="*/10"),
+    },
+    "ingest_media_actions": {
+        "task": "ingest_media_actions",
+        "schedule": crontab(minute="*/10"),
+    },
+    "rollup_media_actions": {
+        "task": "rollup_media_actions",
+        "schedule": crontab(minute=5),
+    },
+    "queue_stale_related_media": {
+        "task": "queue_stale_related_media",
+        "schedule": crontab(hour=4, minute=30),
+    },
+    "update_calculated_related_media": {
+        "task": "update_calculated_related_media",
+        "schedule": crontab(hour=5, minute=0),
+    },
+    "maintain_media_actions": {
+        "task": "maintain_media_actions",
+        "schedule": crontab(hour=3, minute=15),
+    },
 }
 # TODO: beat, delete chunks from media root
 # chunks_dir after xx days...(also uploads_dir)
@@ -460,6 +571,8 @@ GLOBAL_LOGIN_REQUIRED = False
 CELERY_TASK_ALWAYS_EAGER = False
 if os.environ.get("TESTING"):
     CELERY_TASK_ALWAYS_EAGER = True
+    # the cache is not rolled back with the database between tests
+    RESPONSE_CACHE_TIMEOUT = 0
 
 # if True, only show original, don't perform any action on videos
 DO_NOT_TRANSCODE_VIDEO = False
@@ -554,6 +667,9 @@ DJANGO_ADMIN_URL = "admin/"
 
 USE_SAML = False
 USE_RBAC = False
+# seconds the RBAC categories of a user are cached, changes to RBAC groups
+# and memberships invalidate them anyway
+RBAC_CACHE_TIMEOUT = 60 * 60 * 24
 USE_IDENTITY_PROVIDERS = False
 JAZZMIN_UI_TWEAKS = {"theme": "flatly"}
 
@@ -0,0 +1,99 @@
+"""Write-behind views, likes and dislikes of media
+
+Actions increment a per media counter in a Redis hash, instead of an
+UPDATE of the media row that locks it for every watch of a popular media.
+The flush_action_counts task adds the pending increments to Postgres in
+bulk, with one UPDATE per distinct increment, at most ACTION_COUNTS_DELAY
+seconds after an action
+"""
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django_redis import get_redis_connection
+
+PENDING_KEY = "action_counts:{}"
+FLUSHING_KEY = "action_counts:{}:flushing"
+SCHEDULED_KEY = "action_counts:scheduled"
+LOCK_KEY = "action_counts:lock"
+COUNTED_ACTIONS = {"watch": "views", "like": "likes", "dislike": "dislikes"}
+
+
+def incr_action_count(media_id, action):
+    """Count an action on a media
+
+    Args:
+        media_id: id of a Media object
+        action: watch, like or dislike
+
+    Returns:
+        bool: whether the action is counted
+    """
+
+    field = COUNTED_ACTIONS.get(action)
+    if not field:
+        return False
+
+    get_redis_connection("default").hincrby(PENDING_KEY.format(field), media_id, 1)
+    if cache.add(SCHEDULED_KEY, 1, settings.ACTION_COUNTS_DELAY * 10):
+        from .tasks import flush_action_counts
+
+        flush_action_counts.apply_async(countdown=settings.ACTION_COUNTS_DELAY)
+    return True
+
+
+def add_action_counts(field, counts):
+    """Add increments to a counter of media, with one UPDATE per distinct increment
+
+    Args:
+        field: views, likes or dislikes
+        counts: dict of media id -> increment
+    """
+
+    from .models import Media
+
+    increments = defaultdict(list)
+    for media_id, increment in counts.items():
+        increments[increment].append(media_id)
+    for increment, media_ids in increments.items():
+        Media.objects.filter(id__in=media_ids).update(**{field: F(field) + increment})
+
+
+def flush_action_counts_to_db():
+    """Add the pending increments of views, likes and dislikes to media
+
+    The pending hash of a field is renamed before it is read, so actions
+    that happen during a flush are kept for the next one. If a flush
+    fails, its hash is left in place and retried by the next one
+
+    Returns:
+        int: Number of counters flushed
+    """
+
+    # the lock keeps a scheduled and a beat flush from adding the same
+    # increments twice
+    if not cache.add(LOCK_KEY, 1, 60 * 5):
+        return 0
+
+    redis = get_redis_connection("default")
+    flushed = 0
+    try:
+        cache.delete(SCHEDULED_KEY)
+        for field in COUNTED_ACTIONS.values():
+            key = FLUSHING_KEY.format(field)
+            if not redis.exists(key):
+                if not redis.exists(PENDING_KEY.format(field)):
+                    continue
+                redis.rename(PENDING_KEY.format(field), key)
+
+            counts = {int(media_id): int(increment) for media_id, increment in redis.hgetall(key).items()}
+            with transaction.atomic():
+                add_action_counts(field, counts)
+            redis.delete(key)
+            flushed += len(counts)
+    finally:
+        cache.delete(LOCK_KEY)
+    return flushed
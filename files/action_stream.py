@@ -0,0 +1,235 @@
+"""Buffered ingestion of watch, like and dislike actions
+
+Views append actions to a Redis stream, instead of sending a Celery
+message per page view. The ingest_media_actions task drains the stream in
+batches: it loads the earlier actions of a whole batch with a few grouped
+queries, applies the checks of files.methods.pre_save_action in memory,
+keeps only the last watch of a user or session on a media, and saves the
+batch with a bulk_create and one UPDATE per counter and increment
+"""
+
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max, Q
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from .action_counts import COUNTED_ACTIONS, add_action_counts
+from .trending import add_trending_actions
+
+STREAM_KEY = "media_actions:stream"
+SCHEDULED_KEY = "media_actions:scheduled"
+LOCK_KEY = "media_actions:lock"
+BATCH_SIZE = 5000
+STREAMED_ACTIONS = list(COUNTED_ACTIONS)
+
+logger = logging.getLogger(__name__)
+
+
+def queue_media_action(user_or_session, media, action):
+    """Append an action to the stream
+
+    Args:
+        user_or_session: dict returned by files.methods.get_user_or_session
+        media: Media object
+        action: watch, like or dislike
+
+    Returns:
+        bool: whether the action is queued. If not, it is up to the caller
+            to save it with files.tasks.save_user_action
+    """
+
+    if action not in STREAMED_ACTIONS:
+        return False
+
+    event = {
+        "user": user_or_session.get("user_id") or "",
+        "session": user_or_session.get("user_session") or "",
+        "ip": user_or_session.get("remote_ip_addr") or "",
+        "media": media.id,
+        "action": action,
+        "time": time.time(),
+    }
+    try:
+        get_redis_connection("default").xadd(STREAM_KEY, event, maxlen=settings.MEDIA_ACTIONS_STREAM_MAXLEN, approximate=True)
+    except RedisError:
+        logger.warning(f"could not queue {action} of media {media.id}, Redis is not available")
+        return False
+    try:
+        if cache.add(SCHEDULED_KEY, 1, settings.MEDIA_ACTIONS_DELAY * 10):
+            from .tasks import ingest_media_actions
+
+            ingest_media_actions.apply_async(countdown=settings.MEDIA_ACTIONS_DELAY)
+    except Exception:
+        # queued, the periodic ingest_media_actions task saves it
+        logger.exception("could not schedule ingest_media_actions")
+    return True
+
+
+def is_counted(action, user_id, last, last_by_ip, when, duration):
+    """Same checks as files.methods.pre_save_action, on the date of the
+    last same action of the user or session and of the IP address"""
+
+    if last:
+        if action in ["like", "dislike"]:
+            return False
+        if action == "watch" and user_id and duration and (when - last).total_seconds() > duration:
+            return True
+    elif user_id:
+        return True
+
+    if not user_id:
+        if not last_by_ip:
+            return True
+        elapsed = (when - last_by_ip).total_seconds()
+        if action == "watch" and not elapsed > duration:
+            return False
+        return elapsed > settings.TIME_TO_ACTION_ANONYMOUS
+    return False
+
+
+def get_last_actions(events):
+    """Get the dates of the last actions of the users, sessions and IP
+    addresses of events on their media
+
+    Returns:
+        dict: (kind, user id, session key or IP address, media id, action) -> date
+    """
+
+    from actions.models import MediaAction
+
+    media_ids = {event["media"] for event in events}
+    actions = MediaAction.objects.filter(media_id__in=media_ids, action__in={event["action"] for event in events}).order_by()
+    last = {}
+
+    user_ids = {event["user"] for event in events if event["user"]}
+    if user_ids:
+        for row in actions.filter(user_id__in=user_ids).values("user_id", "media_id", "action").annotate(date=Max("action_date")):
+            last[("actor", row["user_id"], "", row["media_id"], row["action"])] = row["date"]
+
+    sessions = {event["session"] for event in events if not event["user"]}
+    if sessions:
+        for row in actions.filter(session_key__in=sessions).values("session_key", "media_id", "action").annotate(date=Max("action_date")):
+            last[("actor", None, row["session_key"], row["media_id"], row["action"])] = row["date"]
+        ips = {event["ip"] for event in events if not event["user"]}
+        for row in actions.filter(user=None, remote_ip__in=ips).values("remote_ip", "media_id", "action").annotate(date=Max("action_date")):
+            last[("ip", None, row["remote_ip"], row["media_id"], row["action"])] = row["date"]
+    return last
+
+
+def save_media_actions(events):
+    """Save a batch of events read from the stream
+
+    Returns:
+        int: Number of actions saved
+    """
+
+    from actions.models import MediaAction
+    from users.models import User
+
+    from .models import Media
+
+    media = list(Media.objects.filter(id__in={event["media"] for event in events}).values_list("id", "duration", "listable"))
+    durations = {id: duration for id, duration, _ in media}
+    # only listable media trend, see files.trending
+    listable = {id for id, _, is_listable in media if is_listable}
+    user_ids = set(User.objects.filter(id__in={event["user"] for event in events if event["user"]}).values_list("id", flat=True))
+    events = [event for event in events if event["media"] in durations and (event["session"] or event["user"] in user_ids)]
+    if not events:
+        return 0
+
+    last = get_last_actions(events)
+    watches = {}
+    actions = []
+    counts = defaultdict(lambda: defaultdict(int))
+    trending = []
+    for event in events:
+        user_id = event["user"] or None
+        session = "" if user_id else event["session"]
+        actor = ("actor", user_id, session, event["media"], event["action"])
+        by_ip = ("ip", None, event["ip"], event["media"], event["action"])
+        if not is_counted(event["action"], user_id, last.get(actor), last.get(by_ip), event["date"], durations[event["media"]]):
+            continue
+
+        last[actor] = event["date"]
+        if not user_id:
+            last[by_ip] = event["date"]
+        counts[COUNTED_ACTIONS[event["action"]]][event["media"]] += 1
+        if event["media"] in listable:
+            trending.append((event["media"], event["action"], event["date"].timestamp()))
+        action = MediaAction(
+            user_id=user_id,
+            session_key=session or None,
+            media_id=event["media"],
+            action=event["action"],
+            action_date=event["date"],
+            remote_ip=event["ip"] or None,
+        )
+        if event["action"] == "watch":
+            # only the last watch of a user or session on a media is kept
+            watches[actor] = action
+        else:
+            actions.append(action)
+
+    # earlier watches are deleted, as in files.tasks.save_user_action
+    earlier = Q()
+    media_ids = defaultdict(list)
+    for _, user_id, session, media_id, _ in watches:
+        media_ids[(user_id, session)].append(media_id)
+    for (user_id, session), ids in media_ids.items():
+        earlier |= Q(user_id=user_id, media_id__in=ids) if user_id else Q(session_key=session, media_id__in=ids)
+
+    with transaction.atomic():
+        if watches:
+            MediaAction.objects.filter(earlier, action="watch").delete()
+        MediaAction.objects.bulk_create(actions + list(watches.values()), batch_size=1000)
+        for field, field_counts in counts.items():
+            add_action_counts(field, field_counts)
+    add_trending_actions(trending)
+    return len(actions) + len(watches)
+
+
+def parse_event(fields):
+    fields = {key.decode(): value.decode() for key, value in fields.items()}
+    return {
+        "user": int(fields["user"]) if fields["user"] else None,
+        "session": fields["session"],
+        "ip": fields["ip"],
+        "media": int(fields["media"]),
+        "action": fields["action"],
+        "date": datetime.fromtimestamp(float(fields["time"]), tz=timezone.utc),
+    }
+
+
+def ingest_media_actions_from_stream():
+    """Drain the stream of actions in batches of BATCH_SIZE
+
+    Events are removed from the stream once their batch is saved, so a
+    failed batch is retried by the next run
+
+    Returns:
+        int: Number of actions saved
+    """
+
+    # a single consumer, so that the checks see the actions of earlier batches
+    if not cache.add(LOCK_KEY, 1, 60 * 10):
+        return 0
+
+    redis = get_redis_connection("default")
+    saved = 0
+    try:
+        cache.delete(SCHEDULED_KEY)
+        while True:
+            entries = redis.xrange(STREAM_KEY, count=BATCH_SIZE)
+            if not entries:
+                return saved
+            saved += save_media_actions([parse_event(fields) for id, fields in entries])
+            redis.xdel(STREAM_KEY, *[id for id, fields in entries])
+    finally:
+        cache.delete(LOCK_KEY)
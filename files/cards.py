@@ -0,0 +1,56 @@
+"""Precomputed "card" fragments of media, for listings
+
+A card holds the parts of a listed media that only change when the media
+or its author is saved: its urls, thumbnail and preview paths and author
+details. Listing serializers read the cards of a whole page with a single
+get_many, instead of reversing urls, resolving file paths and looking up
+preview encodings for every media
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+
+KEY = "media_card:{}"
+
+
+def build_media_card(media):
+    return {
+        "url": media.get_absolute_url(),
+        "api_url": media.get_absolute_url(api=True),
+        "thumbnail_url": media.thumbnail_url,
+        "preview_url": media.preview_url,
+        "user": media.user.username,
+        "author_name": media.author_name,
+        "author_profile": media.author_profile(),
+        "author_thumbnail": media.author_thumbnail(),
+    }
+
+
+def get_media_cards(media):
+    """Get the cards of media, building and caching the missing ones
+
+    Args:
+        media: Media objects
+
+    Returns:
+        dict: media id -> card
+    """
+
+    # keyed on uid, as ids can be reused by a new database
+    keys = {KEY.format(m.uid.hex): m for m in media}
+    cards = cache.get_many(keys.keys())
+    missing = {key: build_media_card(m) for key, m in keys.items() if key not in cards}
+    if missing:
+        cache.set_many(missing, settings.MEDIA_CARD_TIMEOUT)
+        cards.update(missing)
+    return {keys[key].id: card for key, card in cards.items()}
+
+
+def invalidate_media_cards(uids):
+    """Delete the cards of media
+
+    Args:
+        uids: uids of Media objects
+    """
+
+    cache.delete_many([KEY.format(uid.hex) for uid in uids])
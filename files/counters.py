@@ -0,0 +1,110 @@
+"""Denormalised media counts of users, categories and tags
+
+Signals only mark the objects whose media_count may have changed.
+The update_media_counts task recomputes them in batches, with one grouped
+query per model, instead of a COUNT and a save per object on every save
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from django_redis import get_redis_connection
+
+DIRTY_KEY = "media_counts:dirty:{}"
+SCHEDULED_KEY = "media_counts:scheduled"
+BATCH_SIZE = 1000
+
+
+def mark_media_counts_dirty(users=(), categories=(), tags=()):
+    """Mark objects whose media_count has to be recomputed
+
+    A single update_media_counts task is scheduled for all the changes
+    that happen within MEDIA_COUNTS_DELAY seconds
+
+    Args:
+        users: ids of User objects
+        categories: ids of Category objects
+        tags: ids of Tag objects
+    """
+
+    redis = get_redis_connection("default")
+    pipe = redis.pipeline()
+    marked = False
+    for name, ids in (("user", users), ("category", categories), ("tag", tags)):
+        ids = [id for id in ids if id]
+        if ids:
+            pipe.sadd(DIRTY_KEY.format(name), *ids)
+            marked = True
+    if not marked:
+        return False
+    pipe.execute()
+
+    if cache.add(SCHEDULED_KEY, 1, settings.MEDIA_COUNTS_DELAY * 10):
+        from .tasks import update_media_counts
+
+        update_media_counts.apply_async(countdown=settings.MEDIA_COUNTS_DELAY)
+    return True
+
+
+def update_dirty(key, update, batch_size=BATCH_SIZE):
+    """Pop the dirty ids of a Redis set in batches and pass them to update
+
+    Returns:
+        int: Number of ids updated
+    """
+
+    redis = get_redis_connection("default")
+    updated = 0
+    while True:
+        ids = redis.spop(key, batch_size)
+        if not ids:
+            return updated
+        ids = [int(id) for id in ids]
+        try:
+            update(ids)
+        except BaseException:
+            # not updated, leave them for the next run
+            redis.sadd(key, *ids)
+            raise
+        updated += len(ids)
+
+
+def set_counts(model, ids, counts):
+    model.objects.bulk_update([model(id=id, media_count=counts.get(id, 0)) for id in ids], ["media_count"])
+
+
+def recompute_media_counts():
+    """Recompute media_count of the users, categories and tags marked as dirty
+
+    Returns:
+        int: Number of objects updated
+    """
+
+    from users.models import User
+
+    from .models import Category, Media, Tag
+
+    def update_users(ids):
+        counts = Media.objects.filter(listable=True, user_id__in=ids).order_by().values_list("user_id").annotate(Count("id"))
+        set_counts(User, ids, dict(counts))
+
+    def update_categories(ids):
+        # Always set number of Category the total number of media
+        # see Category.update_category_media
+        counts = Media.category.through.objects.filter(category_id__in=ids).order_by().values_list("category_id").annotate(Count("media_id"))
+        set_counts(Category, ids, dict(counts))
+
+    def update_tags(ids):
+        counts = Media.tags.through.objects.filter(tag_id__in=ids, media__state="public", media__is_reviewed=True).order_by().values_list("tag_id").annotate(Count("media_id"))
+        set_counts(Tag, ids, dict(counts))
+
+    cache.delete(SCHEDULED_KEY)
+    updated = update_dirty(DIRTY_KEY.format("user"), update_users)
+    categories = update_dirty(DIRTY_KEY.format("category"), update_categories)
+    tags = update_dirty(DIRTY_KEY.format("tag"), update_tags)
+
+    # bulk_update sends no signals, invalidate cached listings of the counts
+    from .response_cache import invalidate_response_cache
+
+    invalidate_response_cache(*[tag for tag, count in (("categories", categories), ("tags", tags)) if count])
+    return updated + categories + tags
@@ -1,6 +1,7 @@
 # Kudos to Werner Robitza, AVEQ GmbH, for helping with ffmpeg
 # related content
 
+import fcntl
 import hashlib
 import json
 import logging
@@ -9,6 +10,7 @@ import random
 import shutil
 import subprocess
 import tempfile
+from collections import Counter
 from fractions import Fraction
 
 import filetype
@@ -97,6 +99,11 @@ EXTENSIONS = {"h264": "mp4", "h265": "mp4", "vp9": "webm"}
 
 VIDEO_PROFILES = {"h264": "main", "h265": "main"}
 
+# ioctl request to clone a file (reflink), from linux/fs.h
+FICLONE = 0x40049409
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
 
 def get_portal_workflow():
     return settings.PORTAL_WORKFLOW
@@ -183,6 +190,76 @@ def create_temp_dir(suffix=None, dir=settings.TEMP_DIRECTORY):
     return td
 
 
+def copy_file(source_path, target_path, allow_link=True):
+    """Copy a file, avoiding to duplicate its bytes where the filesystem allows it
+
+    Tries in order a reflink (FICLONE, copy-on-write on btrfs/XFS), a hard link,
+    an in-kernel copy_file_range, and last a streamed copy with a fixed size buffer.
+    Hard links are safe for media files since they are never modified in place,
+    trimming and encoding always replace the whole file
+
+    Args:
+        source_path (str): Path of the file to copy
+        target_path (str): Path of the new file, must not exist
+        allow_link (bool): Whether a hard link is acceptable
+
+    Returns:
+        str: The method that was used, one of reflink, link, copy_file_range, copy
+    """
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+
+    with open(source_path, "rb") as source, open(target_path, "xb") as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            return "reflink"
+        except OSError:
+            pass
+
+    if allow_link:
+        os.remove(target_path)
+        try:
+            os.link(source_path, target_path)
+            return "link"
+        except OSError:
+            pass
+
+    with open(source_path, "rb") as source, open(target_path, "wb") as target:
+        return copy_file_object(source, target)
+
+
+def copy_file_object(source, target):
+    """Append the rest of an open file to another open file
+
+    Uses the in-kernel copy_file_range where available, so data never goes
+    through Python, otherwise a streamed copy with a fixed size buffer.
+    Memory use does not depend on the size of the file
+
+    Args:
+        source: File object opened for reading
+        target: File object opened for writing
+
+    Returns:
+        str: The method that was used, copy_file_range or copy
+    """
+    target.flush()
+    if hasattr(os, "copy_file_range"):
+        try:
+            while os.copy_file_range(source.fileno(), target.fileno(), COPY_BUFFER_SIZE * 64):
+                pass
+            return "copy_file_range"
+        except OSError:
+            # eg cross filesystem copy on older kernels, continue from
+            # where the kernel stopped with a plain copy
+            pass
+    shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+    return "copy"
+
+
+def get_upload_ingest_key(uid):
+    """Cache key for what uploader.tasks.ingest_upload found for the media with this uid"""
+    return f"upload_ingest:{uid.hex}"
+
+
 def produce_friendly_token(token_len=settings.FRIENDLY_TOKEN_LEN):
     token = ""
     while len(token) != token_len:
@@ -232,10 +309,13 @@ def run_command(cmd, cwd=None):
     return ret
 
 
-def media_file_info(input_file):
+def media_file_info(input_file, md5sum=None):
     """
     Get the info about an input file, as determined by ffprobe
 
+    If md5sum is given, eg computed while the file was uploaded,
+    the file is not read once more to calculate it
+
     Returns a dict, with the keys:
     - `filename`: Filename
     - `file_size`: Size of the file in bytes
@@ -271,12 +351,13 @@ def media_file_info(input_file):
         ret["fail"] = True
         return ret
 
-    cmd = ["md5sum", input_file]
-    stdout = run_command(cmd).get("out")
-    if stdout:
-        md5sum = stdout.split()[0]
-    else:
-        md5sum = ""
+    if md5sum is None:
+        cmd = ["md5sum", input_file]
+        stdout = run_command(cmd).get("out")
+        if stdout:
+            md5sum = stdout.split()[0]
+        else:
+            md5sum = ""
 
     cmd = [
         settings.FFPROBE_COMMAND,
@@ -959,6 +1040,110 @@ def trim_video_method(media_file_path, timestamps_list):
             return False
 
 
+def get_segment_pieces(timestamps_list):
+    """Map a list of timestamps to the pieces the ffmpeg segment muxer produces
+
+    The segment muxer splits a file at every boundary passed with -segment_times,
+    so piece k covers the time between boundary k-1 and boundary k. Each requested
+    segment is made up of one or more consecutive pieces (more than one only when
+    segments overlap)
+
+    Args:
+        timestamps_list (list): List of dictionaries with startTime and endTime
+
+    Returns:
+        tuple: (list of boundaries in seconds, list of lists of piece indexes per segment)
+    """
+    boundaries = set()
+    for item in timestamps_list:
+        for key in ("startTime", "endTime"):
+            seconds = timestamp_to_seconds(item[key])
+            if seconds > 0:
+                boundaries.add(seconds)
+    boundaries = sorted(boundaries)
+
+    pieces = []
+    for item in timestamps_list:
+        start_time = timestamp_to_seconds(item['startTime'])
+        end_time = timestamp_to_seconds(item['endTime'])
+        first = boundaries.index(start_time) + 1 if start_time > 0 else 0
+        last = boundaries.index(end_time) if end_time > 0 else 0
+        pieces.append(list(range(first, last + 1)))
+
+    return boundaries, pieces
+
+
+def trim_video_segments_method(media_file_path, timestamps_list, output_dir):
+    """Cut many segments out of a video file with a single ffmpeg run
+
+    Uses the ffmpeg segment muxer with stream copy, so the source file is read
+    once no matter how many segments are requested
+
+    Args:
+        media_file_path (str): Path to the media file
+        timestamps_list (list): List of dictionaries with startTime and endTime
+        output_dir (str): Directory where the segment files will be written
+
+    Returns:
+        list: Path of the produced file per segment, None for segments that failed.
+        Empty list if the file could not be segmented at all
+    """
+    if not isinstance(timestamps_list, list) or not timestamps_list:
+        return []
+
+    if not os.path.exists(media_file_path):
+        return []
+
+    _, input_ext = os.path.splitext(media_file_path)
+    work_dir = tempfile.mkdtemp(dir=output_dir)
+    boundaries, pieces = get_segment_pieces(timestamps_list)
+
+    pieces_pattern = os.path.join(work_dir, f"piece_%03d{input_ext}")
+    cmd = [settings.FFMPEG_COMMAND, "-y", "-i", media_file_path, "-map", "0", "-c", "copy", "-f", "segment", "-reset_timestamps", "1", "-avoid_negative_ts", "1"]
+    if boundaries:
+        cmd.extend(["-segment_times", ",".join(str(b) for b in boundaries)])
+    else:
+        # nothing to split, a single piece for the whole file
+        cmd.extend(["-segment_time", str(10**9)])
+    cmd.append(pieces_pattern)
+
+    result = run_command(cmd)  # noqa
+
+    pieces_usage = Counter(piece for segment_pieces in pieces for piece in segment_pieces)
+
+    results = []
+    for i, segment_pieces in enumerate(pieces):
+        piece_files = [pieces_pattern % piece for piece in segment_pieces]
+        piece_files = [f for f in piece_files if os.path.exists(f) and os.path.getsize(f) > 0]
+        if not piece_files or len(piece_files) != len(segment_pieces):
+            results.append(None)
+            continue
+
+        segment_file = os.path.join(work_dir, f"segment_{i}{input_ext}")
+        if len(piece_files) == 1:
+            if pieces_usage[segment_pieces[0]] > 1:
+                shutil.copy2(piece_files[0], segment_file)
+            else:
+                os.rename(piece_files[0], segment_file)
+        else:
+            # overlapping segments share pieces, join them back with the concat demuxer
+            concat_list_path = os.path.join(work_dir, f"concat_list_{i}.txt")
+            with open(concat_list_path, "w") as f:
+                for piece_file in piece_files:
+                    f.write(f"file '{piece_file}'\n")
+            concat_cmd = [settings.FFMPEG_COMMAND, "-y", "-f", "concat", "-safe", "0", "-i", concat_list_path, "-c", "copy", segment_file]
+            concat_result = run_command(concat_cmd)  # noqa
+
+        if os.path.exists(segment_file) and os.path.getsize(segment_file) > 0:
+            results.append(segment_file)
+        else:
+            results.append(None)
+
+    if not any(results):
+        return []
+    return results
+
+
 def get_alphanumeric_only(string):
     """Returns a query that contains only alphanumeric characters
     This include characters other than the English alphabet too
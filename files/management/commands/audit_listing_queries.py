@@ -0,0 +1,188 @@
+import re
+import time
+from collections import Counter
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from files.feeds import IndexRSSFeed, SearchRSSFeed
+from files.methods import show_related_media_content
+from files.models import Media, MediaVisibility
+from files.views import MediaList, MediaSearch
+from users.models import User
+
+# name, view, url. {username} is the author of the latest listable media
+LISTINGS = [
+    ("media", MediaList, "/api/v1/media"),
+    ("media by views", MediaList, "/api/v1/media?sort_by=views_desc"),
+    ("media by likes", MediaList, "/api/v1/media?sort_by=likes_desc"),
+    ("media by title", MediaList, "/api/v1/media?sort_by=title_asc"),
+    ("media by edit date", MediaList, "/api/v1/media?sort_by=edit_date_desc"),
+    ("featured media", MediaList, "/api/v1/media?show=featured"),
+    ("videos", MediaList, "/api/v1/media?media_type=video"),
+    ("author media", MediaList, "/api/v1/media?author={username}"),
+    ("search", MediaSearch, "/api/v1/search?q=media"),
+    ("search by views", MediaSearch, "/api/v1/search?q=media&sort_by=views_desc"),
+    ("rss", IndexRSSFeed, "/rss/"),
+    ("rss search", SearchRSSFeed, "/rss/search?q=media"),
+]
+
+# columns of the seeded media that are not copied from an existing one
+SEED_COLUMNS = {
+    "friendly_token": "'seed' || i",
+    "uid": "md5(random()::text || i)::uuid",
+    "title": "'seeded media ' || i",
+    "add_date": "now() - i * interval '1 minute'",
+    "edit_date": "now() - i * interval '1 minute'",
+    "views": "(random() * 10000)::int",
+    "likes": "(random() * 100)::int",
+    "listable": "mod(i, 5) <> 0",
+    "featured": "mod(i, 100) = 0",
+    "media_type": "(ARRAY['video', 'image', 'audio', 'pdf'])[1 + mod(i, 4)]",
+}
+
+
+def get_query_shape(sql):
+    """Replace the literals of a query, so that queries that differ only
+    on their parameters are grouped together"""
+
+    sql = re.sub(r"'(?:[^']|'')*'", "%s", sql)
+    sql = re.sub(r"\b\d+(\.\d+)?\b", "%s", sql)
+    return re.sub(r"\(%s(, %s)*\)", "(...)", sql)
+
+
+class Command(BaseCommand):
+    help = 'Record the queries of media listings, search, feeds and related media, grouped by shape'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='username to run the listings as, anonymous by default')
+        parser.add_argument('--explain', action='store_true', help='show the EXPLAIN ANALYZE plan of every media query')
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='add this many copies of the first media before the audit. Like everything the command does, they are rolled back at the end',
+        )
+        parser.add_argument(
+            '--share',
+            type=int,
+            default=0,
+            help='share this many of the seeded media that are not listable with --user, for the plans of users that see shared media',
+        )
+        parser.add_argument('--compare', action='store_true', help='also show the plans without the partial listing indexes')
+
+    def handle(self, *args, **options):
+        user = AnonymousUser()
+        if options['user']:
+            user = User.objects.filter(username=options['user']).first()
+            if not user:
+                raise CommandError(f'User {options["user"]} does not exist')
+        if options['share'] and not (options['seed'] and user.is_authenticated):
+            raise CommandError('--share needs --seed and --user')
+
+        with transaction.atomic():
+            if options['seed']:
+                self.seed(options['seed'])
+            if options['share']:
+                self.share(user, options['share'])
+            queries = self.audit(user)
+            if options['explain'] or options['compare']:
+                self.explain(queries, 'with the listing indexes')
+            if options['compare']:
+                self.drop_listing_indexes()
+                self.explain(queries, 'without the listing indexes')
+            transaction.set_rollback(True)
+
+    def seed(self, count):
+        template = Media.objects.order_by('id').first()
+        if not template:
+            raise CommandError('--seed copies an existing media, add one first')
+
+        qn = connection.ops.quote_name
+        table = qn(Media._meta.db_table)
+        columns = [field.column for field in Media._meta.concrete_fields if not field.primary_key]
+        select = [SEED_COLUMNS.get(column, f'm.{qn(column)}') for column in columns]
+        columns = ", ".join(qn(column) for column in columns)
+        started = time.perf_counter()
+        with connection.cursor() as cursor:
+            cursor.execute(f'INSERT INTO {table} ({columns}) SELECT {", ".join(select)} FROM {table} m, generate_series(1, %s) i WHERE m.id = %s', [count, template.id])
+            cursor.execute(f'ANALYZE {table}')
+        self.stdout.write(f'Seeded {count} media in {time.perf_counter() - started:.1f}s')
+
+    def share(self, user, count):
+        qn = connection.ops.quote_name
+        table = qn(MediaVisibility._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (user_id, media_id) SELECT %s, id FROM {qn(Media._meta.db_table)} WHERE NOT listable ORDER BY id DESC LIMIT %s',
+                [user.id, count],
+            )
+            cursor.execute(f'ANALYZE {table}')
+        self.stdout.write(f'Shared {count} media with {user.username}')
+
+    def drop_listing_indexes(self):
+        with connection.cursor() as cursor:
+            for index in Media._meta.indexes:
+                if index.condition is not None:
+                    cursor.execute(f'DROP INDEX {connection.ops.quote_name(index.name)}')
+
+    def audit(self, user):
+        """Run every listing and print its queries
+
+        Returns:
+            list: (shape, sql) of the distinct queries on media
+        """
+
+        latest = Media.objects.filter(listable=True).select_related('user').order_by('-add_date').first()
+        host = urlparse(settings.FRONTEND_HOST).netloc
+
+        runs = []
+        for name, view, url in LISTINGS:
+            if '{username}' in url:
+                if not latest:
+                    continue
+                url = url.format(username=latest.user.username)
+            if issubclass(view, (MediaList, MediaSearch)):
+                request = APIRequestFactory().get(url, HTTP_HOST=host)
+                if user.is_authenticated:
+                    force_authenticate(request, user=user)
+                runs.append((name, lambda request=request, view=view: view.as_view()(request)))
+            else:
+                request = RequestFactory().get(url, HTTP_HOST=host)
+                request.user = user
+                runs.append((name, lambda request=request, view=view: view()(request)))
+        if latest:
+            runs.append(('related media', lambda: show_related_media_content(latest, None, 100)))
+
+        media_queries = {}
+        for name, run in runs:
+            with CaptureQueriesContext(connection) as context:
+                started = time.perf_counter()
+                run()
+                duration = (time.perf_counter() - started) * 1000
+            shapes = Counter()
+            for query in context.captured_queries:
+                shape = get_query_shape(query['sql'])
+                shapes[shape] += 1
+                if query['sql'].startswith('SELECT') and Media._meta.db_table in query['sql']:
+                    media_queries.setdefault(shape, query['sql'])
+
+            self.stdout.write(self.style.MIGRATE_HEADING(f'{name}: {len(context.captured_queries)} queries, {duration:.1f}ms'))
+            for shape, count in shapes.items():
+                self.stdout.write(f'  x{count} {shape}')
+        return list(media_queries.items())
+
+    def explain(self, queries, title):
+        self.stdout.write(self.style.MIGRATE_HEADING(f'Plans {title}'))
+        with connection.cursor() as cursor:
+            for shape, sql in queries:
+                cursor.execute(f'EXPLAIN (ANALYZE, BUFFERS) {sql}')
+                self.stdout.write(f'\n{shape}')
+                for (line,) in cursor.fetchall():
+                    self.stdout.write(f'  {line}')
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from files.models import Media
+from files.search_index import BATCH_SIZE, set_search_vectors
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the weighted search vector of all media'
+
+    def handle(self, *args, **options):
+        ids = list(Media.objects.order_by("id").values_list("id", flat=True))
+        updated = 0
+        while ids:
+            batch, ids = ids[:BATCH_SIZE], ids[BATCH_SIZE:]
+            media = list(Media.objects.filter(id__in=batch).select_related("user").prefetch_related("tags", "subtitles"))
+            updated += set_search_vectors(media)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt the search vector of {updated} media'))
@@ -6,12 +6,13 @@ import logging
 import os
 import random
 import re
+import shutil
 import subprocess
+import uuid
 from datetime import datetime
 
 from django.conf import settings
 from django.core.cache import cache
-from django.core.files import File
 from django.core.mail import EmailMessage
 from django.db.models import Q
 from django.utils import timezone
@@ -19,7 +20,12 @@ from django.utils import timezone
 from cms import celery_app
 
 from . import helpers, models
+from .counters import mark_media_counts_dirty
 from .helpers import mask_ip
+from .related import get_related_media, queue_related_media
+from .response_cache import invalidate_response_cache
+from .search_index import queue_search_index
+from .visibility import queue_media_visibility
 
 logger = logging.getLogger(__name__)
 
@@ -221,10 +227,11 @@ def show_recommended_media(request, limit=100):
     """
 
     basic_query = Q(listable=True)
-    pmi = cache.get("popular_media_ids")
+    popular = cache.get("popular_media")
     # produced by task get_list_of_popular_media and cached
-    if pmi:
-        media = list(models.Media.objects.filter(friendly_token__in=pmi).filter(basic_query).prefetch_related("user")[:limit])
+    if popular:
+        media_ids = [media_id for media_id, score in popular]
+        media = list(models.Media.objects.filter(id__in=media_ids).filter(basic_query).prefetch_related("user")[:limit])
     else:
         media = list(models.Media.objects.filter(basic_query).order_by("-views", "-likes").prefetch_related("user")[:limit])
     random.shuffle(media)
@@ -239,6 +246,11 @@ def show_related_media(media, request=None, limit=100):
     elif settings.RELATED_MEDIA_STRATEGY == "author":
         return show_related_media_author(media, request, limit)
 
+    # precomputed, see files.related
+    related = get_related_media(media, "content", limit)
+    if related is not None:
+        return related
+    queue_related_media([media.id])
     return show_related_media_content(media, request, limit)
 
 
@@ -317,11 +329,21 @@ def show_related_media_author(media, request, limit):
 
 
 def show_related_media_calculated(media, request, limit):
-    """Return a list of related media based on ML recommendations
-    A big todo!
+    """Return a list of related media watched and liked by the same users
+
+    Lists are computed offline, see files.recommendations. Media without
+    enough of them are filled up with content related media
     """
 
-    return []
+    related = get_related_media(media, "calculated", limit) or []
+    if len(related) < limit:
+        content = get_related_media(media, "content", limit)
+        if content is None:
+            queue_related_media([media.id])
+            content = show_related_media_content(media, request, limit)
+        seen = {m.id for m in related}
+        related.extend(m for m in content if m.id not in seen)
+    return related[:limit]
 
 
 def update_user_ratings(user, media, user_ratings):
@@ -464,12 +486,79 @@ def kill_ffmpeg_process(filepath):
     return result
 
 
-def copy_video(original_media, copy_encodings=True, title_suffix="(Trimmed)"):
+def get_field_file_path(instance, field_name, file_path):
+    """Get the name and path a file will have when stored on a FileField
+
+    Args:
+        instance: Model instance that owns the field
+        field_name: Name of the FileField
+        file_path: Path of the file that will be stored
+
+    Returns:
+        tuple: (name relative to the storage, absolute path)
+    """
+
+    field_file = getattr(instance, field_name)
+    name = field_file.field.generate_filename(instance, helpers.get_file_name(file_path))
+    name = field_file.storage.get_available_name(name, max_length=field_file.field.max_length)
+    target_path = field_file.storage.path(name)
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    return name, target_path
+
+
+def move_file_for_field(instance, field_name, file_path, file_name=None):
+    """Move a file that already exists on disk to the location of a FileField
+
+    The file gets the name the field's upload_to would give it, but it is
+    moved rather than read and written again through Django File
+
+    Args:
+        file_name: Optional name to store the file as, instead of the name of file_path
+
+    Returns:
+        Name of the file, relative to the storage
+    """
+
+    name, target_path = get_field_file_path(instance, field_name, file_name or file_path)
+    shutil.move(file_path, target_path)
+    return name
+
+
+def copy_file_for_field(instance, field_name, file_path):
+    """Copy a file to the location of a FileField
+
+    Same as move_file_for_field, but the file is copied with helpers.copy_file,
+    which uses reflinks or hard links where possible instead of duplicating bytes
+
+    Returns:
+        Name of the file, relative to the storage
+    """
+
+    name, target_path = get_field_file_path(instance, field_name, file_path)
+    helpers.copy_file(file_path, target_path)
+    return name
+
+
+def get_copied_file_name(media, file_path, suffix):
+    """Name of a file of media without the uid of media, with a suffix before the extension"""
+
+    name = helpers.get_file_name(file_path).removeprefix(f"{media.uid.hex}.")
+    stem, ext = os.path.splitext(name)
+    return f"{stem}{suffix}{ext}"
+
+
+def copy_video(original_media, copy_encodings=True, title_suffix="(Trimmed)", media_file_path=None, encoding_files=None, file_suffix="_trimmed"):
     """Create a copy of a media object
 
     Args:
         original_media: Original Media object to copy
         copy_encodings: Whether to copy the encodings too
+        media_file_path: Optional path of an already produced file (eg a trimmed segment)
+            that is moved in place of the copy of the original media file
+        encoding_files: Optional dict of encoding id to path of an already produced file,
+            used the same way for encodings. Only encodings in the dict are copied
+        file_suffix: Suffix added to the names of the original files, for
+            the produced files of media_file_path and encoding_files
 
     Returns:
         New Media object
@@ -480,84 +569,100 @@ def copy_video(original_media, copy_encodings=True, title_suffix="(Trimmed)"):
         if not models.Media.objects.filter(friendly_token=friendly_token).exists():
             break
 
-    with open(original_media.media_file.path, "rb") as f:
-        myfile = File(f)
-        new_media = models.Media(
-            media_file=myfile,
-            friendly_token=friendly_token,
-            title=f"{original_media.title} {title_suffix}",
-            description=original_media.description,
-            user=original_media.user,
-            media_type=original_media.media_type,
-            enable_comments=original_media.enable_comments,
-            allow_download=original_media.allow_download,
-            state=helpers.get_default_state(user=original_media.user),
-            is_reviewed=original_media.is_reviewed,
-            encoding_status=original_media.encoding_status,
-            add_date=timezone.now(),
-            video_height=original_media.video_height,
-            size=original_media.size,
-            duration=original_media.duration,
-            media_info=original_media.media_info,
-        )
-        models.Media.objects.bulk_create([new_media])
-        # avoids calling signals since signals will call media_init and we don't want that
+    fields = dict(
+        friendly_token=friendly_token,
+        title=f"{original_media.title} {title_suffix}",
+        description=original_media.description,
+        user=original_media.user,
+        media_type=original_media.media_type,
+        enable_comments=original_media.enable_comments,
+        allow_download=original_media.allow_download,
+        state=helpers.get_default_state(user=original_media.user),
+        is_reviewed=original_media.is_reviewed,
+        encoding_status=original_media.encoding_status,
+        init_status=original_media.init_status,
+        add_date=timezone.now(),
+        video_height=original_media.video_height,
+        size=original_media.size,
+        duration=original_media.duration,
+        media_info=original_media.media_info,
+    )
+
+    # media_file has to be passed on creation, otherwise Media.save will consider
+    # it a newly uploaded file. The uid and user are enough to get its location
+    uid = uuid.uuid4()
+    placeholder = models.Media(uid=uid, user=original_media.user)
+    if media_file_path:
+        fields["size"] = helpers.show_file_size(os.path.getsize(media_file_path))
+        media_file = move_file_for_field(placeholder, "media_file", media_file_path, get_copied_file_name(original_media, original_media.media_file.name, file_suffix))
+    else:
+        media_file = copy_file_for_field(placeholder, "media_file", original_media.media_file.path)
+    new_media = models.Media(uid=uid, media_file=media_file, **fields)
+    # same as Media.save, that is not called
+    new_media.listable = new_media.state == "public" and new_media.encoding_status == "success" and new_media.is_reviewed is True
+    models.Media.objects.bulk_create([new_media])
+    # avoids calling signals since signals will call media_init and we don't want that
 
     if copy_encodings:
+        new_encodings = []
         for encoding in original_media.encodings.filter(chunk=False, status="success"):
-            if encoding.media_file:
-                with open(encoding.media_file.path, "rb") as f:
-                    myfile = File(f)
-                    new_encoding = models.Encoding(
-                        media_file=myfile, media=new_media, profile=encoding.profile, size=encoding.size, status="success", progress=100, chunk=False, logs=f"Copied from encoding {encoding.id}"
-                    )
-                    models.Encoding.objects.bulk_create([new_encoding])
-                    # avoids calling signals as this is still not ready
+            if encoding_files is not None:
+                if not encoding_files.get(encoding.id):
+                    continue
+            elif not encoding.media_file:
+                continue
+
+            new_encoding = models.Encoding(media=new_media, profile=encoding.profile, size=encoding.size, status="success", progress=100, chunk=False, logs=f"Copied from encoding {encoding.id}")
+            if encoding_files is not None:
+                # a segment of the encoding, not the full file
+                new_encoding.size = helpers.show_file_size(os.path.getsize(encoding_files[encoding.id]))
+                file_name = get_copied_file_name(original_media, encoding.media_file.name, file_suffix)
+                new_encoding.media_file = move_file_for_field(new_encoding, "media_file", encoding_files[encoding.id], file_name)
+            else:
+                new_encoding.media_file = copy_file_for_field(new_encoding, "media_file", encoding.media_file.path)
+            new_encodings.append(new_encoding)
+        models.Encoding.objects.bulk_create(new_encodings)
+        # avoids calling signals as this is still not ready
 
     # Copy categories and tags
-    for category in original_media.category.all():
-        new_media.category.add(category)
-
-    for tag in original_media.tags.all():
-        new_media.tags.add(tag)
-
-    if original_media.thumbnail:
-        with open(original_media.thumbnail.path, 'rb') as f:
-            thumbnail_name = helpers.get_file_name(original_media.thumbnail.path)
-            new_media.thumbnail.save(thumbnail_name, File(f))
-
-    if original_media.poster:
-        with open(original_media.poster.path, 'rb') as f:
-            poster_name = helpers.get_file_name(original_media.poster.path)
-            new_media.poster.save(poster_name, File(f))
-
-    if original_media.uploaded_thumbnail:
-        with open(original_media.uploaded_thumbnail.path, 'rb') as f:
-            thumbnail_name = helpers.get_file_name(original_media.uploaded_thumbnail.path)
-            new_media.uploaded_thumbnail.save(thumbnail_name, File(f))
-
-    if original_media.uploaded_poster:
-        with open(original_media.uploaded_poster.path, 'rb') as f:
-            poster_name = helpers.get_file_name(original_media.uploaded_poster.path)
-            new_media.uploaded_poster.save(poster_name, File(f))
-
-    if original_media.sprites:
-        with open(original_media.sprites.path, 'rb') as f:
-            sprites_name = helpers.get_file_name(original_media.sprites.path)
-            new_media.sprites.save(sprites_name, File(f))
+    categories = list(original_media.category.all())
+    tags = list(original_media.tags.all())
+    new_media.category.add(*categories)
+    new_media.tags.add(*tags)
+
+    # image files are copied in place and saved with a single update,
+    # instead of a Media.save() per file
+    update_fields = []
+    for field_name in ["thumbnail", "poster", "uploaded_thumbnail", "uploaded_poster", "sprites"]:
+        field_file = getattr(original_media, field_name)
+        if field_file and os.path.exists(field_file.path):
+            setattr(new_media, field_name, copy_file_for_field(new_media, field_name, field_file.path))
+            update_fields.append(field_name)
 
     if original_media.hls_file and os.path.exists(original_media.hls_file):
         p = os.path.dirname(original_media.hls_file)
         if os.path.exists(p):
-            new_hls_file = original_media.hls_file.replace(original_media.uid.hex, new_media.uid.hex)
-            models.Media.objects.filter(id=new_media.id).update(hls_file=new_hls_file)
+            new_media.hls_file = original_media.hls_file.replace(original_media.uid.hex, new_media.uid.hex)
+            update_fields.append("hls_file")
             new_p = p.replace(original_media.uid.hex, new_media.uid.hex)
 
             if not os.path.exists(new_p):
                 os.makedirs(new_p, exist_ok=True)
-            cmd = f"cp -r {p}/* {new_p}/"
+            cmd = f"cp -r --reflink=auto {p}/* {new_p}/"
             subprocess.run(cmd, stdout=subprocess.PIPE, shell=True)
 
+    if update_fields:
+        models.Media.objects.filter(id=new_media.id).update(**{field_name: getattr(new_media, field_name) for field_name in update_fields})
+
+    # neither Media.save nor its post_save signal ran for the copy, queue
+    # what they would have
+    queue_search_index([new_media.id])
+    queue_media_visibility(media=[new_media.id])
+    mark_media_counts_dirty(users=[new_media.user_id], categories=[c.id for c in categories], tags=[t.id for t in tags])
+    invalidate_response_cache("media_list")
+    if new_media.listable:
+        queue_related_media([new_media.id])
+
     return new_media
 
 
@@ -699,22 +804,23 @@ def copy_media(media):
             if not models.Media.objects.filter(friendly_token=friendly_token).exists():
                 break
 
-        with open(media.media_file.path, "rb") as f:
-            myfile = File(f)
-            new_media = models.Media.objects.create(
-                media_file=myfile,
-                friendly_token=friendly_token,
-                title=f"{media.title} (Copy)",
-                description=media.description,
-                user=media.user,
-                media_type=media.media_type,
-                enable_comments=media.enable_comments,
-                allow_download=media.allow_download,
-                state=helpers.get_default_state(user=media.user),
-                is_reviewed=media.is_reviewed,
-                encoding_status=media.encoding_status,
-                add_date=timezone.now(),
-            )
+        uid = uuid.uuid4()
+        media_file = copy_file_for_field(models.Media(uid=uid, user=media.user), "media_file", media.media_file.path)
+        new_media = models.Media.objects.create(
+            uid=uid,
+            media_file=media_file,
+            friendly_token=friendly_token,
+            title=f"{media.title} (Copy)",
+            description=media.description,
+            user=media.user,
+            media_type=media.media_type,
+            enable_comments=media.enable_comments,
+            allow_download=media.allow_download,
+            state=helpers.get_default_state(user=media.user),
+            is_reviewed=media.is_reviewed,
+            encoding_status=media.encoding_status,
+            add_date=timezone.now(),
+        )
 
         # Copy categories and tags
         for category in media.category.all():
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.6 on 2026-10-19 13:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('files', '0014_alter_subtitle_options_and_more'),
+    ]
+
+    operations = [
+        # existing media have been processed already
+        migrations.AddField(
+            model_name='media',
+            name='init_status',
+            field=models.CharField(
+                choices=[('pending', 'Pending'), ('probing', 'Probing'), ('thumbnails', 'Thumbnails'), ('fail', 'Fail'), ('success', 'Success')],
+                default='success',
+                help_text='Step of the processing that follows an upload, before encoding',
+                max_length=20,
+            ),
+        ),
+        migrations.AlterField(
+            model_name='media',
+            name='init_status',
+            field=models.CharField(
+                choices=[('pending', 'Pending'), ('probing', 'Probing'), ('thumbnails', 'Thumbnails'), ('fail', 'Fail'), ('success', 'Success')],
+                default='pending',
+                help_text='Step of the processing that follows an upload, before encoding',
+                max_length=20,
+            ),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.6 on 2026-10-19 13:41
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # indexes are built without locking writes to files_media
+    atomic = False
+
+    dependencies = [
+        ('files', '0016_title_trigram_indexes'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='media',
+            index=models.Index(condition=models.Q(('listable', True)), fields=['add_date', 'id'], name='files_media_listed_add_date'),
+        ),
+        AddIndexConcurrently(
+            model_name='media',
+            index=models.Index(condition=models.Q(('listable', True)), fields=['edit_date', 'id'], name='files_media_listed_edit_date'),
+        ),
+        AddIndexConcurrently(
+            model_name='media',
+            index=models.Index(condition=models.Q(('listable', True)), fields=['views', 'id'], name='files_media_listed_views'),
+        ),
+        AddIndexConcurrently(
+            model_name='media',
+            index=models.Index(condition=models.Q(('listable', True)), fields=['likes', 'id'], name='files_media_listed_likes'),
+        ),
+        AddIndexConcurrently(
+            model_name='media',
+            index=models.Index(condition=models.Q(('listable', True)), fields=['title', 'id'], name='files_media_listed_title'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.6 on 2026-10-19 13:43
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # indexes are built without locking writes to files_media
+    atomic = False
+
+    dependencies = [
+        ('files', '0017_media_listing_keyset_indexes'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='media',
+            index=models.Index(condition=models.Q(('featured', True), ('listable', True)), fields=['add_date', 'id'], name='files_media_featured_add_date'),
+        ),
+        AddIndexConcurrently(
+            model_name='media',
+            index=models.Index(condition=models.Q(('listable', True)), fields=['media_type', 'add_date', 'id'], name='files_media_listed_type_date'),
+        ),
+        AddIndexConcurrently(
+            model_name='media',
+            index=models.Index(condition=models.Q(('listable', True)), fields=['user', 'add_date', 'id'], name='files_media_listed_user_date'),
+        ),
+    ]
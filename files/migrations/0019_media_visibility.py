@@ -0,0 +1,42 @@
+# Generated by Django 5.2.6 on 2026-10-19 13:47
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def populate_media_visibility(apps, schema_editor):
+    # same as files.visibility.get_visible_pairs, for all users
+    Media = apps.get_model('files', 'Media')
+    MediaPermission = apps.get_model('files', 'MediaPermission')
+    MediaVisibility = apps.get_model('files', 'MediaVisibility')
+
+    pairs = set(MediaPermission.objects.values_list('user_id', 'media_id'))
+    if getattr(settings, 'USE_RBAC', False):
+        rbac = Media.category.through.objects.filter(category__rbac_groups__memberships__role__in=['member', 'contributor', 'manager'])
+        pairs.update(rbac.values_list('category__rbac_groups__memberships__user_id', 'media_id'))
+    MediaVisibility.objects.bulk_create([MediaVisibility(user_id=user_id, media_id=media_id) for user_id, media_id in pairs], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0018_listing_partial_indexes'),
+        ('rbac', '0003_alter_rbacgroup_members'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaVisibility',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('media', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='visibility', to='files.media')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='visible_media', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'media')},
+            },
+        ),
+        migrations.RunPython(populate_media_visibility, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.6 on 2026-10-19 14:06
+
+import django.contrib.postgres.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0019_media_visibility'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelatedMedia',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('strategy', models.CharField(choices=[('content', 'Content'), ('calculated', 'Calculated')], max_length=20)),
+                ('media_ids', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                ('update_date', models.DateTimeField(auto_now=True)),
+                ('media', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='related_lists', to='files.media')),
+            ],
+            options={
+                'unique_together': {('media', 'strategy')},
+            },
+        ),
+    ]
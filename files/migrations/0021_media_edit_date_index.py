@@ -0,0 +1,20 @@
+# Generated by Django 5.2.6 on 2026-10-19 16:02
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # indexes are built without locking writes to files_media
+    atomic = False
+
+    dependencies = [
+        ('files', '0020_related_media'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='media',
+            index=models.Index(fields=['edit_date', 'id'], name='files_media_edit_date'),
+        ),
+    ]
@@ -3,7 +3,13 @@ from .category import Category, Tag  # noqa: F401
 from .comment import Comment  # noqa: F401
 from .encoding import EncodeProfile, Encoding  # noqa: F401
 from .license import License  # noqa: F401
-from .media import Media, MediaPermission  # noqa: F401
+from .media import (  # noqa: F401
+    Media,
+    MediaPermission,
+    MediaVisibility,
+    RelatedMedia,
+    with_preview_encoding,
+)
 from .page import Page, TinyMCEMedia  # noqa: F401
 from .playlist import Playlist, PlaylistMedia  # noqa: F401
 from .rating import Rating, RatingCategory  # noqa: F401
@@ -14,6 +20,7 @@ from .utils import ENCODE_EXTENSIONS_KEYS  # noqa: F401
 from .utils import ENCODE_RESOLUTIONS  # noqa: F401
 from .utils import ENCODE_RESOLUTIONS_KEYS  # noqa: F401
 from .utils import MEDIA_ENCODING_STATUS  # noqa: F401
+from .utils import MEDIA_INIT_STATUS  # noqa: F401
 from .utils import MEDIA_STATES  # noqa: F401
 from .utils import MEDIA_TYPES_SUPPORTED  # noqa: F401
 from .utils import category_thumb_path  # noqa: F401
@@ -1,4 +1,8 @@
+from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
 from django.urls import reverse
 from django.utils.html import strip_tags
 from imagekit.models import ProcessedImageField
@@ -127,6 +131,10 @@ class Tag(models.Model):
 
     class Meta:
         ordering = ["title"]
+        indexes = [
+            # for search suggestions, see MediaSearchSuggest
+            GinIndex(fields=["title"], name="files_tag_title_trgm", opclasses=["gin_trgm_ops"]),
+        ]
 
     def get_absolute_url(self):
         return f"{reverse('search')}?t={self.title}"
@@ -152,5 +160,51 @@ class Tag(models.Model):
         return None
 
 
+@receiver(pre_delete, sender=Category)
+def category_pre_delete(sender, instance, **kwargs):
+    # media are removed from the category without m2m_changed signals,
+    # keep them to recompute their visibility once it is deleted
+    instance._visibility_media_ids = []
+    if getattr(settings, "USE_RBAC", False) and instance.rbac_groups.exists():
+        instance._visibility_media_ids = list(instance.media_set.values_list("id", flat=True))
+
+
+@receiver(post_delete, sender=Category)
+def category_post_delete(sender, instance, **kwargs):
+    from ..visibility import queue_media_visibility
+
+    queue_media_visibility(media=getattr(instance, "_visibility_media_ids", []))
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_change(sender, instance, **kwargs):
+    from ..response_cache import invalidate_response_cache
+
+    invalidate_response_cache("categories")
+
+
+@receiver(pre_delete, sender=Tag)
+def tag_pre_delete(sender, instance, **kwargs):
+    # media are removed from the tag without m2m_changed signals,
+    # keep them to rebuild their search vectors once it is deleted
+    instance._search_media_ids = list(instance.media_set.values_list("id", flat=True))
+
+
+@receiver(post_delete, sender=Tag)
+def tag_post_delete(sender, instance, **kwargs):
+    from ..search_index import queue_search_index
+
+    queue_search_index(getattr(instance, "_search_media_ids", []))
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def tag_change(sender, instance, **kwargs):
+    from ..response_cache import invalidate_response_cache
+
+    invalidate_response_cache("tags")
+
+
 # Import Media to avoid circular imports
 from .media import Media  # noqa
@@ -7,11 +7,14 @@ import uuid
 
 import m3u8
 from django.conf import settings
+from django.contrib.postgres.fields import ArrayField
 from django.contrib.postgres.indexes import GinIndex
-from django.contrib.postgres.search import SearchVectorField
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.core.cache import cache
 from django.core.files import File
-from django.db import models
-from django.db.models import Func, Value
+from django.core.files.storage import default_storage
+from django.db import models, transaction
+from django.db.models import OuterRef, Q, Subquery, Value
 from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from django.urls import reverse
@@ -27,6 +30,7 @@ from .subtitle import TranscriptionRequest
 from .utils import (
     ENCODE_RESOLUTIONS_KEYS,
     MEDIA_ENCODING_STATUS,
+    MEDIA_INIT_STATUS,
     MEDIA_STATES,
     MEDIA_TYPES_SUPPORTED,
     original_media_file_path,
@@ -34,6 +38,30 @@ from .utils import (
 )
 from .video_data import VideoTrimRequest
 
+# fields shown on listings and media cards, see files.cards and MediaSerializer
+LISTING_FIELDS = [
+    "title",
+    "description",
+    "user_id",
+    "add_date",
+    "media_type",
+    "state",
+    "listable",
+    "is_reviewed",
+    "encoding_status",
+    "duration",
+    "size",
+    "featured",
+    "user_featured",
+    "views",
+    "likes",
+    "dislikes",
+    "reported_times",
+    "thumbnail",
+    "uploaded_thumbnail",
+    "preview_file_path",
+]
+
 logger = logging.getLogger(__name__)
 
 
@@ -65,6 +93,13 @@ class Media(models.Model):
 
     encoding_status = models.CharField(max_length=20, choices=MEDIA_ENCODING_STATUS, default="pending", db_index=True)
 
+    init_status = models.CharField(
+        max_length=20,
+        choices=MEDIA_INIT_STATUS,
+        default="pending",
+        help_text="Step of the processing that follows an upload, before encoding",
+    )
+
     featured = models.BooleanField(
         default=False,
         db_index=True,
@@ -213,13 +248,30 @@ class Media(models.Model):
     __original_media_file = None
     __original_thumbnail_time = None
     __original_uploaded_poster = None
+    __original_title = None
+    __original_description = None
 
     class Meta:
         ordering = ["-add_date"]
         indexes = [
-            # TODO: check with pgdash.io or other tool what index need be
-            # removed
-            GinIndex(fields=["search"])
+            GinIndex(fields=["search"]),
+            # for search suggestions, see MediaSearchSuggest
+            GinIndex(fields=["title"], name="files_media_title_trgm", opclasses=["gin_trgm_ops"]),
+            # listings only show listable media, and are paginated on
+            # (sort field, id), see KeysetPagination. Check what queries they
+            # run with the audit_listing_queries command
+            models.Index(fields=["add_date", "id"], condition=Q(listable=True), name="files_media_listed_add_date"),
+            models.Index(fields=["edit_date", "id"], condition=Q(listable=True), name="files_media_listed_edit_date"),
+            models.Index(fields=["views", "id"], condition=Q(listable=True), name="files_media_listed_views"),
+            models.Index(fields=["likes", "id"], condition=Q(listable=True), name="files_media_listed_likes"),
+            models.Index(fields=["title", "id"], condition=Q(listable=True), name="files_media_listed_title"),
+            models.Index(fields=["add_date", "id"], condition=Q(listable=True, featured=True), name="files_media_featured_add_date"),
+            models.Index(fields=["media_type", "add_date", "id"], condition=Q(listable=True), name="files_media_listed_type_date"),
+            models.Index(fields=["user", "add_date", "id"], condition=Q(listable=True), name="files_media_listed_user_date"),
+            # users that see shared media filter on listable OR shared, that
+            # the partial indexes do not cover. add_date, views, likes and
+            # title have an index of their own for these
+            models.Index(fields=["edit_date", "id"], name="files_media_edit_date"),
         ]
 
     def __str__(self):
@@ -237,6 +289,20 @@ class Media(models.Model):
         self.__original_uploaded_poster = self.uploaded_poster
         self.__original_allow_whisper_transcribe = self.allow_whisper_transcribe
         self.__original_allow_whisper_transcribe_and_translate = self.allow_whisper_transcribe_and_translate
+        # and when the searched text changes
+        self.__original_title = self.title
+        self.__original_description = self.description
+        # and when anything shown on listings changes
+        self.__original_listing_values = self.get_listing_values()
+        # and when related media have to be rebuilt
+        self.__original_listable = self.__dict__.get("listable")
+
+    def get_listing_values(self):
+        """Values of the fields shown on listings and media cards, that
+        are loaded. Deferred fields are not loaded to compare them"""
+
+        values = [self.__dict__.get(field) for field in LISTING_FIELDS]
+        return [getattr(value, "name", value) for value in values]
 
     def save(self, *args, **kwargs):
         if not self.title:
@@ -270,6 +336,7 @@ class Media(models.Model):
             if self.media_file != self.__original_media_file:
                 # set this otherwise gets to infinite loop
                 self.__original_media_file = self.media_file
+                self.init_status = "pending"
                 from .. import tasks
 
                 tasks.media_init.apply_async(args=[self.friendly_token], countdown=5)
@@ -292,7 +359,7 @@ class Media(models.Model):
             self.__original_allow_whisper_transcribe_and_translate = self.allow_whisper_transcribe_and_translate
         else:
             # media is going to be created now
-            # after media is saved, post_save signal will call media_init function
+            # after media is saved, post_save signal will start the media_init task
             # to take care of post save steps
 
             self.state = helpers.get_default_state(user=self.user)
@@ -303,7 +370,22 @@ class Media(models.Model):
         else:
             self.listable = False
 
+        search_changed = not self.pk or self.title != self.__original_title or self.description != self.__original_description
+        # read by media_save, to invalidate cached listings and queue related media.
+        # Related media also depend on categories and tags, see media_m2m
+        self._listing_changed = not self.pk or self.get_listing_values() != self.__original_listing_values
+        self._related_changed = not self.pk or self.title != self.__original_title or self.listable != self.__original_listable
+
         super(Media, self).save(*args, **kwargs)
+        self.__original_listing_values = self.get_listing_values()
+        self.__original_listable = self.listable
+
+        if search_changed:
+            self.__original_title = self.title
+            self.__original_description = self.description
+            from ..search_index import queue_search_index
+
+            queue_search_index([self.id])
 
         # produce a thumbnail out of an uploaded poster
         # will run only when a poster is uploaded for the first time
@@ -343,10 +425,9 @@ class Media(models.Model):
                     countdown=10,
                 )
 
-    def update_search_vector(self):
-        """
-        Update SearchVector field of SearchModel using raw SQL
-        search field is used to store SearchVector
+    def get_search_texts(self):
+        """Get the texts the search vector is built from, by weight
+        A: title, B: tags, C: description and author, D: subtitles
         """
 
         # first get anything interesting out of the media
@@ -357,26 +438,34 @@ class Media(models.Model):
             a_tags = " ".join([tag.title for tag in self.tags.all()])
             b_tags = " ".join([tag.title.replace("-", " ") for tag in self.tags.all()])
 
-        items = [
-            self.title,
-            self.user.username,
-            self.user.email,
-            self.user.name,
-            self.description,
-            a_tags,
-            b_tags,
-        ]
-
-        for subtitle in self.subtitles.all():
-            items.append(subtitle.subtitle_text)
+        weighted_items = {
+            "A": [self.title],
+            "B": [a_tags, b_tags],
+            "C": [self.description, self.user.username, self.user.email, self.user.name],
+            "D": [subtitle.subtitle_text for subtitle in self.subtitles.all()],
+        }
+
+        texts = {}
+        for weight, items in weighted_items.items():
+            items = [item for item in items if item]
+            text = " ".join(items)
+            text = " ".join([token for token in text.lower().split(" ") if token not in STOP_WORDS])
+            texts[weight] = helpers.clean_query(text)
+        return texts
 
-        items = [item for item in items if item]
-        text = " ".join(items)
-        text = " ".join([token for token in text.lower().split(" ") if token not in STOP_WORDS])
-
-        text = helpers.clean_query(text)
+    def update_search_vector(self):
+        """
+        Update SearchVector field of SearchModel
+        search field is used to store SearchVector, weighted so that
+        search results can be ranked by relevance
+        For many media, see files.search_index
+        """
 
-        Media.objects.filter(id=self.id).update(search=Func(Value('simple'), Value(text), function='to_tsvector'))
+        texts = self.get_search_texts()
+        vector = SearchVector(Value(texts["A"]), config="simple", weight="A")
+        for weight in ["B", "C", "D"]:
+            vector += SearchVector(Value(texts[weight]), config="simple", weight=weight)
+        Media.objects.filter(id=self.id).update(search=vector)
 
         return True
 
@@ -384,19 +473,49 @@ class Media(models.Model):
         """Normally this is called when a media is uploaded
         Performs all related tasks, as check for media type,
         video duration, encode
+        tasks.media_init runs the same steps as a chain of tasks
         """
+        if not self.init_media_type():
+            return False
+        self.init_thumbnail()
+        self.init_encode()
+        return True
+
+    def set_init_status(self, init_status):
+        """Set the step of media_init the media is at
+        Updated without a save, to avoid the post_save actions
+        """
+        self.init_status = init_status
+        Media.objects.filter(pk=self.pk).update(init_status=init_status)
+
+    def init_media_type(self):
+        """First step of media_init: find the media type and
+        remove the file if this type is not allowed
+        """
+        self.set_init_status("probing")
         self.set_media_type()
         from ..methods import is_media_allowed_type
 
         if not is_media_allowed_type(self):
             helpers.rm_file(self.media_file.path)
+            self.discard_upload_ingest()
             if self.state == "public":
                 self.state = "unlisted"
                 self.save(update_fields=["state"])
+            self.set_init_status("fail")
             return False
+        return True
 
-        if self.media_type == "video":
+    def init_thumbnail(self):
+        """Second step of media_init: thumbnail and poster"""
+        self.set_init_status("thumbnails")
+        if self.media_type in ["video", "image"]:
             self.set_thumbnail(force=True)
+        return True
+
+    def init_encode(self):
+        """Last step of media_init: start the sprite and encoding tasks"""
+        if self.media_type == "video":
             if settings.DO_NOT_TRANSCODE_VIDEO:
                 self.encoding_status = "success"
                 self.save()
@@ -404,8 +523,9 @@ class Media(models.Model):
             else:
                 self.produce_sprite_from_video()
                 self.encode()
-        elif self.media_type == "image":
-            self.set_thumbnail(force=True)
+        if self.media_type != "video" or settings.DO_NOT_TRANSCODE_VIDEO:
+            self.discard_upload_ingest()
+        self.set_init_status("success")
         return True
 
     def set_media_type(self, save=True):
@@ -427,7 +547,9 @@ class Media(models.Model):
         if self.media_type in ["image", "pdf"]:
             self.encoding_status = "success"
         else:
-            ret = helpers.media_file_info(self.media_file.path)
+            # the md5 may have been calculated already, see uploader.tasks.ingest_upload
+            ingest = self.get_upload_ingest()
+            ret = helpers.media_file_info(self.media_file.path, md5sum=ingest["md5sum"] if ingest else None)
 
             if ret.get("fail"):
                 self.media_type = ""
@@ -478,6 +600,29 @@ class Media(models.Model):
             )
         return True
 
+    def get_upload_ingest(self):
+        """Get what was found about the media file when its upload was read
+        See uploader.tasks.ingest_upload
+
+        Returns:
+            dict with md5sum, file_size and chunks, None if not available
+        """
+        ingest = cache.get(helpers.get_upload_ingest_key(self.uid))
+        if not ingest or ingest["status"] != "success":
+            return None
+        if not os.path.isfile(self.media_file.path) or os.path.getsize(self.media_file.path) != ingest["file_size"]:
+            return None
+        return ingest
+
+    def discard_upload_ingest(self):
+        """Remove the chunks ingest_upload cut the media file in, when they
+        are not going to be encoded"""
+        key = helpers.get_upload_ingest_key(self.uid)
+        ingest = cache.get(key)
+        if ingest:
+            helpers.rm_files(ingest.get("chunks", []))
+            cache.delete(key)
+
     def set_thumbnail(self, force=False):
         """sets thumbnail for media
         For video call function to produce thumbnail and poster
@@ -577,6 +722,7 @@ class Media(models.Model):
             profiles = [p.id for p in profiles]
             tasks.chunkize_media.delay(self.friendly_token, profiles, force=force)
         else:
+            self.discard_upload_ingest()
             for profile in profiles:
                 if profile.extension != "gif":
                     if self.video_height and self.video_height < profile.resolution:
@@ -867,6 +1013,11 @@ class Media(models.Model):
 
         # get preview_file out of the encodings, since some times preview_file_path
         # is empty but there is the gif encoding!
+        if hasattr(self, "preview_encoding_file"):
+            # listings annotate it, see with_preview_encoding
+            if self.preview_encoding_file:
+                return helpers.url_from_path(default_storage.path(self.preview_encoding_file))
+            return None
         preview_media = self.encodings.filter(profile__extension="gif").first()
         if preview_media and preview_media.media_file:
             return helpers.url_from_path(preview_media.media_file.path)
@@ -975,6 +1126,16 @@ class Media(models.Model):
         return data
 
 
+def with_preview_encoding(queryset):
+    """Annotate media with the file of their gif encoding
+
+    Media.preview_url uses it, instead of a query per media
+    """
+
+    gif = Encoding.objects.filter(media=OuterRef("pk"), profile__extension="gif").order_by("id").values("media_file")[:1]
+    return queryset.annotate(preview_encoding_file=Subquery(gif))
+
+
 class MediaPermission(models.Model):
     """Model to store user permissions for media"""
 
@@ -997,6 +1158,35 @@ class MediaPermission(models.Model):
         return f"{self.user.username} - {self.media.title} ({self.permission})"
 
 
+class MediaVisibility(models.Model):
+    """Media a user can see besides listable ones, through a MediaPermission
+    or an RBAC group. Maintained by files.visibility"""
+
+    user = models.ForeignKey('users.User', on_delete=models.CASCADE, related_name='visible_media')
+    media = models.ForeignKey('Media', on_delete=models.CASCADE, related_name='visibility')
+
+    class Meta:
+        unique_together = ('user', 'media')
+
+
+class RelatedMedia(models.Model):
+    """Ids of the media related to a media, most related first, for a
+    RELATED_MEDIA_STRATEGY. Maintained by files.related"""
+
+    STRATEGY_CHOICES = (
+        ("content", "Content"),
+        ("calculated", "Calculated"),
+    )
+
+    media = models.ForeignKey('Media', on_delete=models.CASCADE, related_name='related_lists')
+    strategy = models.CharField(max_length=20, choices=STRATEGY_CHOICES)
+    media_ids = ArrayField(models.IntegerField(), default=list)
+    update_date = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('media', 'strategy')
+
+
 @receiver(post_save, sender=Media)
 def media_save(sender, instance, created, **kwargs):
     # media_file path is not set correctly until mode is saved
@@ -1008,35 +1198,59 @@ def media_save(sender, instance, created, **kwargs):
         return False
 
     if created:
+        from .. import tasks
         from ..methods import notify_users
 
-        instance.media_init()
+        # probing and thumbnails run on the task queue, not on the request,
+        # once the media is committed so that the task can find it
+        friendly_token = instance.friendly_token
+        transaction.on_commit(lambda: tasks.media_init.delay(friendly_token))
         notify_users(friendly_token=instance.friendly_token, action="media_added")
 
-    instance.user.update_user_media()
-    if instance.category.all():
-        # this won't catch when a category
-        # is removed from a media, which is what we want...
-        for category in instance.category.all():
-            category.update_category_media()
+    from ..cards import invalidate_media_cards
+    from ..response_cache import invalidate_response_cache
+
+    # saves of the encoding steps, progress and thumbnails do not change
+    # listings, which would otherwise be invalidated all the time
+    if getattr(instance, "_listing_changed", True):
+        invalidate_media_cards([instance.uid])
+        invalidate_response_cache(f"media:{instance.friendly_token}", "media_list")
+    else:
+        invalidate_response_cache(f"media:{instance.friendly_token}")
 
-    if instance.tags.all():
-        for tag in instance.tags.all():
-            tag.update_tag_media()
+    if not instance.listable:
+        from ..trending import remove_trending_media
 
-    instance.update_search_vector()
+        remove_trending_media([instance.id])
+    elif getattr(instance, "_related_changed", True):
+        from ..related import queue_related_media
+
+        queue_related_media([instance.id])
+
+    # counts are recomputed in batches, see files.counters
+    from ..counters import mark_media_counts_dirty
+
+    mark_media_counts_dirty(
+        users=[instance.user_id],
+        categories=instance.category.values_list("id", flat=True),
+        tags=instance.tags.values_list("id", flat=True),
+    )
 
 
 @receiver(pre_delete, sender=Media)
 def media_file_pre_delete(sender, instance, **kwargs):
-    if instance.category.all():
-        for category in instance.category.all():
-            instance.category.remove(category)
-            category.update_category_media()
-    if instance.tags.all():
-        for tag in instance.tags.all():
-            instance.tags.remove(tag)
-            tag.update_tag_media()
+    from ..cards import invalidate_media_cards
+    from ..response_cache import invalidate_response_cache
+    from ..trending import remove_trending_media
+
+    invalidate_media_cards([instance.uid])
+    invalidate_response_cache(f"media:{instance.friendly_token}", "media_list")
+    remove_trending_media([instance.id])
+
+    # relations are deleted with the media, their counts are recomputed
+    # in post_delete
+    instance._counted_categories = list(instance.category.values_list("id", flat=True))
+    instance._counted_tags = list(instance.tags.values_list("id", flat=True))
 
 
 @receiver(post_delete, sender=Media)
@@ -1045,6 +1259,14 @@ def media_file_delete(sender, instance, **kwargs):
     Deletes file from filesystem
     when corresponding `Media` object is deleted.
     """
+    from ..counters import mark_media_counts_dirty
+
+    mark_media_counts_dirty(
+        users=[instance.user_id],
+        categories=getattr(instance, "_counted_categories", []),
+        tags=getattr(instance, "_counted_tags", []),
+    )
+
     if instance.media_file:
         helpers.rm_file(instance.media_file.path)
     if instance.thumbnail:
@@ -1060,8 +1282,7 @@ def media_file_delete(sender, instance, **kwargs):
     if instance.hls_file:
         p = os.path.dirname(instance.hls_file)
         helpers.rm_dir(p)
-
-    instance.user.update_user_media()
+    instance.discard_upload_ingest()
 
     # remove extra zombie thumbnails
     if instance.thumbnail:
@@ -1071,11 +1292,70 @@ def media_file_delete(sender, instance, **kwargs):
             helpers.rm_file(thumbnail)
 
 
+@receiver(post_save, sender=MediaPermission)
+@receiver(post_delete, sender=MediaPermission)
+def media_permission_change(sender, instance, **kwargs):
+    from ..visibility import queue_media_visibility
+
+    queue_media_visibility(media=[instance.media_id])
+
+
+@receiver(m2m_changed, sender=Media.category.through)
+def media_category_visibility(sender, instance, action, reverse, pk_set, **kwargs):
+    """Media of RBAC categories are visible to the members of their groups"""
+
+    if action not in ["post_add", "post_remove", "post_clear"] or not getattr(settings, "USE_RBAC", False):
+        return
+    from ..visibility import RBAC_MEMBER_ROLES, queue_media_visibility
+
+    if not reverse:
+        queue_media_visibility(media=[instance.pk])
+    elif pk_set:
+        queue_media_visibility(media=pk_set)
+    else:
+        # post_clear of a category, the media it had are not known anymore
+        users = instance.rbac_groups.filter(memberships__role__in=RBAC_MEMBER_ROLES).values_list("memberships__user_id", flat=True)
+        queue_media_visibility(users=users)
+
+
 @receiver(m2m_changed, sender=Media.category.through)
-def media_m2m(sender, instance, **kwargs):
-    if instance.category.all():
-        for category in instance.category.all():
-            category.update_category_media()
-    if instance.tags.all():
-        for tag in instance.tags.all():
-            tag.update_tag_media()
+@receiver(m2m_changed, sender=Media.tags.through)
+def media_m2m(sender, instance, action, reverse, pk_set, **kwargs):
+    field = "category" if sender is Media.category.through else "tags"
+    if action == "pre_clear":
+        # the relations are not known anymore after the clear
+        related = instance.media_set if reverse else getattr(instance, field)
+        setattr(instance, f"_cleared_{field}", list(related.values_list("id", flat=True)))
+        return
+    if action not in ["post_add", "post_remove", "post_clear"]:
+        return
+    if action == "post_clear":
+        pk_set = set(instance.__dict__.pop(f"_cleared_{field}", []))
+
+    from ..counters import mark_media_counts_dirty
+    from ..response_cache import invalidate_response_cache
+
+    if reverse:
+        invalidate_response_cache("media_list")
+    else:
+        invalidate_response_cache(f"media:{instance.friendly_token}", "media_list")
+
+    # related media are ranked on shared categories and tags, see files.related
+    from ..related import queue_related_media
+
+    if not reverse:
+        queue_related_media([instance.pk])
+    elif pk_set:
+        queue_related_media(list(pk_set))
+
+    ids = [instance.pk] if reverse else pk_set
+
+    if field == "category":
+        mark_media_counts_dirty(categories=ids)
+        return
+
+    mark_media_counts_dirty(tags=ids)
+    # tags are part of the searched text
+    from ..search_index import queue_search_index
+
+    queue_search_index(pk_set if reverse else [instance.pk])
@@ -106,9 +106,6 @@ class TranscriptionRequest(models.Model):
 
 @receiver(post_save, sender=Subtitle)
 def subtitle_save(sender, instance, created, **kwargs):
-    from .. import tasks
+    from ..search_index import queue_search_index
 
-    tasks.update_search_vector.apply_async(
-        args=[instance.media.friendly_token],
-        countdown=10,
-    )
+    queue_search_index([instance.media_id])
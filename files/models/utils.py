@@ -13,6 +13,15 @@ MEDIA_ENCODING_STATUS = (
     ("success", "Success"),
 )
 
+# steps of media_init, that run after a media is uploaded
+MEDIA_INIT_STATUS = (
+    ("pending", "Pending"),
+    ("probing", "Probing"),
+    ("thumbnails", "Thumbnails"),
+    ("fail", "Fail"),
+    ("success", "Success"),
+)
+
 # the media state of a Media object
 # this is set by default according to the portal workflow
 MEDIA_STATES = (
@@ -0,0 +1,125 @@
+"""Related media of the calculated strategy, from co-watches
+
+An offline job builds a sparse users x media matrix from the watch and
+like actions of the last RELATED_MEDIA_CALCULATED_DAYS days, anonymous
+sessions counting as users. The related media of a media are its top
+cosine neighbours among the columns of the matrix, computed for
+RELATED_MEDIA_CALCULATED_CHUNK media at a time to bound memory, and
+stored as RelatedMedia lists of the calculated strategy.
+
+Needs numpy and scipy, from requirements-full.txt
+"""
+
+from array import array
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+ACTION_WEIGHTS = {"watch": 1, "like": 2}
+
+
+def load_interactions(since):
+    """Load the watches and likes of listable media since a date
+
+    Returns:
+        tuple: rows (actors), columns (media) and weights arrays, and the
+            media id of each column
+    """
+
+    from actions.models import MediaAction
+
+    actors, columns = {}, {}
+    rows, cols, weights = array("i"), array("i"), array("f")
+    actions = MediaAction.objects.filter(action_date__gte=since, action__in=list(ACTION_WEIGHTS), media__listable=True)
+    for user_id, session_key, media_id, action in actions.values_list("user_id", "session_key", "media_id", "action").iterator(chunk_size=10000):
+        rows.append(actors.setdefault(user_id or session_key, len(actors)))
+        cols.append(columns.setdefault(media_id, len(columns)))
+        weights.append(ACTION_WEIGHTS[action])
+    return rows, cols, weights, array("q", columns)
+
+
+def get_cowatch_neighbours(rows, cols, weights, media_ids, size, min_cowatch, chunk):
+    """Top cosine neighbours of media, by the users that watched or liked them
+
+    Args:
+        rows, cols, weights: actor index, media index and weight of
+            actions, as arrays of load_interactions
+        media_ids: media id of each media index
+        size: maximum number of neighbours of a media
+        min_cowatch: minimum number of users that watched both media
+        chunk: number of media whose similarities are computed at once
+
+    Yields:
+        tuple: media id, and ids of its neighbours, most similar first
+    """
+
+    import numpy as np
+    from scipy import sparse
+
+    if not len(media_ids):
+        return
+
+    rows, cols = np.frombuffer(rows, dtype=np.int32), np.frombuffer(cols, dtype=np.int32)
+    weights, media_ids = np.frombuffer(weights, dtype=np.float32), np.frombuffer(media_ids, dtype=np.int64)
+
+    # duplicates, eg a watch and a like of the same user, are summed
+    matrix = sparse.csr_matrix((weights, (rows, cols)), shape=(rows.max() + 1, len(media_ids)))
+    norms = np.sqrt(matrix.multiply(matrix).sum(axis=0)).A1
+    items = (matrix @ sparse.diags(1 / norms)).T.tocsr()
+    watched = (matrix > 0).astype(np.float32).T.tocsr()
+
+    for start in range(0, len(media_ids), chunk):
+        end = min(start + chunk, len(media_ids))
+        similarities = items[start:end] @ items.T
+        if min_cowatch > 1:
+            cowatches = watched[start:end] @ watched.T
+            similarities = similarities.multiply(cowatches >= min_cowatch)
+        similarities = sparse.csr_matrix(similarities)
+        similarities.eliminate_zeros()
+
+        for i in range(end - start):
+            first, last = similarities.indptr[i], similarities.indptr[i + 1]
+            neighbours, scores = similarities.indices[first:last], similarities.data[first:last]
+            other = neighbours != start + i
+            neighbours, scores = neighbours[other], scores[other]
+            if len(scores) > size:
+                top = np.argpartition(-scores, size - 1)[:size]
+                neighbours, scores = neighbours[top], scores[top]
+            order = np.argsort(-scores, kind="stable")
+            yield int(media_ids[start + i]), media_ids[neighbours[order]].tolist()
+
+
+def build_calculated_related_media():
+    """Rebuild the related media of the calculated strategy
+
+    Lists of media without neighbours anymore are deleted, so that they
+    fall back to the content strategy
+
+    Returns:
+        int: Number of media with related media
+    """
+
+    from .models import RelatedMedia
+
+    started = timezone.now()
+    since = started - timedelta(days=settings.RELATED_MEDIA_CALCULATED_DAYS)
+    neighbours = get_cowatch_neighbours(
+        *load_interactions(since),
+        size=settings.RELATED_MEDIA_STORED,
+        min_cowatch=settings.RELATED_MEDIA_CALCULATED_MIN_COWATCH,
+        chunk=settings.RELATED_MEDIA_CALCULATED_CHUNK,
+    )
+
+    saved = 0
+    lists = []
+    for media_id, related_ids in neighbours:
+        if related_ids:
+            lists.append(RelatedMedia(media_id=media_id, strategy="calculated", media_ids=related_ids))
+        if len(lists) >= 1000:
+            saved += len(RelatedMedia.objects.bulk_create(lists, update_conflicts=True, unique_fields=["media", "strategy"], update_fields=["media_ids", "update_date"]))
+            lists = []
+    if lists:
+        saved += len(RelatedMedia.objects.bulk_create(lists, update_conflicts=True, unique_fields=["media", "strategy"], update_fields=["media_ids", "update_date"]))
+    RelatedMedia.objects.filter(strategy="calculated", update_date__lt=started).delete()
+    return saved
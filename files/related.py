@@ -0,0 +1,178 @@
+"""Precomputed lists of related media
+
+Instead of querying listable media in a random order on every view of a
+media, RelatedMedia keeps the ids of its related media, most related
+first. With the content strategy, candidates score for a shared author,
+and for each shared category and tag, and the list is filled up with
+popular and latest media.
+
+Changes of the title, listability, categories and tags of media queue the
+media, and the update_related_media task rebuilds their lists in batches.
+Lists older than RELATED_MEDIA_MAX_AGE days are queued once a day, so that
+they pick up media added since
+"""
+
+import random
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from .counters import update_dirty
+
+DIRTY_KEY = "related_media:dirty"
+SCHEDULED_KEY = "related_media:scheduled"
+BATCH_SIZE = 100
+AUTHOR_SCORE = 3
+CATEGORY_SCORE = 2
+TAG_SCORE = 1
+
+
+def queue_related_media(media_ids):
+    """Queue media to have their related media rebuilt
+
+    A single update_related_media task is scheduled for all the changes
+    that happen within RELATED_MEDIA_DELAY seconds
+
+    Args:
+        media_ids: ids of Media objects
+    """
+
+    media_ids = [id for id in media_ids if id]
+    if not media_ids:
+        return False
+    redis = get_redis_connection("default")
+    while media_ids:
+        batch, media_ids = media_ids[:10000], media_ids[10000:]
+        redis.sadd(DIRTY_KEY, *batch)
+
+    if cache.add(SCHEDULED_KEY, 1, settings.RELATED_MEDIA_DELAY * 10):
+        from .tasks import update_related_media
+
+        update_related_media.apply_async(countdown=settings.RELATED_MEDIA_DELAY)
+    return True
+
+
+def queue_stale_related_media():
+    """Queue the listable media whose lists are missing or older than
+    RELATED_MEDIA_MAX_AGE days
+
+    Returns:
+        int: Number of media queued
+    """
+
+    from .models import Media, RelatedMedia
+
+    fresh = RelatedMedia.objects.filter(strategy="content", update_date__gte=timezone.now() - timedelta(days=settings.RELATED_MEDIA_MAX_AGE))
+    media_ids = list(Media.objects.filter(listable=True).exclude(id__in=fresh.values("media_id")).values_list("id", flat=True))
+    queue_related_media(media_ids)
+    return len(media_ids)
+
+
+def get_content_related_ids(media, categories, tags, fill, size):
+    """Rank the media related to a media by author, categories and tags
+
+    Args:
+        media: Media object
+        categories: ids of the categories of media
+        tags: ids of the tags of media
+        fill: ids of popular and latest media, used if there are not
+            enough related ones
+        size: maximum number of ids
+
+    Returns:
+        list: media ids, most related first
+    """
+
+    from .models import Media
+
+    scores = Counter()
+    listable = Media.objects.filter(listable=True).exclude(id=media.id)
+    for id in listable.filter(user_id=media.user_id).order_by("-add_date").values_list("id", flat=True)[:size]:
+        scores[id] += AUTHOR_SCORE
+    for through, field, ids, score in (
+        (Media.category.through, "category_id", categories, CATEGORY_SCORE),
+        (Media.tags.through, "tag_id", tags, TAG_SCORE),
+    ):
+        if not ids:
+            continue
+        shared = through.objects.filter(**{f"{field}__in": ids}, media__listable=True).exclude(media_id=media.id)
+        shared = shared.values_list("media_id").annotate(shared=Count(field)).order_by("-shared", "-media_id")[:size]
+        for id, count in shared:
+            scores[id] += score * count
+
+    related = [id for id, score in sorted(scores.items(), key=lambda item: (-item[1], -item[0]))[:size]]
+    seen = set(related)
+    seen.add(media.id)
+    for id in fill:
+        if id not in seen:
+            related.append(id)
+            seen.add(id)
+    return related[:size]
+
+
+def set_related_media(media_ids):
+    """Rebuild the content related media of media
+
+    Returns:
+        int: Number of media updated
+    """
+
+    from .models import Media, RelatedMedia
+
+    size = settings.RELATED_MEDIA_STORED
+    media = list(Media.objects.filter(id__in=media_ids))
+    categories, tags = {}, {}
+    for relations, through, field in ((categories, Media.category.through, "category_id"), (tags, Media.tags.through, "tag_id")):
+        for media_id, id in through.objects.filter(media_id__in=media_ids).values_list("media_id", field):
+            relations.setdefault(media_id, []).append(id)
+
+    popular = [media_id for media_id, score in cache.get("popular_media") or []]
+    latest = Media.objects.filter(listable=True).order_by("-add_date").values_list("id", flat=True)[:size]
+    fill = popular + list(latest)
+
+    lists = [RelatedMedia(media=m, strategy="content", media_ids=get_content_related_ids(m, categories.get(m.id), tags.get(m.id), fill, size)) for m in media]
+    RelatedMedia.objects.bulk_create(lists, update_conflicts=True, unique_fields=["media", "strategy"], update_fields=["media_ids", "update_date"])
+    return len(lists)
+
+
+def rebuild_related_media():
+    """Rebuild the related media of the queued media
+
+    Returns:
+        int: Number of media updated
+    """
+
+    cache.delete(SCHEDULED_KEY)
+    return update_dirty(DIRTY_KEY, set_related_media, BATCH_SIZE)
+
+
+def get_related_media(media, strategy, limit):
+    """Get the stored related media of a media
+
+    The most related half of limit is always included, the rest is a
+    random sample of the other stored media, and they are shuffled
+
+    Returns:
+        list: Media objects, or None if the related media of media are
+            not built yet
+    """
+
+    from .models import Media, RelatedMedia, with_preview_encoding
+
+    media_ids = RelatedMedia.objects.filter(media=media, strategy=strategy).values_list("media_ids", flat=True).first()
+    if media_ids is None:
+        return None
+
+    keep = limit // 2
+    rest = media_ids[keep:]
+    media_ids = media_ids[:keep] + random.sample(rest, min(limit - keep, len(rest)))
+    # lists can be a day old, skip the media that are not listable anymore
+    related = with_preview_encoding(Media.objects.filter(listable=True).select_related("user")).in_bulk(media_ids)
+    related = list(related.values())
+    random.shuffle(related)
+    return related
@@ -0,0 +1,84 @@
+"""Shared cache of the responses to anonymous requests
+
+Responses are cached per host, path, language and query parameters, along
+with the versions their tags had when they were cached. Save and delete
+signals of media, users, categories and tags give their tags a new
+version, and any response cached under an older one is not served again
+"""
+
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.crypto import get_random_string
+from django.utils.http import urlencode
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+KEY = "response_cache:{}"
+TAG_KEY = "response_cache:tag:{}"
+
+
+def get_response_cache_key(request):
+    params = sorted((key, value) for key in request.GET for value in request.GET.getlist(key))
+    key = f"{request.get_host()}|{request.path}|{getattr(request, 'LANGUAGE_CODE', '')}|{urlencode(params)}"
+    return KEY.format(hashlib.md5(key.encode("utf-8"), usedforsecurity=False).hexdigest())
+
+
+def get_tag_versions(tags):
+    versions = cache.get_many([TAG_KEY.format(tag) for tag in tags])
+    return {tag: versions.get(TAG_KEY.format(tag), "") for tag in tags}
+
+
+def invalidate_response_cache(*tags):
+    """Stop serving the cached responses that have any of tags"""
+
+    # versions outlive the responses cached with them
+    cache.set_many({TAG_KEY.format(tag): get_random_string(8) for tag in tags}, settings.RESPONSE_CACHE_TIMEOUT * 2)
+
+
+def cache_anonymous_response(get_tags=None):
+    """Cache the successful responses of a view to anonymous GET requests
+
+    Works on function views and on APIView methods. Not meant for pages
+    that render messages, requests with messages to show and responses
+    that set cookies are never cached
+
+    Args:
+        get_tags: function(request, **kwargs) that returns the tags of
+            the response, so that signals can invalidate it
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            request = args[1] if isinstance(args[0], APIView) else args[0]
+            if request.method != "GET" or request.user.is_authenticated or not settings.RESPONSE_CACHE_TIMEOUT:
+                return view(*args, **kwargs)
+            # len() does not mark the messages as shown, unlike iterating them
+            if len(getattr(request, "_messages", [])):
+                return view(*args, **kwargs)
+
+            key = get_response_cache_key(request)
+            tags = get_tags(request, **kwargs) if get_tags else []
+            versions = get_tag_versions(tags)
+            cached = cache.get(key)
+            if cached and cached["versions"] == versions:
+                if cached["data"] is not None:
+                    return Response(cached["data"])
+                return HttpResponse(cached["content"], content_type=cached["content_type"])
+
+            response = view(*args, **kwargs)
+            if response.status_code == 200 and not response.cookies:
+                if isinstance(response, Response):
+                    cached = {"versions": versions, "data": response.data}
+                else:
+                    cached = {"versions": versions, "data": None, "content": response.content, "content_type": response["Content-Type"]}
+                cache.set(key, cached, settings.RESPONSE_CACHE_TIMEOUT)
+            return response
+
+        return wrapper
+
+    return decorator
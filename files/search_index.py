@@ -0,0 +1,92 @@
+"""Batched maintenance of Media.search
+
+Media saves, tag changes and subtitles only queue the ids of the media
+whose searched text changed. The update_search_vectors task rebuilds them
+in batches, with one UPDATE statement per batch
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django_redis import get_redis_connection
+
+DIRTY_KEY = "search_index:dirty"
+SCHEDULED_KEY = "search_index:scheduled"
+BATCH_SIZE = 100
+
+
+def queue_search_index(media_ids):
+    """Queue media to have their search vector rebuilt
+
+    Repeated requests for the same media are coalesced, and a single
+    update_search_vectors task is scheduled for all the changes that
+    happen within SEARCH_INDEX_DELAY seconds
+
+    Args:
+        media_ids: ids of Media objects
+    """
+
+    media_ids = [id for id in media_ids if id]
+    if not media_ids:
+        return False
+    get_redis_connection("default").sadd(DIRTY_KEY, *media_ids)
+
+    if cache.add(SCHEDULED_KEY, 1, settings.SEARCH_INDEX_DELAY * 10):
+        from .tasks import update_search_vectors
+
+        update_search_vectors.apply_async(countdown=settings.SEARCH_INDEX_DELAY)
+    return True
+
+
+def set_search_vectors(media):
+    """Rebuild the search vector of many media with a single UPDATE
+
+    Args:
+        media: Media objects, with tags, subtitles and user fetched
+
+    Returns:
+        int: Number of rows updated
+    """
+
+    rows = []
+    for m in media:
+        texts = m.get_search_texts()
+        rows.append((m.id, texts["A"], texts["B"], texts["C"], texts["D"]))
+    if not rows:
+        return 0
+    values = ", ".join(["(%s, %s, %s, %s, %s)"] * len(rows))
+    params = [param for row in rows for param in row]
+    table = media[0]._meta.db_table
+    vector = " || ".join(f"setweight(to_tsvector('simple', v.{weight.lower()}), '{weight}')" for weight in ["A", "B", "C", "D"])
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {table} SET search = {vector} FROM (VALUES {values}) AS v(id, a, b, c, d) WHERE {table}.id = v.id",
+            params,
+        )
+        return cursor.rowcount
+
+
+def rebuild_search_vectors():
+    """Rebuild the search vector of the queued media
+
+    Returns:
+        int: Number of media updated
+    """
+
+    from .models import Media
+
+    cache.delete(SCHEDULED_KEY)
+    redis = get_redis_connection("default")
+    updated = 0
+    while True:
+        ids = redis.spop(DIRTY_KEY, BATCH_SIZE)
+        if not ids:
+            return updated
+        ids = [int(id) for id in ids]
+        try:
+            media = list(Media.objects.filter(id__in=ids).select_related("user").prefetch_related("tags", "subtitles"))
+            updated += set_search_vectors(media)
+        except BaseException:
+            # not updated, leave them for the next run
+            redis.sadd(DIRTY_KEY, *ids)
+            raise
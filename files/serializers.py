@@ -1,38 +1,69 @@
 from django.conf import settings
+from django.db import models
 from rest_framework import serializers
 
+from .cards import get_media_cards
 from .methods import is_mediacms_editor
 from .models import Category, Comment, EncodeProfile, Media, Playlist, Tag
 
 # TODO: put them in a more DRY way
 
 
-class MediaSerializer(serializers.ModelSerializer):
+class MediaCardListSerializer(serializers.ListSerializer):
+    """Fetches the cards of all the media at once, see files.cards"""
+
+    def to_representation(self, data):
+        media = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        self.child.cards = get_media_cards(media)
+        return [self.child.to_representation(item) for item in media]
+
+
+class MediaCardMixin:
+    cards = None
+
+    def get_card(self, obj):
+        if not self.cards or obj.id not in self.cards:
+            self.cards = get_media_cards([obj])
+        return self.cards[obj.id]
+
+    def get_absolute_uri(self, path):
+        return self.context["request"].build_absolute_uri(path) if path else None
+
+
+class MediaSerializer(MediaCardMixin, serializers.ModelSerializer):
     # to be used in APIs as show related media
-    user = serializers.ReadOnlyField(source="user.username")
+    user = serializers.SerializerMethodField()
     url = serializers.SerializerMethodField()
     api_url = serializers.SerializerMethodField()
     thumbnail_url = serializers.SerializerMethodField()
+    preview_url = serializers.SerializerMethodField()
+    author_name = serializers.SerializerMethodField()
     author_profile = serializers.SerializerMethodField()
     author_thumbnail = serializers.SerializerMethodField()
 
+    def get_user(self, obj):
+        return self.get_card(obj)["user"]
+
     def get_url(self, obj):
-        return self.context["request"].build_absolute_uri(obj.get_absolute_url())
+        return self.get_absolute_uri(self.get_card(obj)["url"])
 
     def get_api_url(self, obj):
-        return self.context["request"].build_absolute_uri(obj.get_absolute_url(api=True))
+        return self.get_absolute_uri(self.get_card(obj)["api_url"])
 
     def get_thumbnail_url(self, obj):
-        if obj.thumbnail_url:
-            return self.context["request"].build_absolute_uri(obj.thumbnail_url)
-        else:
-            return None
+        return self.get_absolute_uri(self.get_card(obj)["thumbnail_url"])
+
+    def get_preview_url(self, obj):
+        return self.get_card(obj)["preview_url"]
+
+    def get_author_name(self, obj):
+        return self.get_card(obj)["author_name"]
 
     def get_author_profile(self, obj):
-        return self.context["request"].build_absolute_uri(obj.author_profile())
+        return self.get_absolute_uri(self.get_card(obj)["author_profile"])
 
     def get_author_thumbnail(self, obj):
-        return self.context["request"].build_absolute_uri(obj.author_thumbnail())
+        return self.get_absolute_uri(self.get_card(obj)["author_thumbnail"])
 
     class Meta:
         model = Media
@@ -80,6 +111,7 @@ class MediaSerializer(serializers.ModelSerializer):
             "size",
             # "category",
         )
+        list_serializer_class = MediaCardListSerializer
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -123,6 +155,7 @@ class SingleMediaSerializer(serializers.ModelSerializer):
             "state",
             "duration",
             "encoding_status",
+            "init_status",
             "views",
             "likes",
             "dislikes",
@@ -153,6 +186,7 @@ class SingleMediaSerializer(serializers.ModelSerializer):
             "author_thumbnail",
             "encodings_info",
             "encoding_status",
+            "init_status",
             "views",
             "likes",
             "dislikes",
@@ -177,15 +211,32 @@ class SingleMediaSerializer(serializers.ModelSerializer):
         )
 
 
-class MediaSearchSerializer(serializers.ModelSerializer):
+class MediaSearchSerializer(MediaCardMixin, serializers.ModelSerializer):
     url = serializers.SerializerMethodField()
     api_url = serializers.SerializerMethodField()
+    thumbnail_url = serializers.SerializerMethodField()
+    preview_url = serializers.SerializerMethodField()
+    author_name = serializers.SerializerMethodField()
+    author_profile = serializers.SerializerMethodField()
 
     def get_url(self, obj):
-        return self.context["request"].build_absolute_uri(obj.get_absolute_url())
+        return self.get_absolute_uri(self.get_card(obj)["url"])
 
     def get_api_url(self, obj):
-        return self.context["request"].build_absolute_uri(obj.get_absolute_url(api=True))
+        return self.get_absolute_uri(self.get_card(obj)["api_url"])
+
+    # unlike MediaSerializer, these are not absolute
+    def get_thumbnail_url(self, obj):
+        return self.get_card(obj)["thumbnail_url"]
+
+    def get_preview_url(self, obj):
+        return self.get_card(obj)["preview_url"]
+
+    def get_author_name(self, obj):
+        return self.get_card(obj)["author_name"]
+
+    def get_author_profile(self, obj):
+        return self.get_card(obj)["author_profile"]
 
     class Meta:
         model = Media
@@ -205,6 +256,7 @@ class MediaSearchSerializer(serializers.ModelSerializer):
             "preview_url",
             "categories_info",
         )
+        list_serializer_class = MediaCardListSerializer
 
 
 class EncodeProfileSerializer(serializers.ModelSerializer):
@@ -3,9 +3,10 @@ import os
 import re
 import shutil
 import tempfile
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
 
-from celery import Task
+from celery import Task, chain
 from celery import shared_task as task
 from celery.signals import task_revoked
 
@@ -18,9 +19,14 @@ from django.db import DatabaseError
 from django.db.models import Q
 
 from actions.models import USER_MEDIA_ACTIONS, MediaAction
+from actions.rollups import get_popular_media_scores
 from users.models import User
 
+from . import related
+from .action_counts import flush_action_counts_to_db, incr_action_count
+from .action_stream import ingest_media_actions_from_stream
 from .backends import FFmpegBackend
+from .counters import recompute_media_counts
 from .exceptions import VideoEncodingError
 from .helpers import (
     calculate_seconds,
@@ -28,12 +34,14 @@ from .helpers import (
     get_file_name,
     get_file_type,
     get_trim_timestamps,
+    get_upload_ingest_key,
     media_file_info,
     produce_ffmpeg_commands,
     produce_friendly_token,
     rm_file,
     run_command,
     trim_video_method,
+    trim_video_segments_method,
 )
 from .methods import (
     copy_video,
@@ -54,6 +62,11 @@ from .models import (
     TranscriptionRequest,
     VideoTrimRequest,
 )
+from .recommendations import build_calculated_related_media
+from .related import rebuild_related_media
+from .search_index import rebuild_search_vectors
+from .trending import add_trending_actions
+from .visibility import recompute_media_visibility
 
 logger = get_task_logger(__name__)
 
@@ -136,32 +149,39 @@ def chunkize_media(self, friendly_token, profiles, force=True):
     profiles = [EncodeProfile.objects.get(id=profile) for profile in profiles]
     media = Media.objects.get(friendly_token=friendly_token)
     cwd = os.path.dirname(os.path.realpath(media.media_file.path))
-    file_name = media.media_file.path.split("/")[-1]
-    random_prefix = produce_friendly_token()
-    file_format = f"{random_prefix}_{file_name}"
-    chunks_file_name = f"%02d_{file_format}"
-    chunks_file_name += ".mkv"
-    cmd = [
-        settings.FFMPEG_COMMAND,
-        "-y",
-        "-i",
-        media.media_file.path,
-        "-c",
-        "copy",
-        "-f",
-        "segment",
-        "-segment_time",
-        str(settings.VIDEO_CHUNKS_DURATION),
-        chunks_file_name,
-    ]
     chunks = []
-    ret = run_command(cmd, cwd=cwd)
+    # the file may have been cut in chunks already, see uploader.tasks.ingest_upload
+    ingest = media.get_upload_ingest()
+    if ingest and ingest["chunks"] and all(os.path.exists(chunk) for chunk in ingest["chunks"]):
+        chunks = ingest["chunks"]
+        cache.delete(get_upload_ingest_key(media.uid))
+    else:
+        media.discard_upload_ingest()
+        file_name = media.media_file.path.split("/")[-1]
+        random_prefix = produce_friendly_token()
+        file_format = f"{random_prefix}_{file_name}"
+        chunks_file_name = f"%02d_{file_format}"
+        chunks_file_name += ".mkv"
+        cmd = [
+            settings.FFMPEG_COMMAND,
+            "-y",
+            "-i",
+            media.media_file.path,
+            "-c",
+            "copy",
+            "-f",
+            "segment",
+            "-segment_time",
+            str(settings.VIDEO_CHUNKS_DURATION),
+            chunks_file_name,
+        ]
+        ret = run_command(cmd, cwd=cwd)
 
-    if "out" in ret.keys():
-        for line in ret.get("error").split("\n"):
-            ch = re.findall(r"Opening \'([\W\w]+)\' for writing", line)
-            if ch:
-                chunks.append(ch[0])
+        if "out" in ret.keys():
+            for line in ret.get("error").split("\n"):
+                ch = re.findall(r"Opening \'([\W\w]+)\' for writing", line)
+                if ch:
+                    chunks.append(ch[0])
     if not chunks:
         # command completely failed to segment file.putting to normal encode
         logger.info(f"Failed to break file {friendly_token} in chunks. Putting to normal encode queue")
@@ -528,6 +548,15 @@ def whisper_transcribe(friendly_token, translate_to_english=False):
         return False
 
 
+@task(name="update_search_vectors", queue="short_tasks")
+def update_search_vectors():
+    """Rebuild the search vector of the media queued by files.search_index"""
+
+    updated = rebuild_search_vectors()
+    logger.info(f"updated search vector of {updated} media")
+    return True
+
+
 @task(name="update_search_vector", queue="short_tasks")
 def update_search_vector(friendly_token):
     try:
@@ -627,14 +656,65 @@ def create_hls(friendly_token):
 
 @task(name="media_init", queue="short_tasks")
 def media_init(friendly_token):
+    """Start the steps that follow an upload, as a chain of tasks
+    Media.init_status shows the step a media is at
+    """
+    uid = Media.objects.filter(friendly_token=friendly_token).values_list("uid", flat=True).first()
+    if not uid:
+        logger.info("failed to get media with friendly_token %s" % friendly_token)
+        return False
+    steps = [
+        media_init_type.si(friendly_token),
+        media_init_thumbnail.si(friendly_token),
+        media_init_encode.si(friendly_token),
+    ]
+    # chunked uploads are read once for their md5 and chunks first
+    ingest = cache.get(get_upload_ingest_key(uid))
+    if ingest and ingest["status"] == "pending":
+        from uploader.tasks import ingest_upload
+
+        steps.insert(0, ingest_upload.si(friendly_token))
+    chain(*steps).delay()
+
+    return True
+
+
+def get_media_to_init(friendly_token):
+    """Get the media for a step of media_init
+    None if it does not exist or a previous step failed
+    """
     try:
         media = Media.objects.get(friendly_token=friendly_token)
-    except:  # noqa
+    except Media.DoesNotExist:
         logger.info("failed to get media with friendly_token %s" % friendly_token)
+        return None
+    if media.init_status == "fail":
+        return None
+    return media
+
+
+@task(name="media_init_type", queue="short_tasks")
+def media_init_type(friendly_token):
+    media = get_media_to_init(friendly_token)
+    if not media:
         return False
-    media.media_init()
+    return media.init_media_type()
 
-    return True
+
+@task(name="media_init_thumbnail", queue="short_tasks")
+def media_init_thumbnail(friendly_token):
+    media = get_media_to_init(friendly_token)
+    if not media:
+        return False
+    return media.init_thumbnail()
+
+
+@task(name="media_init_encode", queue="short_tasks")
+def media_init_encode(friendly_token):
+    media = get_media_to_init(friendly_token)
+    if not media:
+        return False
+    return media.init_encode()
 
 
 @task(name="check_running_states", queue="short_tasks")
@@ -832,12 +912,12 @@ def save_user_action(user_or_session, friendly_token=None, action="watch", extra
     )
     ma.save()
 
-    if action == "watch":
-        media.views += 1
-        Media.objects.filter(friendly_token=friendly_token).update(views=media.views)
-
-        # update field without calling save, to avoid post_save signals being triggered
-        # same in other actions
+    if action in ["watch", "like", "dislike"]:
+        # counted in Redis and added to the media by flush_action_counts,
+        # to avoid locking the media row on every action
+        incr_action_count(media.id, action)
+        if media.listable:
+            add_trending_actions([(media.id, action, time.time())])
 
     elif action == "report":
         media.reported_times += 1
@@ -851,51 +931,93 @@ def save_user_action(user_or_session, friendly_token=None, action="watch", extra
             action="media_reported",
             extra=extra_info,
         )
-    elif action == "like":
-        media.likes += 1
-        Media.objects.filter(friendly_token=friendly_token).update(likes=media.likes)
-    elif action == "dislike":
-        media.dislikes += 1
-        Media.objects.filter(friendly_token=friendly_token).update(dislikes=media.dislikes)
 
     return True
 
 
 @task(name="get_list_of_popular_media", queue="long_tasks")
 def get_list_of_popular_media():
-    """Experimental task for preparing media listing
-    for index page / recommended section
-    calculate and return the top 50 popular media, based on two rules
-    X = the top 25 videos that have the most views during the last week
-    Y = the most recent 25 videos that have been liked over the last 6 months
+    """Rank the popular media for the index page / recommended section
+
+    Scores are the watches, likes and dislikes of the daily rollups,
+    weighted by POPULAR_MEDIA_WEIGHTS and decayed with a half life of
+    POPULAR_MEDIA_HALF_LIFE_DAYS, see actions.rollups.get_popular_media_scores
     """
 
-    valid_media_x = {}
-    valid_media_y = {}
-    basic_query = Q(listable=True)
-    media_x = Media.objects.filter(basic_query).values("friendly_token")
+    scores = get_popular_media_scores(
+        settings.POPULAR_MEDIA_WINDOW_DAYS,
+        settings.POPULAR_MEDIA_HALF_LIFE_DAYS,
+        settings.POPULAR_MEDIA_WEIGHTS,
+        settings.POPULAR_MEDIA_LIMIT,
+    )
+    cache.set("popular_media", scores, 60 * 60 * 12)
+    logger.info(f"saved {len(scores)} popular media")
+
+    return True
+
+
+@task(name="update_media_counts", queue="short_tasks")
+def update_media_counts():
+    """Recompute media_count of users, categories and tags marked as dirty"""
+
+    updated = recompute_media_counts()
+    logger.info(f"updated media_count of {updated} objects")
+    return True
+
+
+@task(name="ingest_media_actions", queue="short_tasks")
+def ingest_media_actions():
+    """Save the watch, like and dislike actions queued in the Redis stream"""
+
+    saved = ingest_media_actions_from_stream()
+    logger.info(f"saved {saved} media actions")
+    return True
+
+
+@task(name="flush_action_counts", queue="short_tasks")
+def flush_action_counts():
+    """Add the views, likes and dislikes counted in Redis to media"""
+
+    flushed = flush_action_counts_to_db()
+    logger.info(f"flushed {flushed} action counts")
+    return True
+
+
+@task(name="update_related_media", queue="short_tasks")
+def update_related_media():
+    """Rebuild the related media of the media queued by files.related"""
+
+    updated = rebuild_related_media()
+    logger.info(f"rebuilt related media of {updated} media")
+    return True
+
+
+@task(name="queue_stale_related_media", queue="long_tasks")
+def queue_stale_related_media():
+    """Queue the media whose related media are old, so that they include media added since"""
+
+    queued = related.queue_stale_related_media()
+    logger.info(f"queued {queued} media with stale related media")
+    return True
 
-    period_x = datetime.now() - timedelta(days=7)
-    period_y = datetime.now() - timedelta(days=30 * 6)
 
-    for media in media_x:
-        ft = media["friendly_token"]
-        num = MediaAction.objects.filter(action_date__gte=period_x, action="watch", media__friendly_token=ft).count()
-        if num:
-            valid_media_x[ft] = num
-        num = MediaAction.objects.filter(action_date__gte=period_y, action="like", media__friendly_token=ft).count()
-        if num:
-            valid_media_y[ft] = num
+@task(name="update_calculated_related_media", queue="long_tasks")
+def update_calculated_related_media():
+    """Rebuild the related media of the calculated strategy, if it is used"""
+
+    if settings.RELATED_MEDIA_STRATEGY != "calculated":
+        return False
+    saved = build_calculated_related_media()
+    logger.info(f"computed related media of {saved} media")
+    return True
 
-    x = sorted(valid_media_x.items(), key=lambda kv: kv[1], reverse=True)[:25]
-    y = sorted(valid_media_y.items(), key=lambda kv: kv[1], reverse=True)[:25]
 
-    media_ids = [a[0] for a in x]
-    media_ids.extend([a[0] for a in y])
-    media_ids = list(set(media_ids))
-    cache.set("popular_media_ids", media_ids, 60 * 60 * 12)
-    logger.info("saved popular media ids")
+@task(name="update_media_visibility", queue="short_tasks")
+def update_media_visibility():
+    """Recompute the visibility of the users and media queued by files.visibility"""
 
+    updated = recompute_media_visibility()
+    logger.info(f"updated visibility of {updated} users and media")
     return True
 
 
@@ -1058,7 +1180,7 @@ def video_trim_task(self, trim_request_id):
         if not original_trim_result:
             logger.info(f"Failed to trim original file for media {target_media.friendly_token}")
 
-        deleted_encodings = handle_pending_running_encodings(target_media)
+        handle_pending_running_encodings(target_media)
         # the following could be un-necessary, read commend in pre_trim_video_actions to see why
         encodings = target_media.encodings.filter(status="success", profile__extension='mp4', chunk=False)
         for encoding in encodings:
@@ -1071,26 +1193,43 @@ def video_trim_task(self, trim_request_id):
         post_trim_action.delay(target_media.friendly_token)
 
     else:
-        for i, timestamp in enumerate(timestamps_encodings, start=1):
-            # copy the original file for each of the segments. This could be optimized to avoid the overhead but
-            # for now is necessary because the ffmpeg trim command will be run towards the original
-            # file on different times.
-            target_media = copy_video(original_media, title_suffix=f"(Trimmed) {i}", copy_encodings=True)
-
-            video_trim_request = VideoTrimRequest.objects.create(media=target_media, status="running", video_action="create_segments", media_trim_style='no_encoding', timestamps=[timestamp])  # noqa
-
-            original_trim_result = trim_video_method(target_media.media_file.path, [timestamp])
-            deleted_encodings = handle_pending_running_encodings(target_media)  # noqa
-            # the following could be un-necessary, read commend in pre_trim_video_actions to see why
-            encodings = target_media.encodings.filter(status="success", profile__extension='mp4', chunk=False)
+        # cut all segments out of the original file and out of every encoding with one ffmpeg run
+        # per file, then move the produced files in place for the new media, instead of copying
+        # the full files for each segment and trimming each copy
+        with tempfile.TemporaryDirectory(dir=settings.TEMP_DIRECTORY) as temp_dir:
+            original_segments = trim_video_segments_method(original_media.media_file.path, timestamps_original, temp_dir)
+            if not original_segments:
+                logger.info(f"Failed to trim original file for media {original_media.friendly_token}")
+
+            encodings_segments = {}
+            encodings = original_media.encodings.filter(status="success", profile__extension='mp4', chunk=False)
             for encoding in encodings:
-                trim_result = trim_video_method(encoding.media_file.path, [timestamp])
-                if not trim_result:
-                    logger.info(f"Failed to trim encoding {encoding.id} for media {target_media.friendly_token}")
-                    encoding.delete()
+                encoding_segments = trim_video_segments_method(encoding.media_file.path, timestamps_encodings, temp_dir)
+                if not encoding_segments:
+                    logger.info(f"Failed to trim encoding {encoding.id} for media {original_media.friendly_token}")
+                encodings_segments[encoding.id] = encoding_segments
+
+            for i, timestamp in enumerate(timestamps_encodings, start=1):
+                media_file_path = original_segments[i - 1] if original_segments else None
+                encoding_files = {encoding_id: segments[i - 1] for encoding_id, segments in encodings_segments.items() if segments and segments[i - 1]}
+
+                target_media = copy_video(
+                    original_media,
+                    title_suffix=f"(Trimmed) {i}",
+                    copy_encodings=True,
+                    media_file_path=media_file_path,
+                    encoding_files=encoding_files,
+                    file_suffix=f"_trimmed_{i}",
+                )
+
+                VideoTrimRequest.objects.create(media=target_media, status="running", video_action="create_segments", media_trim_style='no_encoding', timestamps=[timestamp])
+
+                if not media_file_path:
+                    # fall back to trimming a full copy of the original file
+                    original_trim_result = trim_video_method(target_media.media_file.path, [timestamp])  # noqa
 
-            pre_trim_video_actions(target_media)
-            post_trim_action.delay(target_media.friendly_token)
+                pre_trim_video_actions(target_media)
+                post_trim_action.delay(target_media.friendly_token)
 
         # set as completed the initial trim_request
         trim_request.status = "success"
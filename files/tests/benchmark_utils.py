@@ -0,0 +1,188 @@
+"""Seeding and measuring for the API benchmarks, see tests/benchmarks"""
+
+import json
+import os
+import statistics
+import time
+import tracemalloc
+import uuid
+from datetime import timedelta
+from itertools import islice
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from actions.models import MediaAction
+from files.models import (
+    Category,
+    Comment,
+    EncodeProfile,
+    Encoding,
+    Media,
+    Playlist,
+    PlaylistMedia,
+    Tag,
+)
+from files.visibility import get_visible_pairs, set_visibility
+from rbac.models import RBACGroup, RBACMembership
+from users.models import User
+
+BATCH_SIZE = 5000
+MEDIA_TYPES = ["video", "image", "audio", "pdf"]
+
+
+def bulk_create(model, objects):
+    """Create the objects of an iterable in batches of BATCH_SIZE, so that
+    only a batch is in memory at a time
+
+    Returns:
+        list: ids of the created objects
+    """
+
+    objects = iter(objects)
+    ids = []
+    for batch in iter(lambda: list(islice(objects, BATCH_SIZE)), []):
+        ids.extend(obj.pk for obj in model.objects.bulk_create(batch))
+    return ids
+
+
+def seed_benchmark_data(scale):
+    """Create scale media, and users, encodings, categories, tags, RBAC
+    groups, playlists, comments and actions in proportion
+
+    Objects are generated and created in batches, so no signals run, and
+    only their ids are kept. Counts and search vectors are set directly
+
+    Returns:
+        dict: objects the benchmarks request, "media", "playlist" and
+            "member", a user in all RBAC groups
+    """
+
+    now = timezone.now()
+    user_ids = bulk_create(User, (User(username=f"bench{i}", email=f"bench{i}@example.com", name=f"Bench User {i}") for i in range(max(scale // 20, 1))))
+    category_ids = bulk_create(Category, (Category(title=f"bench category {i}", is_rbac_category=i % 5 == 0) for i in range(50)))
+    tag_ids = bulk_create(Tag, (Tag(title=f"benchtag{i}") for i in range(500)))
+
+    media_ids = bulk_create(
+        Media,
+        (
+            Media(
+                friendly_token=f"bench{i}",
+                uid=uuid.uuid4(),
+                title=f"benchmark media {i}",
+                description=f"description of benchmark media {i}",
+                # the files are not created, endpoints only build their urls
+                media_file=f"original/bench{i}",
+                user_id=user_ids[i % len(user_ids)],
+                media_type=MEDIA_TYPES[i % len(MEDIA_TYPES)],
+                state="public" if i % 10 else "private",
+                listable=bool(i % 10),
+                is_reviewed=True,
+                encoding_status="success",
+                add_date=now - timedelta(minutes=i),
+                views=(i * 7919) % 10000,
+                likes=(i * 104729) % 100,
+                duration=i % 3600,
+            )
+            for i in range(scale)
+        ),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(f"UPDATE {Media._meta.db_table} SET search = to_tsvector('simple', title || ' ' || description)")
+
+    bulk_create(Media.category.through, (Media.category.through(media_id=id, category_id=category_ids[i % len(category_ids)]) for i, id in enumerate(media_ids)))
+    bulk_create(Media.tags.through, (Media.tags.through(media_id=id, tag_id=tag_ids[(i * 3 + j) % len(tag_ids)]) for i, id in enumerate(media_ids) for j in range(3)))
+
+    profile_ids = list(EncodeProfile.objects.filter(extension__in=["mp4", "gif"]).values_list("id", flat=True)[:3])
+    videos = (id for i, id in enumerate(media_ids) if MEDIA_TYPES[i % len(MEDIA_TYPES)] == "video")
+    bulk_create(Encoding, (Encoding(media_id=id, profile_id=profile_id, status="success", chunk=False) for id in videos for profile_id in profile_ids))
+
+    group_ids = bulk_create(RBACGroup, (RBACGroup(name=f"bench group {i}") for i in range(10)))
+    rbac_category_ids = category_ids[::5]
+    bulk_create(RBACGroup.categories.through, (RBACGroup.categories.through(rbacgroup_id=id, category_id=rbac_category_ids[i % len(rbac_category_ids)]) for i, id in enumerate(group_ids)))
+    bulk_create(RBACMembership, (RBACMembership(user_id=user_ids[i % len(user_ids)], rbac_group_id=id, role="member") for id in group_ids for i in range(min(20, len(user_ids)))))
+    set_visibility("user_id", user_ids, get_visible_pairs(user_id__in=user_ids))
+
+    member = User.objects.get(id=user_ids[0])
+    playlist = Playlist.objects.create(user=member, title="benchmark playlist")
+    bulk_create(PlaylistMedia, (PlaylistMedia(playlist=playlist, media_id=id, ordering=i) for i, id in enumerate(media_ids[:100])))
+
+    detail = Media.objects.get(id=media_ids[1])
+    for i in range(50):
+        Comment.objects.create(media=detail, user_id=user_ids[i % len(user_ids)], text=f"benchmark comment {i}")
+
+    actions = ["watch", "like", "dislike"]
+    bulk_create(
+        MediaAction,
+        (MediaAction(media_id=media_ids[(i * 31) % len(media_ids)], user_id=user_ids[i % len(user_ids)], action=actions[i % len(actions)]) for i in range(scale * 5)),
+    )
+
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    return {"media": detail, "playlist": playlist, "member": member}
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def measure(request, rounds):
+    """Run request rounds times, after a warm up one
+
+    Returns:
+        dict: SQL queries of a request, p50 and p95 latency in ms, and
+            peak Python memory in KB
+    """
+
+    request()
+    durations = []
+    for i in range(rounds):
+        started = time.perf_counter()
+        request()
+        durations.append((time.perf_counter() - started) * 1000)
+
+    with CaptureQueriesContext(connection) as context:
+        tracemalloc.start()
+        request()
+        memory = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+    return {
+        "queries": len(context.captured_queries),
+        "p50": round(statistics.median(durations), 2),
+        "p95": round(percentile(durations, 95), 2),
+        "memory": round(memory, 1),
+    }
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, baseline):
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def get_regressions(result, baseline, tolerance):
+    """Compare a measurement with its baseline
+
+    Queries have to stay the same or drop, latency and memory may grow up
+    to tolerance (eg 0.25 for 25%)
+
+    Returns:
+        list: descriptions of the regressions, empty if there are none
+    """
+
+    regressions = []
+    if result["queries"] > baseline["queries"]:
+        regressions.append(f"queries {baseline['queries']} -> {result['queries']}")
+    for metric in ["p50", "p95", "memory"]:
+        if result[metric] > baseline[metric] * (1 + tolerance):
+            regressions.append(f"{metric} {baseline[metric]} -> {result[metric]}")
+    return regressions
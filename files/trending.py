@@ -0,0 +1,94 @@
+"""Trending media, ranked by a time decayed score in a Redis sorted set
+
+Each counted watch or like adds its weight to the score of the media,
+scaled by 2 ** ((time - epoch) / TRENDING_HALF_LIFE) instead of decaying
+all the other scores, so an update is a single ZINCRBY and the order of
+the set is always the order of the decayed scores. As these scaled
+weights grow with time, the set is scaled back and its epoch moved to the
+present every REBASE_HALF_LIVES half lives, and scores that have decayed
+below MIN_SCORE are removed then
+"""
+
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+KEY = "trending_media"
+EPOCH_KEY = "trending_media:epoch"
+REBASE_HALF_LIVES = 32
+MIN_SCORE = 0.01
+
+ADD_SCRIPT = """
+local now = tonumber(ARGV[1])
+local half_life = tonumber(ARGV[2])
+local epoch = tonumber(redis.call('GET', KEYS[2]))
+if not epoch then
+    epoch = now
+    redis.call('SET', KEYS[2], epoch)
+end
+local half_lives = (now - epoch) / half_life
+if half_lives > tonumber(ARGV[3]) then
+    redis.call('ZUNIONSTORE', KEYS[1], 1, KEYS[1], 'WEIGHTS', tostring(2 ^ -half_lives))
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[4])
+    epoch = now
+    redis.call('SET', KEYS[2], epoch)
+end
+for i = 5, #ARGV, 3 do
+    local weight = tonumber(ARGV[i + 1]) * 2 ^ ((tonumber(ARGV[i + 2]) - epoch) / half_life)
+    redis.call('ZINCRBY', KEYS[1], tostring(weight), ARGV[i])
+end
+return epoch
+"""
+
+
+def add_trending_actions(actions):
+    """Add actions to the trending scores of their media
+
+    Args:
+        actions: (media id, action, unix timestamp) tuples, of listable media
+
+    Returns:
+        int: Number of actions added
+    """
+
+    args = []
+    for media_id, action, timestamp in actions:
+        weight = settings.TRENDING_WEIGHTS.get(action)
+        if weight:
+            args.extend([media_id, weight, timestamp])
+    if not args:
+        return 0
+
+    redis = get_redis_connection("default")
+    redis.register_script(ADD_SCRIPT)(keys=[KEY, EPOCH_KEY], args=[time.time(), settings.TRENDING_HALF_LIFE, REBASE_HALF_LIVES, MIN_SCORE] + args)
+    return len(args) // 3
+
+
+def remove_trending_media(media_ids):
+    """Remove media from trending, eg when they stop being listable"""
+
+    if media_ids:
+        get_redis_connection("default").zrem(KEY, *media_ids)
+
+
+class TrendingMedia:
+    """Listable media, highest trending score first
+
+    Sliced and counted like a queryset, so a Django paginator pages over
+    the sorted set and only loads the media of the requested page.
+    Only slicing is supported
+    """
+
+    def __len__(self):
+        return get_redis_connection("default").zcard(KEY)
+
+    def __getitem__(self, index):
+        from .models import Media, with_preview_encoding
+
+        start, stop = index.start or 0, index.stop or 0
+        if stop <= start:
+            return []
+        ids = [int(id) for id in get_redis_connection("default").zrevrange(KEY, start, stop - 1)]
+        media = with_preview_encoding(Media.objects.filter(listable=True).select_related("user")).in_bulk(ids)
+        return [media[id] for id in ids if id in media]
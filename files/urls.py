@@ -67,6 +67,7 @@ urlpatterns = [
         name="api_get_encoding",
     ),
     re_path(r"^api/v1/search$", views.MediaSearch.as_view()),
+    re_path(r"^api/v1/search/suggest$", views.MediaSearchSuggest.as_view()),
     re_path(
         rf"^api/v1/media/{friendly_token}/actions$",
         views.MediaActions.as_view(),
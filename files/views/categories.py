@@ -7,6 +7,7 @@ from rest_framework.views import APIView
 
 from ..methods import is_mediacms_editor
 from ..models import Category, Tag
+from ..response_cache import cache_anonymous_response
 from ..serializers import CategorySerializer, TagSerializer
 
 
@@ -22,6 +23,7 @@ class CategoryList(APIView):
             200: openapi.Response('response description', CategorySerializer),
         },
     )
+    @cache_anonymous_response(lambda request, **kwargs: ["categories"])
     def get(self, request, format=None):
         base_filters = {}
 
@@ -57,6 +59,7 @@ class TagList(APIView):
             200: openapi.Response('response description', TagSerializer),
         },
     )
+    @cache_anonymous_response(lambda request, **kwargs: ["tags"])
     def get(self, request, format=None):
         tags = Tag.objects.filter().order_by("-media_count")
         pagination_class = api_settings.DEFAULT_PAGINATION_CLASS
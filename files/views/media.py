@@ -1,13 +1,15 @@
 from datetime import datetime, timedelta
 
 from django.conf import settings
-from django.contrib.postgres.search import SearchQuery
-from django.db.models import Count, Q
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.core.cache import cache
+from django.db.models import Count, F, Q
 from django.shortcuts import get_object_or_404
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import permissions, status
 from rest_framework.exceptions import PermissionDenied
+from rest_framework.pagination import PageNumberPagination
 from rest_framework.parsers import (
     FileUploadParser,
     FormParser,
@@ -15,15 +17,15 @@ from rest_framework.parsers import (
     MultiPartParser,
 )
 from rest_framework.response import Response
-from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
 from actions.models import MediaAction
-from cms.custom_pagination import FastPaginationWithoutCount
+from cms.custom_pagination import FastPaginationWithoutCount, KeysetPagination
 from cms.permissions import IsAuthorizedToAdd, IsUserOrEditor
 from users.models import User
 
 from .. import helpers
+from ..action_stream import queue_media_action
 from ..methods import (
     change_media_owner,
     copy_media,
@@ -38,13 +40,26 @@ from ..models import (
     EncodeProfile,
     Media,
     MediaPermission,
+    MediaVisibility,
     Playlist,
     PlaylistMedia,
     Tag,
+    with_preview_encoding,
 )
+from ..response_cache import cache_anonymous_response
 from ..serializers import MediaSearchSerializer, MediaSerializer, SingleMediaSerializer
 from ..stop_words import STOP_WORDS
 from ..tasks import save_user_action
+from ..trending import TrendingMedia
+from ..visibility import get_visible_media_filter
+
+
+def get_media_list_tags(request, **kwargs):
+    tags = ["media_list"]
+    author = request.GET.get("author", "").strip()
+    if author:
+        tags.append(f"user:{author}")
+    return tags
 
 
 class MediaList(APIView):
@@ -55,9 +70,9 @@ class MediaList(APIView):
 
     @swagger_auto_schema(
         manual_parameters=[
-            openapi.Parameter(name='page', type=openapi.TYPE_INTEGER, in_=openapi.IN_QUERY, description='Page number'),
+            openapi.Parameter(name='cursor', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY, description='Page cursor, from the next and previous links'),
             openapi.Parameter(name='author', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY, description='username'),
-            openapi.Parameter(name='show', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY, description='show', enum=['recommended', 'featured', 'latest']),
+            openapi.Parameter(name='show', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY, description='show', enum=['recommended', 'featured', 'latest', 'trending']),
         ],
         tags=['Media'],
         operation_summary='List Media',
@@ -69,32 +84,19 @@ class MediaList(APIView):
         if user:
             base_filters &= Q(user=user)
 
-        base_queryset = Media.objects.prefetch_related("user", "tags")
+        base_queryset = Media.objects.prefetch_related("user")
 
         if not request.user.is_authenticated:
             return base_queryset.filter(base_filters)
 
-        conditions = base_filters
-
-        permission_filter = {'user': request.user}
+        # media shared through permissions and RBAC groups, see files.visibility
+        conditions = get_visible_media_filter(request.user)
         if user:
-            permission_filter['owner_user'] = user
-
-        if MediaPermission.objects.filter(**permission_filter).exists():
-            perm_conditions = Q(permissions__user=request.user)
-            if user:
-                perm_conditions &= Q(user=user)
-            conditions |= perm_conditions
-
-        if getattr(settings, 'USE_RBAC', False):
-            rbac_categories = request.user.get_rbac_categories_as_member()
-            rbac_conditions = Q(category__in=rbac_categories)
-            if user:
-                rbac_conditions &= Q(user=user)
-            conditions |= rbac_conditions
+            conditions &= Q(user=user)
 
-        return base_queryset.filter(conditions).distinct()
+        return base_queryset.filter(conditions)
 
+    @cache_anonymous_response(get_media_list_tags)
     def get(self, request, format=None):
         # authenticated users can see:
 
@@ -126,7 +128,7 @@ class MediaList(APIView):
 
         # Fall back to legacy handling only if we didn't parse a combined option
         if not parsed_combined:
-            sort_by_options = ["title", "add_date", "edit_date", "views", "likes"]
+            sort_by_options = ["title", "add_date", "edit_date", "views", "likes", "relevance"]
             if sort_by not in sort_by_options:
                 sort_by = "add_date"
             if ordering == "asc":
@@ -151,49 +153,46 @@ class MediaList(APIView):
                 year = datetime.now().date().year
                 gte = datetime(year, 1, 1)
 
+        if show_param == "trending":
+            # ranked in Redis and paged over its sorted set, other filters do not apply
+            paginator = PageNumberPagination()
+            page = paginator.paginate_queryset(TrendingMedia(), request)
+            return self._get_paginated_response(paginator, page, request)
+
         already_sorted = False
-        pagination_class = api_settings.DEFAULT_PAGINATION_CLASS
+        pagination_class = KeysetPagination
 
         if show_param == "recommended":
             pagination_class = FastPaginationWithoutCount
             media = show_recommended_media(request, limit=50)
             already_sorted = True
         elif show_param == "featured":
-            media = Media.objects.filter(listable=True, featured=True).prefetch_related("user", "tags")
+            media = Media.objects.filter(listable=True, featured=True).prefetch_related("user")
         elif show_param == "shared_by_me":
             if not self.request.user.is_authenticated:
                 media = Media.objects.none()
             else:
-                media = Media.objects.filter(permissions__owner_user=self.request.user).prefetch_related("user", "tags").distinct()
+                media = Media.objects.filter(permissions__owner_user=self.request.user).prefetch_related("user").distinct()
         elif show_param == "shared_with_me":
             if not self.request.user.is_authenticated:
                 media = Media.objects.none()
             else:
-                base_queryset = Media.objects.prefetch_related("user", "tags")
-
-                # Build OR conditions similar to _get_media_queryset
-                conditions = Q(permissions__user=request.user)
-
-                if getattr(settings, 'USE_RBAC', False):
-                    rbac_categories = request.user.get_rbac_categories_as_member()
-                    conditions |= Q(category__in=rbac_categories)
-
-                media = base_queryset.filter(conditions).distinct()
+                # media shared through permissions and RBAC groups, see files.visibility
+                visible = MediaVisibility.objects.filter(user=request.user).values("media_id")
+                media = Media.objects.filter(id__in=visible).prefetch_related("user")
         elif author_param:
             user_queryset = User.objects.all()
             user = get_object_or_404(user_queryset, username=author_param)
             if self.request.user == user or is_mediacms_editor(self.request.user):
-                media = Media.objects.filter(user=user).prefetch_related("user", "tags")
+                media = Media.objects.filter(user=user).prefetch_related("user")
             else:
                 media = self._get_media_queryset(request, user)
-                already_sorted = True
 
         else:
             if is_mediacms_editor(self.request.user):
-                media = Media.objects.prefetch_related("user", "tags")
+                media = Media.objects.prefetch_related("user")
             else:
                 media = self._get_media_queryset(request)
-                already_sorted = True
 
         if query:
             query = helpers.clean_query(query)
@@ -206,6 +205,8 @@ class MediaList(APIView):
                 query = None
         if query:
             media = media.filter(search=query)
+        elif sort_by == "relevance":
+            sort_by = "add_date"
 
         if tag:
             media = media.filter(tags__title=tag)
@@ -234,22 +235,25 @@ class MediaList(APIView):
             elif publish_state in ['private', 'public', 'unlisted']:
                 media = media.filter(state=publish_state)
 
-        if not already_sorted:
-            media = media.order_by(f"{ordering}{sort_by}")
-
-        media = media[:1000]
-
         paginator = pagination_class()
 
-        page = paginator.paginate_queryset(media, request)
+        if already_sorted:
+            page = paginator.paginate_queryset(media, request)
+        elif sort_by == "relevance":
+            # title matches rank higher than tags, description and subtitles
+            media = with_preview_encoding(media).annotate(rank=SearchRank(F("search"), query, cover_density=True))
+            page = paginator.paginate_queryset(media, request, ordering="-rank")
+        else:
+            page = paginator.paginate_queryset(with_preview_encoding(media), request, ordering=f"{ordering}{sort_by}")
 
+        return self._get_paginated_response(paginator, page, request)
+
+    def _get_paginated_response(self, paginator, page, request):
         serializer = MediaSerializer(page, many=True, context={"request": request})
 
-        tags_set = set()
-        for media_obj in page:
-            for tag in media_obj.tags.all():
-                tags_set.add(tag.title)
-        tags = ", ".join(sorted(tags_set))
+        # tags of all the media on the page, with a single query
+        tags = Tag.objects.filter(media__in=[media_obj.id for media_obj in page]).order_by("title").values_list("title", flat=True).distinct()
+        tags = ", ".join(tags)
 
         response = paginator.get_paginated_response(serializer.data)
         response.data['tags'] = tags
@@ -689,6 +693,7 @@ class MediaDetail(APIView):
         operation_description='Get information for a media',
         responses={200: SingleMediaSerializer(), 400: 'bad request'},
     )
+    @cache_anonymous_response(lambda request, friendly_token, **kwargs: [f"media:{friendly_token}"])
     def get(self, request, friendly_token, format=None):
         # Get media details
         # password = request.GET.get("password")
@@ -905,12 +910,13 @@ class MediaActions(APIView):
                 )
         if action:
             user_or_session = get_user_or_session(request)
-            save_user_action.delay(
-                user_or_session,
-                friendly_token=media.friendly_token,
-                action=action,
-                extra_info=extra,
-            )
+            if not queue_media_action(user_or_session, media, action):
+                save_user_action.delay(
+                    user_or_session,
+                    friendly_token=media.friendly_token,
+                    action=action,
+                    extra_info=extra,
+                )
 
             return Response({"detail": "action received"}, status=status.HTTP_201_CREATED)
         else:
@@ -984,7 +990,7 @@ class MediaSearch(APIView):
 
         # Fall back to legacy handling only if we didn't parse a combined option
         if not parsed_combined:
-            sort_by_options = ["title", "add_date", "edit_date", "views", "likes"]
+            sort_by_options = ["title", "add_date", "edit_date", "views", "likes", "relevance"]
             if sort_by not in sort_by_options:
                 sort_by = "add_date"
             if ordering == "asc":
@@ -1004,16 +1010,13 @@ class MediaSearch(APIView):
                 media = Media.objects.prefetch_related("user", "tags")
                 basic_query = Q()
             else:
-                basic_query = Q(listable=True) | Q(permissions__user=request.user) | Q(user=request.user)
-
-                if getattr(settings, 'USE_RBAC', False):
-                    rbac_categories = request.user.get_rbac_categories_as_member()
-                    basic_query |= Q(category__in=rbac_categories)
+                # media shared through permissions and RBAC groups, see files.visibility
+                basic_query = get_visible_media_filter(request.user, owned=True)
 
         else:
             basic_query = Q(listable=True)
 
-        media = Media.objects.filter(basic_query).distinct()
+        media = Media.objects.filter(basic_query)
 
         if query:
             # move this processing to a prepare_query function
@@ -1027,12 +1030,15 @@ class MediaSearch(APIView):
                 query = None
         if query:
             media = media.filter(search=query)
+        elif sort_by == "relevance":
+            sort_by = "add_date"
 
         if tag:
             media = media.filter(tags__title=tag)
 
         if category:
-            media = media.filter(category__title__contains=category)
+            # more than one category of a media can match
+            media = media.filter(category__title__contains=category).distinct()
 
         if media_type:
             media = media.filter(media_type=media_type)
@@ -1056,20 +1062,61 @@ class MediaSearch(APIView):
             if gte:
                 media = media.filter(add_date__gte=gte)
 
-        media = media.order_by(f"{ordering}{sort_by}")
+        if sort_by == "relevance":
+            # title matches rank higher than tags, description and subtitles
+            media = media.annotate(rank=SearchRank(F("search"), query, cover_density=True))
+            ordering = "-rank"
+        else:
+            ordering = f"{ordering}{sort_by}"
 
         if self.request.query_params.get("show", "").strip() == "titles":
-            media = media.values("title")[:40]
+            media = media.order_by(ordering).values("title")[:40]
             return Response(media, status=status.HTTP_200_OK)
         else:
-            media = media.prefetch_related("user")[:1000]  # limit to 1000 results
+            media = with_preview_encoding(media.prefetch_related("user"))
 
-            if category or tag:
-                pagination_class = api_settings.DEFAULT_PAGINATION_CLASS
-            else:
-                # pagination_class = FastPaginationWithoutCount
-                pagination_class = api_settings.DEFAULT_PAGINATION_CLASS
-            paginator = pagination_class()
-            page = paginator.paginate_queryset(media, request)
+            paginator = KeysetPagination()
+            page = paginator.paginate_queryset(media, request, ordering=ordering)
             serializer = MediaSearchSerializer(page, many=True, context={"request": request})
             return paginator.get_paginated_response(serializer.data)
+
+
+class MediaSearchSuggest(APIView):
+    """
+    Suggestions for search as you type, out of media and tag titles
+    Only GET is implemented here
+    """
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(name='q', type=openapi.TYPE_STRING, in_=openapi.IN_QUERY, description='Text typed so far'),
+        ],
+        tags=['Search'],
+        operation_summary='Search suggestions',
+        operation_description='Titles of listed media and of tags that contain the text, for search as you type',
+    )
+    def get(self, request, format=None):
+        query = helpers.clean_query(self.request.query_params.get("q", "").strip())[:100]
+        if len(query) < 2:
+            return Response({"media": [], "tags": []}, status=status.HTTP_200_OK)
+
+        # only listable media are suggested, so the same response
+        # can be cached for everyone
+        cache_key = f"search_suggest:{query}"
+        ret = cache.get(cache_key)
+        if ret is None:
+            # icontains uses the trigram indexes on title
+            media = (
+                Media.objects.filter(listable=True, title__icontains=query)
+                .annotate(similarity=TrigramSimilarity("title", query))
+                .order_by("-similarity", "-views")
+                .values_list("title", flat=True)[: settings.SEARCH_SUGGEST_LIMIT * 2]
+            )
+            tags = Tag.objects.filter(title__icontains=query).order_by("-media_count").values_list("title", flat=True)[: settings.SEARCH_SUGGEST_LIMIT]
+            ret = {
+                "media": list(dict.fromkeys(media))[: settings.SEARCH_SUGGEST_LIMIT],
+                "tags": list(tags),
+            }
+            cache.set(cache_key, ret, settings.SEARCH_SUGGEST_CACHE_TIMEOUT)
+
+        return Response(ret, status=status.HTTP_200_OK)
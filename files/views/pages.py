@@ -14,6 +14,7 @@ from files.methods import user_allowed_to_upload
 from users.models import User
 
 from .. import helpers
+from ..action_stream import queue_media_action
 from ..forms import (
     ContactForm,
     EditSubtitleForm,
@@ -694,7 +695,8 @@ def view_media(request):
         return render(request, "cms/media.html", context)
 
     user_or_session = get_user_or_session(request)
-    save_user_action.delay(user_or_session, friendly_token=friendly_token, action="watch")
+    if not queue_media_action(user_or_session, media, "watch"):
+        save_user_action.delay(user_or_session, friendly_token=friendly_token, action="watch")
     context = {}
     context["media"] = friendly_token
     context["media_object"] = media
@@ -0,0 +1,139 @@
+"""Materialised visibility of media that are not listable
+
+Besides listable media, a user sees media shared with them through a
+MediaPermission and, with USE_RBAC, media in the categories of the RBAC
+groups they are a member of. MediaVisibility keeps these (user, media)
+pairs, so listings select them with a single indexed subquery, instead of
+joining permissions and RBAC categories and then a DISTINCT.
+
+Signals queue the users or media whose pairs may have changed, and the
+update_media_visibility task recomputes them in batches
+"""
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django_redis import get_redis_connection
+
+from .counters import update_dirty
+
+DIRTY_KEY = "media_visibility:dirty:{}"
+SCHEDULED_KEY = "media_visibility:scheduled"
+BATCH_SIZE = 100
+RBAC_MEMBER_ROLES = ["member", "contributor", "manager"]
+
+
+def queue_media_visibility(users=(), media=()):
+    """Queue users or media to have their visibility recomputed
+
+    A single update_media_visibility task is scheduled for all the changes
+    that happen within MEDIA_VISIBILITY_DELAY seconds
+
+    Args:
+        users: ids of User objects
+        media: ids of Media objects
+    """
+
+    redis = get_redis_connection("default")
+    pipe = redis.pipeline()
+    queued = False
+    for name, ids in (("user", users), ("media", media)):
+        ids = [id for id in ids if id]
+        if ids:
+            pipe.sadd(DIRTY_KEY.format(name), *ids)
+            queued = True
+    if not queued:
+        return False
+    pipe.execute()
+
+    if cache.add(SCHEDULED_KEY, 1, settings.MEDIA_VISIBILITY_DELAY * 10):
+        from .tasks import update_media_visibility
+
+        update_media_visibility.apply_async(countdown=settings.MEDIA_VISIBILITY_DELAY)
+    return True
+
+
+def get_visible_media_filter(user, owned=False):
+    """Get the filter of the media a user sees on listings and search
+
+    Most users see listable media only, and get Q(listable=True), so their
+    queries use the partial listing indexes like anonymous ones. An OR
+    with shared or owned media can not use them, see Media.Meta.indexes
+
+    Args:
+        user: an authenticated User
+        owned: whether the non listable media of the user are included
+
+    Returns:
+        Q: filter on Media
+    """
+
+    from .models import Media, MediaVisibility
+
+    conditions = Q(listable=True)
+    if MediaVisibility.objects.filter(user=user, media__listable=False).exists():
+        conditions |= Q(id__in=MediaVisibility.objects.filter(user=user).values("media_id"))
+    if owned and Media.objects.filter(user=user, listable=False).exists():
+        conditions |= Q(user=user)
+    return conditions
+
+
+def get_visible_pairs(**filters):
+    """Get the (user_id, media_id) pairs of media shared with users
+
+    Args:
+        filters: either user_id__in or media_id__in
+
+    Returns:
+        set: (user_id, media_id) tuples
+    """
+
+    from .models import Media, MediaPermission
+
+    pairs = set(MediaPermission.objects.filter(**filters).values_list("user_id", "media_id"))
+    if getattr(settings, "USE_RBAC", False):
+        if "user_id__in" in filters:
+            filters = {"category__rbac_groups__memberships__user_id__in": filters["user_id__in"]}
+        rbac = Media.category.through.objects.filter(category__rbac_groups__memberships__role__in=RBAC_MEMBER_ROLES, **filters)
+        pairs.update(rbac.values_list("category__rbac_groups__memberships__user_id", "media_id"))
+    return pairs
+
+
+def set_visibility(field, ids, pairs):
+    """Make the MediaVisibility rows of ids match pairs
+
+    Args:
+        field: user_id or media_id
+        ids: the ids of field that pairs were calculated for
+        pairs: (user_id, media_id) tuples
+    """
+
+    from .models import MediaVisibility
+
+    existing = set(MediaVisibility.objects.filter(**{f"{field}__in": ids}).values_list("user_id", "media_id"))
+    stale = defaultdict(list)
+    for user_id, media_id in existing - pairs:
+        stale[user_id].append(media_id)
+    for user_id, media_ids in stale.items():
+        MediaVisibility.objects.filter(user_id=user_id, media_id__in=media_ids).delete()
+    MediaVisibility.objects.bulk_create([MediaVisibility(user_id=user_id, media_id=media_id) for user_id, media_id in pairs - existing], ignore_conflicts=True)
+
+
+def recompute_media_visibility():
+    """Recompute the visibility of the queued users and media
+
+    Returns:
+        int: Number of users and media updated
+    """
+
+    def update_users(ids):
+        set_visibility("user_id", ids, get_visible_pairs(user_id__in=ids))
+
+    def update_media(ids):
+        set_visibility("media_id", ids, get_visible_pairs(media_id__in=ids))
+
+    cache.delete(SCHEDULED_KEY)
+    updated = update_dirty(DIRTY_KEY.format("user"), update_users, BATCH_SIZE)
+    return updated + update_dirty(DIRTY_KEY.format("media"), update_media, BATCH_SIZE)
@@ -0,0 +1,45 @@
+"""Per user cache of the categories a user has access to through RBAC groups
+
+Entries are versioned: rbac signals change the version of the affected
+users instead of deleting their entry, so a request that read the
+memberships before a change can not cache them after it
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.crypto import get_random_string
+
+VERSION_KEY = "rbac_categories:version:{}"
+CATEGORIES_KEY = "rbac_categories:{}:{}"
+
+
+def get_rbac_category_roles(user_id):
+    """Get the categories of the RBAC groups of a user
+
+    Returns:
+        dict: category id -> set of the user's roles on it
+    """
+
+    from .models import RBACMembership
+
+    version = cache.get(VERSION_KEY.format(user_id), "")
+    key = CATEGORIES_KEY.format(user_id, version)
+    roles = cache.get(key)
+    if roles is None:
+        roles = {}
+        memberships = RBACMembership.objects.filter(user_id=user_id, rbac_group__categories__isnull=False)
+        for category_id, role in memberships.values_list("rbac_group__categories", "role"):
+            roles.setdefault(category_id, set()).add(role)
+        cache.set(key, roles, settings.RBAC_CACHE_TIMEOUT)
+    return roles
+
+
+def invalidate_rbac_category_roles(user_ids):
+    """Give the cached RBAC categories of users a new version
+
+    Args:
+        user_ids: ids of User objects
+    """
+
+    # versions outlive the entries they point to
+    cache.set_many({VERSION_KEY.format(user_id): get_random_string(8) for user_id in set(user_ids)}, None)
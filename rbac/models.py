@@ -1,7 +1,7 @@
 from allauth.socialaccount.models import SocialApp
 from django.conf import settings
 from django.db import models
-from django.db.models.signals import m2m_changed
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
 from django.utils.crypto import get_random_string
 
@@ -94,3 +94,45 @@ def handle_rbac_group_categories_change(sender, instance, action, pk_set, **kwar
             category = Category.objects.get(pk=category_id)
 
             IdentityProviderCategoryMapping.objects.filter(identity_provider=instance.identity_provider, name=instance.uid, map_to=category).delete()
+
+
+@receiver(post_save, sender=RBACMembership)
+@receiver(post_delete, sender=RBACMembership)
+def rbac_membership_change(sender, instance, **kwargs):
+    from .cache import invalidate_rbac_category_roles
+
+    invalidate_rbac_category_roles([instance.user_id])
+    if not getattr(settings, 'USE_RBAC', False):
+        return
+    from files.visibility import queue_media_visibility
+
+    queue_media_visibility(users=[instance.user_id])
+
+
+@receiver(m2m_changed, sender=RBACGroup.categories.through)
+def rbac_group_categories_visibility(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Members of an RBAC group see the media of its categories, recompute their cached categories and visibility when categories change.
+    """
+    if action == 'pre_clear' and reverse:
+        # the groups of a category are not known after they are cleared
+        instance._rbac_user_ids = list(RBACMembership.objects.filter(rbac_group__categories=instance).values_list('user_id', flat=True))
+        return
+    if action not in ['post_add', 'post_remove', 'post_clear']:
+        return
+
+    if not reverse:
+        user_ids = list(instance.memberships.values_list('user_id', flat=True))
+    elif pk_set:
+        user_ids = list(RBACMembership.objects.filter(rbac_group_id__in=pk_set).values_list('user_id', flat=True))
+    else:
+        user_ids = getattr(instance, '_rbac_user_ids', [])
+
+    from .cache import invalidate_rbac_category_roles
+
+    invalidate_rbac_category_roles(user_ids)
+    if not getattr(settings, 'USE_RBAC', False):
+        return
+    from files.visibility import queue_media_visibility
+
+    queue_media_visibility(users=user_ids)
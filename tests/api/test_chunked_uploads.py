@@ -0,0 +1,169 @@
+import hashlib
+import os
+import uuid
+
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import Client, TestCase, override_settings
+
+from files.helpers import get_upload_ingest_key
+from files.models import Media
+from files.tests import create_account
+from uploader.sessions import UploadSession
+
+UPLOAD_URL = '/fu/upload/'
+
+
+class ChunkedUploadTestCase(TestCase):
+    fixtures = ["fixtures/categories.json", "fixtures/encoding_profiles.json"]
+    file_name = 'test_image2.jpg'
+
+    def setUp(self):
+        self.password = 'this_is_a_fake_password'
+        self.user = create_account(password=self.password)
+        self.client = Client()
+        self.client.login(username=self.user.username, password=self.password)
+        with open(f'fixtures/{self.file_name}', 'rb') as f:
+            self.content = f.read()
+        size = len(self.content) // 3 + 1
+        self.parts, rest = [], self.content
+        while rest:
+            part, rest = rest[:size], rest[size:]
+            self.parts.append(part)
+        self.uuid = str(uuid.uuid4())
+
+    def send_part(self, index, content=None, **extra):
+        data = {
+            'qqfile': SimpleUploadedFile('blob', self.parts[index] if content is None else content),
+            'qquuid': self.uuid,
+            'qqfilename': self.file_name,
+            'qqpartindex': index,
+            'qqtotalparts': len(self.parts),
+            'qqtotalfilesize': len(self.content),
+            **extra,
+        }
+        return self.client.post(UPLOAD_URL, data)
+
+    def finish(self):
+        data = {'qquuid': self.uuid, 'qqfilename': self.file_name, 'qqtotalparts': len(self.parts), 'qqtotalfilesize': len(self.content)}
+        return self.client.post(f'{UPLOAD_URL}?done', data)
+
+    def assert_uploaded(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['success'])
+        media = Media.objects.get(user=self.user, title=self.file_name)
+        with open(media.media_file.path, 'rb') as f:
+            self.assertEqual(f.read(), self.content, "Media file should hold all the parts, in order")
+        return media
+
+
+@override_settings(UPLOAD_INGEST=False)
+class TestChunkedUploads(ChunkedUploadTestCase):
+    def test_multi_part_upload(self):
+        for index in range(len(self.parts)):
+            self.assertEqual(self.send_part(index).status_code, 200)
+        self.assert_uploaded(self.finish())
+
+    def test_out_of_order_parts(self):
+        """Test that parts are assembled in order as soon as the parts before them arrive"""
+        session = UploadSession(self.uuid)
+        self.send_part(2)
+        self.assertEqual(session.get_assembled(), (0, 0), "A part should wait for the parts before it")
+        self.send_part(0)
+        self.assertEqual(session.get_assembled(), (1, len(self.parts[0])))
+        self.send_part(1)
+        self.assertEqual(session.get_assembled(), (3, len(self.content)), "The waiting part should be assembled with the missing one")
+        self.assertEqual(set(session.get_parts()), {0, 1, 2})
+        self.assert_uploaded(self.finish())
+        self.assertFalse(UploadSession(self.uuid).exists, "Session should be deleted once the media is created")
+
+    def test_resume(self):
+        """Test that an upload missing a part can be finished once the part is sent"""
+        self.send_part(0)
+        self.send_part(2)
+        response = self.finish()
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Media.objects.filter(user=self.user).exists())
+        self.assertEqual(UploadSession(self.uuid).get_assembled(), (1, len(self.parts[0])), "What was assembled should be kept for a resume")
+
+        self.send_part(1)
+        self.assert_uploaded(self.finish())
+
+    def test_retried_duplicate_part(self):
+        """Test that parts sent twice are assembled once"""
+        session = UploadSession(self.uuid)
+        self.send_part(0)
+        self.send_part(0)
+        self.assertEqual(session.get_assembled(), (1, len(self.parts[0])), "An assembled part sent again should be skipped")
+        self.send_part(2)
+        self.send_part(2)
+        self.send_part(1)
+        self.assert_uploaded(self.finish())
+
+    def test_part_checksums(self):
+        """Test that parts are rejected if they do not match the md5 sent with them, or replace an assembled part"""
+        md5 = hashlib.md5(self.parts[0]).hexdigest()
+        response = self.send_part(0, content=self.parts[0][:-1], qqpartmd5=md5)
+        self.assertEqual(response.status_code, 400, "A corrupted part should be rejected")
+        self.assertEqual(self.send_part(0, qqpartmd5=md5).status_code, 200)
+
+        response = self.send_part(0, content=self.parts[1])
+        self.assertEqual(response.status_code, 400, "An assembled part should not be replayed with other content")
+        self.send_part(1)
+        self.send_part(2)
+        self.assert_uploaded(self.finish())
+
+    def test_status(self):
+        """Test that the parts received so far can be queried, to resume an upload"""
+        self.send_part(0)
+        self.send_part(2)
+        response = self.client.get(f'{UPLOAD_URL}status/{self.uuid}/')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['total_parts'], data['assembled_parts'], data['assembled_size']), (3, 1, len(self.parts[0])))
+        self.assertEqual([(part['index'], part['md5']) for part in data['parts']], [(i, hashlib.md5(self.parts[i]).hexdigest()) for i in (0, 2)])
+
+        other = create_account(password=self.password)
+        self.client.login(username=other.username, password=self.password)
+        self.assertEqual(self.client.get(f'{UPLOAD_URL}status/{self.uuid}/').status_code, 404)
+
+    def test_other_user_session(self):
+        """Test that parts can not be added to the upload of another user"""
+        self.send_part(0)
+        other = create_account(password=self.password)
+        self.client.login(username=other.username, password=self.password)
+        response = self.send_part(1)
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(response.json()['reset'])
+
+
+@override_settings(UPLOAD_INGEST=True)
+class TestUploadIngest(ChunkedUploadTestCase):
+    file_name = 'small_video.mp4'
+
+    def test_ingest_before_media_init(self):
+        """Test that the md5 of a chunked upload is calculated once, before the other steps of media_init"""
+        for index in range(len(self.parts)):
+            self.send_part(index)
+        with self.captureOnCommitCallbacks(execute=True):
+            media = self.assert_uploaded(self.finish())
+        media.refresh_from_db()
+        self.assertEqual(media.md5sum, hashlib.md5(self.content).hexdigest())
+        self.assertIsNone(cache.get(get_upload_ingest_key(media.uid)), "Results should be discarded once the video is not chunkized")
+
+    def test_chunks_removed_with_media(self):
+        """Test that chunks cut from an upload are removed if the media is deleted before they are encoded"""
+        with open(f'fixtures/{self.file_name}', 'rb') as f:
+            media = Media.objects.create(title="Chunked", user=self.user, media_file=File(f))
+        chunks = []
+        for i in range(2):
+            chunk = os.path.join(os.path.dirname(media.media_file.path), f"{i:02d}_{media.uid.hex}.mkv")
+            with open(chunk, 'wb') as f:
+                f.write(b"chunk")
+            chunks.append(chunk)
+        cache.set(get_upload_ingest_key(media.uid), {"status": "success", "md5sum": "", "file_size": len(self.content), "chunks": chunks})
+
+        media.delete()
+        self.assertFalse(any(os.path.exists(chunk) for chunk in chunks))
+        self.assertIsNone(cache.get(get_upload_ingest_key(media.uid)))
@@ -0,0 +1,145 @@
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client, TestCase, override_settings
+from django.utils import timezone
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from actions.models import MediaAction, MediaActionRollup
+from actions.partitions import (
+    add_months,
+    create_partitions,
+    drop_expired_media_actions,
+    get_partitions,
+    is_partitioned,
+    maintain_media_actions,
+    partition_media_actions,
+)
+from actions.rollups import rollup_media_actions
+from files.action_stream import save_media_actions
+from files.models import Media
+from files.tasks import get_list_of_popular_media, save_user_action
+from files.tests import create_account
+from files.trending import KEY as TRENDING_KEY
+
+
+class TestMediaActions(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.password = 'this_is_a_fake_password'
+        self.user = create_account(password=self.password)
+        self.media = Media.objects.create(title="Test Media", user=self.user, state="public", encoding_status="success", is_reviewed=True, listable=True)
+
+    def test_action_counts_are_flushed_to_media(self):
+        """Test that views, likes and dislikes counted in Redis are added to the media"""
+        views, likes, dislikes = self.media.views, self.media.likes, self.media.dislikes
+        other = create_account(username="other", email="other@example.com")
+
+        for user in [self.user, other]:
+            self.assertTrue(save_user_action({"user_id": user.id}, friendly_token=self.media.friendly_token, action="watch"))
+        self.assertTrue(save_user_action({"user_id": self.user.id}, friendly_token=self.media.friendly_token, action="like"))
+        self.assertTrue(save_user_action({"user_id": other.id}, friendly_token=self.media.friendly_token, action="dislike"))
+        # liking twice is not counted
+        self.assertFalse(save_user_action({"user_id": self.user.id}, friendly_token=self.media.friendly_token, action="like"))
+
+        self.media.refresh_from_db()
+        self.assertEqual((self.media.views, self.media.likes, self.media.dislikes), (views + 2, likes + 1, dislikes + 1))
+
+    def test_streamed_actions_are_saved_in_batches(self):
+        """Test that watches and likes queued by the views are saved, with a single watch per user and media"""
+        views, likes = self.media.views, self.media.likes
+        self.client.login(username=self.user.username, password=self.password)
+
+        for i in range(2):
+            self.assertEqual(self.client.get(f"/view?m={self.media.friendly_token}").status_code, 200)
+            response = self.client.post(f"/api/v1/media/{self.media.friendly_token}/actions", {"type": "like"}, content_type="application/json")
+            self.assertEqual(response.status_code, 201)
+
+        self.assertEqual(MediaAction.objects.filter(user=self.user, media=self.media, action="watch").count(), 1)
+        self.assertEqual(MediaAction.objects.filter(user=self.user, media=self.media, action="like").count(), 1)
+        self.media.refresh_from_db()
+        self.assertEqual((self.media.views, self.media.likes), (views + 1, likes + 1))
+
+    def test_streamed_actions_keep_their_date(self):
+        """Test that actions saved from the stream get the date they happened, not the date they are saved"""
+        date = timezone.now() - timedelta(hours=2)
+        event = {"user": self.user.id, "session": "", "ip": "", "media": self.media.id, "action": "like", "date": date}
+        self.assertEqual(save_media_actions([event]), 1)
+        self.assertEqual(MediaAction.objects.get(user=self.user, media=self.media, action="like").action_date, date)
+
+    def test_watch_saved_without_redis(self):
+        """Test that watches are saved with save_user_action when the stream can not be written to"""
+        self.client.login(username=self.user.username, password=self.password)
+        with mock.patch("files.action_stream.get_redis_connection", side_effect=RedisError):
+            self.assertEqual(self.client.get(f"/view?m={self.media.friendly_token}").status_code, 200)
+        self.assertTrue(MediaAction.objects.filter(user=self.user, media=self.media, action="watch").exists())
+
+    def test_rollups_are_kept_after_retention(self):
+        """Test that daily rollups count actions and unique viewers, and outlive the actions dropped by retention"""
+        other = create_account(username="other", email="other@example.com")
+        MediaAction.objects.create(user=self.user, media=self.media, action="watch")
+        MediaAction.objects.create(user=other, media=self.media, action="watch")
+        MediaAction.objects.create(session_key="session", media=self.media, action="watch")
+        MediaAction.objects.create(user=other, media=self.media, action="like")
+
+        self.assertEqual(rollup_media_actions(), 1)
+        rollup = MediaActionRollup.objects.get(media=self.media)
+        self.assertEqual((rollup.watches, rollup.likes, rollup.dislikes, rollup.unique_viewers), (3, 1, 0, 3))
+
+        get_list_of_popular_media()
+        [(media_id, score)] = cache.get("popular_media")
+        # 3 watches and a like of today, not decayed
+        self.assertEqual((media_id, round(score, 6)), (self.media.id, 8))
+
+        MediaAction.objects.update(action_date=timezone.now() - timedelta(days=100))
+        self.assertEqual(drop_expired_media_actions(30), 4)
+        self.assertFalse(MediaAction.objects.exists())
+        self.assertTrue(MediaActionRollup.objects.filter(media=self.media).exists())
+
+    @override_settings(MEDIA_ACTION_PARTITIONS_AHEAD=2, MEDIA_ACTIONS_RETENTION_DAYS=30)
+    def test_partitioned_media_actions(self):
+        """Test that actions are saved in monthly partitions once converted, and expired partitions are dropped"""
+        MediaAction.objects.create(user=self.user, media=self.media, action="watch")
+        # deferred foreign key checks of the rows block the conversion
+        connection.check_constraints()
+        partition_media_actions()
+        self.assertTrue(is_partitioned())
+        this_month = timezone.now().date().replace(day=1)
+        self.assertEqual(sorted(get_partitions()), [this_month, add_months(this_month, 1), add_months(this_month, 2)])
+        self.assertEqual(MediaAction.objects.count(), 1, "Actions should be copied to the partitions")
+
+        expired_month = add_months(this_month, -3)
+        create_partitions(expired_month, expired_month)
+        expired = MediaAction.objects.create(user=self.user, media=self.media, action="like")
+        MediaAction.objects.filter(id=expired.id).update(action_date=timezone.make_aware(datetime(expired_month.year, expired_month.month, 2)))
+        current = MediaAction.objects.create(session_key="session", media=self.media, action="watch")
+        self.assertEqual(MediaAction.objects.count(), 3)
+        connection.check_constraints()
+
+        with self.settings(MEDIA_ACTION_PARTITIONS_AHEAD=3):
+            self.assertEqual(maintain_media_actions(), 1, "The partition of the expired month should be dropped")
+        self.assertEqual(sorted(get_partitions()), [add_months(this_month, months) for months in range(4)])
+        self.assertFalse(MediaAction.objects.filter(id=expired.id).exists())
+        self.assertTrue(MediaAction.objects.filter(id=current.id).exists())
+
+    def test_trending_media(self):
+        """Test that show=trending pages over media ranked by their decayed actions, listable media only"""
+        get_redis_connection("default").delete(TRENDING_KEY)
+        liked = Media.objects.create(title="Liked Media", user=self.user, state="public", encoding_status="success", is_reviewed=True, listable=True)
+        hidden = Media.objects.create(title="Hidden Media", user=self.user, state="public", encoding_status="success", is_reviewed=True, listable=True)
+        other = create_account(username="other", email="other@example.com")
+
+        for user in [self.user, other]:
+            save_user_action({"user_id": user.id}, friendly_token=self.media.friendly_token, action="watch")
+            save_user_action({"user_id": user.id}, friendly_token=hidden.friendly_token, action="watch")
+        save_user_action({"user_id": self.user.id}, friendly_token=liked.friendly_token, action="like")
+        hidden.state = "private"
+        hidden.save()
+
+        response = self.client.get("/api/v1/media?show=trending")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["count"], 2)
+        self.assertEqual([item["friendly_token"] for item in response.data["results"]], [liked.friendly_token, self.media.friendly_token])
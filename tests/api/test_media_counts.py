@@ -0,0 +1,49 @@
+from django.test import TestCase
+
+from files.models import Category, Media, Tag
+from files.tests import create_account
+
+
+class TestMediaCounts(TestCase):
+    def setUp(self):
+        self.user = create_account()
+        self.category = Category.objects.create(title="Counted")
+        self.tag = Tag.objects.create(title="counted")
+        self.media = Media.objects.create(title="Counted Media", user=self.user, state="public", encoding_status="success", is_reviewed=True)
+        self.media.category.add(self.category)
+        self.media.tags.add(self.tag)
+
+    def assert_counts(self, user, category, tag):
+        self.user.refresh_from_db()
+        self.category.refresh_from_db()
+        self.tag.refresh_from_db()
+        self.assertEqual((self.user.media_count, self.category.media_count, self.tag.media_count), (user, category, tag))
+
+    def test_created(self):
+        self.assert_counts(1, 1, 1)
+        Media.objects.create(title="Other Media", user=self.user, state="public", encoding_status="success", is_reviewed=True)
+        self.assert_counts(2, 1, 1)
+
+    def test_hidden(self):
+        self.media.state = "private"
+        self.media.save()
+        # categories count all their media
+        self.assert_counts(0, 1, 0)
+
+        self.media.state = "public"
+        self.media.save()
+        self.assert_counts(1, 1, 1)
+
+    def test_deleted(self):
+        self.media.delete()
+        self.assert_counts(0, 0, 0)
+
+    def test_tagged_and_untagged(self):
+        self.media.tags.remove(self.tag)
+        self.assert_counts(1, 1, 0)
+        self.media.tags.add(self.tag)
+        self.assert_counts(1, 1, 1)
+
+        self.media.tags.clear()
+        self.media.category.clear()
+        self.assert_counts(1, 0, 0)
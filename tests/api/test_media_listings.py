@@ -1,7 +1,27 @@
+from datetime import timedelta
+from importlib.util import find_spec
+from io import StringIO
+from unittest import mock, skipUnless
+
+from django.contrib import messages
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages import get_messages
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core.cache import cache
 from django.core.files import File
-from django.test import Client, TestCase
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from files.models import Media
+from actions.models import MediaAction
+from cms.custom_pagination import KeysetPagination
+from files import recommendations, related
+from files.models import Media, MediaPermission, MediaVisibility, RelatedMedia, Tag
+from files.recommendations import build_calculated_related_media, load_interactions
+from files.response_cache import cache_anonymous_response, get_response_cache_key
 from files.tests import create_account
 
 
@@ -65,3 +85,269 @@ class TestMediaListings(TestCase):
         response = self.client.get(url)
 
         self.assertEqual(response.status_code, 200, "Recommended media endpoint should return 200")
+
+    def test_media_listing_cursor_pagination(self):
+        """Test walking the media listing with the next and previous cursors"""
+        Media.objects.filter(id=self.media.id).update(views=5)
+        for views in [5, 5, 3, 1]:
+            with open('fixtures/test_image2.jpg', "rb") as f:
+                media = Media.objects.create(title="Test Media", user=self.user, state="public", encoding_status="success", is_reviewed=True, listable=True, media_file=File(f))
+            Media.objects.filter(id=media.id).update(views=views)
+        expected = list(Media.objects.filter(listable=True).order_by("-views", "-id").values_list("friendly_token", flat=True))
+
+        with mock.patch.object(KeysetPagination, "page_size", 2):
+            response = self.client.get('/api/v1/media?sort_by=views_desc')
+            self.assertEqual(response.data['count'], 5, "First page should contain count")
+            pages = [response.data]
+            while pages[-1]['next']:
+                pages.append(self.client.get(pages[-1]['next']).data)
+            previous = self.client.get(pages[-1]['previous']).data
+
+        tokens = [item['friendly_token'] for page in pages for item in page['results']]
+        self.assertEqual(tokens, expected, "Cursor pages should follow the sort order, without gaps or repeats")
+        self.assertEqual(len(pages), 3)
+        self.assertIsNone(pages[1]['count'], "Only the first page should contain count")
+        self.assertEqual(previous['results'], pages[1]['results'], "Previous cursor should return the previous page")
+
+    def test_audit_listing_queries(self):
+        """Test the listing queries audit, and that its seeded media are rolled back"""
+        out = StringIO()
+        call_command('audit_listing_queries', seed=10, explain=True, stdout=out)
+
+        output = out.getvalue()
+        self.assertIn('Seeded 10 media', output)
+        self.assertIn('media by views:', output)
+        self.assertIn('Plans with the listing indexes', output)
+        self.assertEqual(Media.objects.count(), 1, "Seeded media should be rolled back")
+
+        out = StringIO()
+        call_command('audit_listing_queries', seed=10, share=2, user=self.user.username, stdout=out)
+        self.assertIn(f'Shared 2 media with {self.user.username}', out.getvalue())
+        self.assertFalse(MediaVisibility.objects.exists(), "Shared media should be rolled back")
+
+    def test_shared_media_listing(self):
+        """Test that media shared through a permission are listed, and hidden again once unshared"""
+        Media.objects.filter(id=self.media.id).update(listable=False, state="private")
+        other_password = 'another_fake_password'
+        other = create_account(password=other_password)
+        self.client.login(username=other.username, password=other_password)
+
+        permission = MediaPermission.objects.create(owner_user=self.user, user=other, media=self.media, permission="viewer")
+        self.assertTrue(MediaVisibility.objects.filter(user=other, media=self.media).exists())
+        for url in ['/api/v1/media', '/api/v1/media?show=shared_with_me', '/api/v1/search?q=test']:
+            response = self.client.get(url)
+            media_titles = [item['title'] for item in response.data['results']]
+            self.assertIn(self.media.title, media_titles, f"Shared media should be in {url}")
+
+        permission.delete()
+        self.assertFalse(MediaVisibility.objects.filter(user=other, media=self.media).exists())
+        response = self.client.get('/api/v1/media?show=shared_with_me')
+        self.assertEqual(response.data['results'], [], "Unshared media should not be listed")
+
+    def test_listing_without_shared_media(self):
+        """Test that users who see no shared media filter on listable only, so the partial listing indexes are used"""
+        self.client.login(username=self.user.username, password=self.password)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/v1/media?sort_by=edit_date_desc')
+        self.assertEqual([item['title'] for item in response.data['results']], [self.media.title])
+        listing = [query['sql'] for query in context.captured_queries if 'ORDER BY "files_media"."edit_date" DESC' in query['sql']]
+        self.assertEqual(len(listing), 1)
+        self.assertIn('WHERE "files_media"."listable" ORDER BY', listing[0])
+
+    @override_settings(RESPONSE_CACHE_TIMEOUT=60)
+    def test_anonymous_listing_response_cache(self):
+        """Test that anonymous listings are cached, until a media changes"""
+        url = '/api/v1/media?cache_test=1'
+        response = self.client.get(url)
+        self.assertEqual(len(response.data['results']), 1)
+
+        Media.objects.filter(id=self.media.id).update(title="Changed title")
+        response = self.client.get(url)
+        self.assertEqual(response.data['results'][0]['title'], "Test Media", "Cached response should be served")
+
+        self.media.refresh_from_db()
+        self.media.save()
+        response = self.client.get(url)
+        self.assertEqual(response.data['results'][0]['title'], "Changed title", "Saving a media should invalidate cached listings")
+
+    @override_settings(RESPONSE_CACHE_TIMEOUT=60)
+    def test_response_cache_invalidation(self):
+        """Test that saves that do not change listings keep cached listings, and invalidate the cached detail"""
+        list_url, detail_url = '/api/v1/media?cache_test=2', f'/api/v1/media/{self.media.friendly_token}'
+        self.client.get(list_url)
+        self.client.get(detail_url)
+        Media.objects.filter(id=self.media.id).update(title="Changed title")
+
+        # as the encoding steps do
+        self.media.set_init_status("success")
+        self.media.save(update_fields=["init_status"])
+        self.assertEqual(self.client.get(list_url).data['results'][0]['title'], "Test Media", "Listings should stay cached")
+        self.assertEqual(self.client.get(detail_url).data['title'], "Changed title", "Detail should be invalidated on any save")
+
+        self.media.featured = True
+        self.media.save()
+        self.assertTrue(self.client.get(list_url).data['results'][0]['featured'], "Changes of listed fields should invalidate listings")
+
+    @override_settings(RESPONSE_CACHE_TIMEOUT=60)
+    def test_response_cache_skips_messages(self):
+        """Test that responses are not cached or served from the cache for requests with messages"""
+        view = cache_anonymous_response()(lambda request: HttpResponse(str([m.message for m in get_messages(request)])))
+        request = RequestFactory().get('/cache_test/')
+        request.user = AnonymousUser()
+        request.session = self.client.session
+        request._messages = FallbackStorage(request)
+        messages.info(request, "Logged out")
+        self.assertEqual(view(request).content, b"['Logged out']")
+
+        request._messages = FallbackStorage(request)
+        self.assertEqual(view(request).content, b"[]", "A response with messages should not be cached")
+        self.assertEqual(view(request).content, b"[]")
+        request._messages = FallbackStorage(request)
+        messages.info(request, "Logged out")
+        self.assertEqual(view(request).content, b"['Logged out']", "Cached responses should not be served with messages to show")
+
+        def set_cookie(request):
+            response = HttpResponse("cookie")
+            response.set_cookie("sessionid", "anonymous")
+            return response
+
+        request = RequestFactory().get('/cache_test_cookie/')
+        request.user = AnonymousUser()
+        cache_anonymous_response()(set_cookie)(request)
+        self.assertIsNone(cache.get(get_response_cache_key(request)), "Responses that set cookies should not be cached")
+
+    def test_media_cards_follow_author_changes(self):
+        """Test that the cached listing fragments of media are rebuilt when their author changes"""
+        response = self.client.get('/api/v1/media')
+        self.assertEqual(response.data['results'][0]['author_name'], self.user.name)
+
+        self.user.name = "Renamed author"
+        self.user.save()
+        response = self.client.get('/api/v1/media')
+        self.assertEqual(response.data['results'][0]['author_name'], "Renamed author")
+
+    def test_media_listing_query_count(self):
+        """Test that the number of queries of a listing page does not grow with the media on it"""
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get('/api/v1/media')
+            return len(context.captured_queries), response
+
+        self.media.tags.add(Tag.objects.create(title="first"))
+        queries, response = count_queries()
+        self.assertEqual(len(response.data['results']), 1)
+
+        for i in range(4):
+            with open('fixtures/test_image2.jpg', "rb") as f:
+                media = Media.objects.create(title=f"Test Media {i}", user=self.user, state="public", encoding_status="success", is_reviewed=True, listable=True, media_file=File(f))
+            media.tags.add(Tag.objects.create(title=f"tag{i}"))
+
+        more_queries, response = count_queries()
+        self.assertEqual(len(response.data['results']), 5)
+        self.assertEqual(response.data['tags'], "first, tag0, tag1, tag2, tag3")
+        self.assertEqual(more_queries, queries, "Listing queries should not depend on the number of media")
+
+    def test_precomputed_related_media(self):
+        """Test that related media are read from the lists built when media change, ranked by shared tags"""
+        cache.delete("popular_media")
+        tag = Tag.objects.create(title="shared")
+        related = []
+        for i in range(3):
+            with open('fixtures/test_image2.jpg', "rb") as f:
+                related.append(Media.objects.create(title=f"Related {i}", user=create_account(), state="public", encoding_status="success", is_reviewed=True, media_file=File(f)))
+        related[0].tags.add(tag)
+        self.media.tags.add(tag)
+
+        ids = RelatedMedia.objects.get(media=self.media, strategy="content").media_ids
+        self.assertEqual(ids[0], related[0].id, "Media sharing a tag should rank first")
+        self.assertEqual(set(ids), {media.id for media in related}, "Lists should be filled up with other listable media")
+
+        response = self.client.get(f'/api/v1/media/{self.media.friendly_token}')
+        self.assertEqual({item['friendly_token'] for item in response.data['related_media']}, {media.friendly_token for media in related})
+
+    def test_related_media_queued_on_changes(self):
+        """Test that saves queue related media only when the title or listability change"""
+        with mock.patch.object(related, "queue_related_media") as queue:
+            self.media.featured = True
+            self.media.save()
+            queue.assert_not_called()
+
+            self.media.title = "Renamed Media"
+            self.media.save()
+            queue.assert_called_once_with([self.media.id])
+
+    def test_stale_related_media(self):
+        """Test that only media with missing or old related media are queued once a day"""
+        with open('fixtures/test_image2.jpg', "rb") as f:
+            other = Media.objects.create(title="Other", user=self.user, state="public", encoding_status="success", is_reviewed=True, media_file=File(f))
+        missing = Media.objects.create(title="Missing", user=self.user, state="public", encoding_status="success", is_reviewed=True)
+        RelatedMedia.objects.filter(media=other).update(update_date=timezone.now() - timedelta(days=30))
+        RelatedMedia.objects.filter(media=missing).delete()
+
+        with mock.patch.object(related, "queue_related_media") as queue:
+            self.assertEqual(related.queue_stale_related_media(), 2)
+        self.assertEqual(sorted(queue.call_args.args[0]), sorted([other.id, missing.id]))
+
+    def test_related_media_of_cleared_tag(self):
+        """Test that clearing the media of a tag queues them, as they are not known after the clear"""
+        tag = Tag.objects.create(title="cleared")
+        self.media.tags.add(tag)
+
+        with mock.patch.object(related, "queue_related_media", wraps=related.queue_related_media) as queue:
+            tag.media_set.clear()
+        queue.assert_called_once_with([self.media.id])
+
+    def test_load_interactions(self):
+        """Test that watches and likes of listable media are loaded, weighted by action"""
+        liked = Media.objects.create(title="Liked", user=create_account(), state="public", encoding_status="success", is_reviewed=True)
+        hidden = Media.objects.create(title="Hidden", user=create_account(), encoding_status="success", is_reviewed=True)
+        # new media get the default state
+        hidden.state = "private"
+        hidden.save()
+        MediaAction.objects.create(user=self.user, media=self.media, action="watch")
+        MediaAction.objects.create(user=self.user, media=liked, action="like")
+        MediaAction.objects.create(session_key="session", media=self.media, action="watch")
+        MediaAction.objects.create(session_key="session", media=liked, action="dislike")
+        MediaAction.objects.create(user=self.user, media=hidden, action="watch")
+
+        rows, cols, weights, media_ids = load_interactions(timezone.now() - timedelta(days=1))
+        self.assertEqual(sorted(media_ids), sorted([self.media.id, liked.id]))
+        self.assertEqual(len(set(rows)), 2, "The user and the anonymous session should be two actors")
+        self.assertEqual(sorted((media_ids[col], weight) for col, weight in zip(cols, weights)), sorted([(self.media.id, 1), (self.media.id, 1), (liked.id, 2)]))
+
+    @override_settings(RELATED_MEDIA_STORED=5, RELATED_MEDIA_CALCULATED_MIN_COWATCH=2, RELATED_MEDIA_CALCULATED_CHUNK=10)
+    def test_build_calculated_related_media(self):
+        """Test that calculated lists are saved from the neighbours of media, and lists without neighbours are deleted"""
+        others = [Media.objects.create(title=f"Other {i}", user=create_account(), state="public", encoding_status="success", is_reviewed=True) for i in range(2)]
+        RelatedMedia.objects.create(media=others[1], strategy="calculated", media_ids=[self.media.id])
+
+        neighbours = [(self.media.id, [others[0].id]), (others[0].id, [self.media.id]), (others[1].id, [])]
+        with mock.patch.object(recommendations, "get_cowatch_neighbours", return_value=iter(neighbours)) as get_neighbours:
+            self.assertEqual(build_calculated_related_media(), 2)
+        self.assertEqual(get_neighbours.call_args.kwargs, {"size": 5, "min_cowatch": 2, "chunk": 10})
+        self.assertEqual(RelatedMedia.objects.get(media=self.media, strategy="calculated").media_ids, [others[0].id])
+        self.assertFalse(RelatedMedia.objects.filter(media=others[1], strategy="calculated").exists(), "Lists of media without neighbours should be deleted")
+
+    @skipUnless(find_spec("scipy"), "needs the packages of requirements-full.txt")
+    @override_settings(RELATED_MEDIA_STRATEGY="calculated", RELATED_MEDIA_CALCULATED_MIN_COWATCH=2)
+    def test_calculated_related_media(self):
+        """Test that calculated related media are the media watched by the same users"""
+        others = []
+        for i in range(2):
+            with open('fixtures/test_image2.jpg', "rb") as f:
+                others.append(Media.objects.create(title=f"Other {i}", user=create_account(), state="public", encoding_status="success", is_reviewed=True, media_file=File(f)))
+        cowatched, watched_once = others
+        for user in (self.user, create_account()):
+            MediaAction.objects.create(user=user, media=self.media, action="watch")
+            MediaAction.objects.create(user=user, media=cowatched, action="watch")
+        MediaAction.objects.create(user=self.user, media=watched_once, action="watch")
+
+        build_calculated_related_media()
+        ids = RelatedMedia.objects.get(media=self.media, strategy="calculated").media_ids
+        self.assertEqual(ids, [cowatched.id], "Only media watched by enough of the same users should be related")
+
+        response = self.client.get(f'/api/v1/media/{self.media.friendly_token}')
+        tokens = [item['friendly_token'] for item in response.data['related_media']]
+        self.assertIn(cowatched.friendly_token, tokens)
+        self.assertIn(watched_once.friendly_token, tokens, "Calculated media should be filled up with content related media")
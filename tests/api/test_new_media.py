@@ -1,8 +1,15 @@
+import os
+import tempfile
 import uuid
+from unittest import mock
 
+from django.contrib.postgres.search import SearchQuery
+from django.core.files import File
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import Client, TestCase
 
-from files.models import Encoding, Media
+from files.methods import copy_video
+from files.models import Encoding, Media, Tag
 from files.tests import create_account
 
 API_V1_LOGIN_URL = '/api/v1/login'
@@ -26,14 +33,16 @@ class TestX(TestCase):
         # because celery is started with setting task_always_eager
         # practically this means that this testing will take some time, but
         # ensures that video transcoding completes well
-        with open('fixtures/small_video.mp4', 'rb') as fp:
-            client.post('/api/v1/media', {'title': 'small video file test', 'media_file': fp})
+        # media_init starts once the media is committed
+        with self.captureOnCommitCallbacks(execute=True):
+            with open('fixtures/small_video.mp4', 'rb') as fp:
+                client.post('/api/v1/media', {'title': 'small video file test', 'media_file': fp})
 
-        with open('fixtures/test_image.png', 'rb') as fp:
-            client.post('/api/v1/media', {'title': 'image file test', 'media_file': fp})
+            with open('fixtures/test_image.png', 'rb') as fp:
+                client.post('/api/v1/media', {'title': 'image file test', 'media_file': fp})
 
-        with open('fixtures/medium_video.mp4', 'rb') as fp:
-            client.post('/fu/upload/', {'qqfile': fp, 'qqfilename': 'medium_video.mp4', 'qquuid': str(uuid.uuid4())})
+            with open('fixtures/medium_video.mp4', 'rb') as fp:
+                client.post('/fu/upload/', {'qqfile': fp, 'qqfilename': 'medium_video.mp4', 'qquuid': str(uuid.uuid4())})
 
         self.assertEqual(Media.objects.all().count(), 3, "Problem with file upload")
         # by default the portal_workflow is public, so anything uploaded gets public
@@ -48,3 +57,64 @@ class TestX(TestCase):
         # using the provided EncodeProfiles, these two files should produce 9 Encoding objects.
         # if new EncodeProfiles are added and enabled, this will break!
         self.assertEqual(Encoding.objects.filter(status='success').count(), 10, "Not all video transcodings finished well")
+
+    def test_copy_video(self):
+        """Test that copies, made without Media.save, are listable, searchable and counted"""
+        with open('fixtures/test_image2.jpg', "rb") as f:
+            media = Media.objects.create(title="Original", user=self.user, state="public", encoding_status="success", is_reviewed=True, media_file=File(f))
+        media.tags.add(Tag.objects.create(title="copied"))
+
+        copy = copy_video(media, copy_encodings=False, title_suffix="(Copy)")
+        copy.refresh_from_db()
+        self.assertTrue(copy.listable, "Copy should be listable like the original")
+        self.assertIsNotNone(copy.search, "Copy should get a search vector")
+        self.assertTrue(Media.objects.filter(id=copy.id, search=SearchQuery("copied:*", search_type="raw")).exists(), "Tags of the copy should be searchable")
+        with open(copy.media_file.path, "rb") as copied, open(media.media_file.path, "rb") as original:
+            self.assertEqual(copied.read(), original.read())
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.media_count, 2)
+        self.assertEqual(Tag.objects.get(title="copied").media_count, 2)
+
+    def test_copy_video_segment(self):
+        """Test that a segment moved in place of the copied file keeps the name of the original, and gets its own size"""
+        with open('fixtures/test_image2.jpg', "rb") as f:
+            media = Media.objects.create(title="Original", user=self.user, media_file=File(f))
+        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as f:
+            f.write(b"0" * 300000)
+
+        copy = copy_video(media, copy_encodings=False, media_file_path=f.name, file_suffix="_trimmed_1")
+        self.assertEqual(os.path.basename(copy.media_file.name), f"{copy.uid.hex}.test_image2_trimmed_1.jpg")
+        self.assertEqual(copy.size, "0.3MB")
+        self.assertFalse(os.path.exists(f.name), "Segment should be moved, not copied")
+
+    def test_media_init_on_commit(self):
+        """Test that media_init starts once the media is committed, and runs its steps in order"""
+        statuses = []
+        set_init_status = Media.set_init_status
+
+        def record_init_status(media, init_status):
+            statuses.append(init_status)
+            set_init_status(media, init_status)
+
+        with mock.patch.object(Media, "set_init_status", autospec=True, side_effect=record_init_status):
+            with self.captureOnCommitCallbacks() as callbacks:
+                with open('fixtures/test_image2.jpg', "rb") as f:
+                    media = Media.objects.create(title="Image", user=self.user, media_file=File(f))
+            self.assertEqual(len(callbacks), 1)
+            self.assertEqual(Media.objects.get(id=media.id).init_status, "pending", "media_init should not run before the commit")
+
+            callbacks[0]()
+        media.refresh_from_db()
+        self.assertEqual(statuses, ["probing", "thumbnails", "success"])
+        self.assertEqual(media.init_status, "success")
+        self.assertEqual(media.media_type, "image")
+        self.assertTrue(media.thumbnail)
+
+    def test_media_init_fail(self):
+        """Test that media_init stops after a file of a type that is not allowed"""
+        with self.captureOnCommitCallbacks(execute=True):
+            media = Media.objects.create(title="Text", user=self.user, media_file=SimpleUploadedFile("notes.txt", b"not a media file"))
+        media.refresh_from_db()
+        self.assertEqual(media.init_status, "fail")
+        self.assertFalse(media.thumbnail, "Steps after a failed one should not run")
+        self.assertFalse(Encoding.objects.filter(media=media).exists())
@@ -0,0 +1,48 @@
+from unittest import mock
+
+from django.test import TestCase, override_settings
+
+from files import visibility
+from files.models import Category, Media, MediaVisibility
+from files.tests import create_account
+from rbac.models import RBACGroup, RBACMembership
+
+
+@override_settings(USE_RBAC=True)
+class TestRBACAccess(TestCase):
+    def setUp(self):
+        self.user = create_account()
+        self.category = Category.objects.create(title="RBAC category", is_rbac_category=True)
+        self.group = RBACGroup.objects.create(name="RBAC group")
+
+    def test_cached_categories_follow_rbac_changes(self):
+        """Test that the cached RBAC categories of a user are invalidated by memberships and group categories"""
+        self.assertFalse(self.user.has_member_access_to_category(self.category))
+
+        membership = RBACMembership.objects.create(user=self.user, rbac_group=self.group, role="member")
+        self.assertFalse(self.user.has_member_access_to_category(self.category))
+
+        self.group.categories.add(self.category)
+        self.assertTrue(self.user.has_member_access_to_category(self.category))
+        self.assertEqual(list(self.user.get_rbac_categories_as_member()), [self.category])
+        self.assertEqual(list(self.user.get_rbac_categories_as_contributor()), [])
+
+        membership.role = "contributor"
+        membership.save()
+        self.assertEqual(list(self.user.get_rbac_categories_as_contributor()), [self.category])
+
+        self.category.rbac_groups.clear()
+        self.assertFalse(self.user.has_member_access_to_category(self.category))
+
+    def test_delete_rbac_category(self):
+        """Test that the media of a deleted RBAC category are queued, and stop being visible to its members"""
+        RBACMembership.objects.create(user=self.user, rbac_group=self.group, role="member")
+        self.group.categories.add(self.category)
+        media = Media.objects.create(title="RBAC media", user=create_account(), state="private")
+        media.category.add(self.category)
+        self.assertTrue(MediaVisibility.objects.filter(user=self.user, media=media).exists())
+
+        with mock.patch.object(visibility, "queue_media_visibility", wraps=visibility.queue_media_visibility) as queue:
+            self.category.delete()
+        queue.assert_called_once_with(media=[media.id])
+        self.assertFalse(MediaVisibility.objects.filter(user=self.user, media=media).exists())
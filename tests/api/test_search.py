@@ -1,6 +1,12 @@
+from unittest import mock
+
+from django.contrib.postgres.search import SearchQuery
+from django.core.cache import cache
 from django.core.files import File
 from django.test import Client, TestCase
+from django.utils import timezone
 
+from files import search_index
 from files.models import Category, Media, Tag
 from files.tests import create_account
 
@@ -14,27 +20,32 @@ class TestSearch(TestCase):
         self.user = create_account(password=self.password)
 
         # Create test media items with different attributes for search testing
-        with open('fixtures/test_image2.jpg', "rb") as f:
-            myfile = File(f)
-            self.media1 = Media.objects.create(title="Python Tutorial", description="Learn Python programming", user=self.user, media_file=myfile)
-
-        with open('fixtures/test_image2.jpg', "rb") as f:
-            myfile = File(f)
-            self.media2 = Media.objects.create(
-                title="Django Framework",
-                description="Web development with Django",
-                user=self.user,
-                media_file=myfile,
-            )
-
-        with open('fixtures/test_image2.jpg', "rb") as f:
-            myfile = File(f)
-            self.media3 = Media.objects.create(
-                title="JavaScript Basics",
-                description="Introduction to JavaScript",
-                user=self.user,
-                media_file=myfile,
-            )
+        # media_init, that makes them listable, starts once they are committed
+        with self.captureOnCommitCallbacks(execute=True):
+            with open('fixtures/test_image2.jpg', "rb") as f:
+                myfile = File(f)
+                self.media1 = Media.objects.create(title="Python Tutorial", description="Learn Python programming", user=self.user, media_file=myfile)
+
+            with open('fixtures/test_image2.jpg', "rb") as f:
+                myfile = File(f)
+                self.media2 = Media.objects.create(
+                    title="Django Framework",
+                    description="Web development with Django",
+                    user=self.user,
+                    media_file=myfile,
+                )
+
+            with open('fixtures/test_image2.jpg', "rb") as f:
+                myfile = File(f)
+                self.media3 = Media.objects.create(
+                    title="JavaScript Basics",
+                    description="Introduction to JavaScript",
+                    user=self.user,
+                    media_file=myfile,
+                )
+        for media in (self.media1, self.media2, self.media3):
+            media.refresh_from_db()
+
         # Add categories and tags
         self.category = Category.objects.first()
         self.tag = Tag.objects.create(title="programming", user=self.user)
@@ -96,14 +107,15 @@ class TestSearch(TestCase):
         self.assertEqual(response.status_code, 200, "Media type filtered search should return 200")
 
         # Create an image media with the same search term
-        with open('fixtures/test_image2.jpg', "rb") as f:
-            myfile = File(f)
-            image_media = Media.objects.create(
-                title="Tutorial Image",
-                description="Tutorial image description",
-                user=self.user,
-                media_file=myfile,
-            )
+        with self.captureOnCommitCallbacks(execute=True):
+            with open('fixtures/test_image2.jpg', "rb") as f:
+                myfile = File(f)
+                image_media = Media.objects.create(
+                    title="Tutorial Image",
+                    description="Tutorial image description",
+                    user=self.user,
+                    media_file=myfile,
+                )
         image_media.update_search_vector()
 
         # Search with media_type=video
@@ -112,3 +124,97 @@ class TestSearch(TestCase):
 
         media_titles = [item['title'] for item in response.data['results']]
         self.assertNotIn(image_media.title, media_titles, "Image media should not be in results")
+
+    def test_search_sort_by_relevance(self):
+        """Test that title matches rank above description matches"""
+        with self.captureOnCommitCallbacks(execute=True):
+            with open('fixtures/test_image2.jpg', "rb") as f:
+                myfile = File(f)
+                description_media = Media.objects.create(
+                    title="Web Basics",
+                    description="A python introduction",
+                    user=self.user,
+                    media_file=myfile,
+                )
+        description_media.update_search_vector()
+
+        url = '/api/v1/search?q=python&sort_by=relevance'
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200, "Search sorted by relevance should return 200")
+        media_titles = [item['title'] for item in response.data['results']]
+        self.assertEqual(media_titles[0], self.media1.title, "Media with 'Python' in title should rank first")
+        self.assertIn(description_media.title, media_titles, "Media with 'Python' in description should be in results")
+
+    def test_search_suggest(self):
+        """Test search as you type suggestions"""
+        cache.delete("search_suggest:progr")
+        self.media1.title = "Programming in Python"
+        self.media1.save()
+
+        url = '/api/v1/search/suggest?q=progr'
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200, "Suggest endpoint should return 200")
+        self.assertIn(self.tag.title, response.data['tags'], "Tag containing the text should be suggested")
+        self.assertIn("Programming in Python", response.data['media'], "Listable media title containing the text should be suggested")
+        self.assertNotIn(self.media2.title, response.data['media'], "Media title not containing the text should not be suggested")
+
+
+class TestSearchIndex(TestCase):
+    def setUp(self):
+        self.user = create_account()
+        self.media = Media.objects.create(title="Indexed Media", user=self.user, state="public", encoding_status="success", is_reviewed=True)
+        self.tag = Tag.objects.create(title="wombat")
+
+    def is_indexed(self, word):
+        return Media.objects.filter(id=self.media.id, search=SearchQuery(f"{word}:*", search_type="raw")).exists()
+
+    def test_title_change(self):
+        """Test that a change of the title queues the media and rebuilds its vector"""
+        self.assertTrue(self.is_indexed("indexed"))
+        self.media.title = "Renamed kangaroo"
+        with mock.patch.object(search_index, "queue_search_index", wraps=search_index.queue_search_index) as queue:
+            self.media.save()
+        queue.assert_called_once_with([self.media.id])
+        self.assertTrue(self.is_indexed("kangaroo"))
+        self.assertFalse(self.is_indexed("indexed"))
+
+    def test_non_text_save(self):
+        """Test that saves that do not change the searched text do not queue the media"""
+        self.media.featured = True
+        self.media.views = 10
+        with mock.patch.object(search_index, "queue_search_index") as queue:
+            self.media.save()
+        queue.assert_not_called()
+
+    def test_author_change(self):
+        """Test that media are reindexed when their author is renamed, and not on other saves of the author"""
+        with mock.patch.object(search_index, "queue_search_index") as queue:
+            self.user.last_login = timezone.now()
+            self.user.save()
+        queue.assert_not_called()
+
+        self.user.name = "Platypus"
+        with mock.patch.object(search_index, "queue_search_index", wraps=search_index.queue_search_index) as queue:
+            self.user.save()
+        queue.assert_called_once_with([self.media.id])
+        self.assertTrue(self.is_indexed("platypus"))
+
+    def test_tag_add_and_clear(self):
+        """Test that tags added and cleared from either side are reindexed"""
+        self.media.tags.add(self.tag)
+        self.assertTrue(self.is_indexed("wombat"))
+        self.media.tags.clear()
+        self.assertFalse(self.is_indexed("wombat"))
+
+        self.tag.media_set.add(self.media)
+        self.assertTrue(self.is_indexed("wombat"))
+        self.tag.media_set.clear()
+        self.assertFalse(self.is_indexed("wombat"))
+
+    def test_tag_delete(self):
+        """Test that media of a deleted tag are reindexed"""
+        self.media.tags.add(self.tag)
+        self.tag.delete()
+        self.assertFalse(self.is_indexed("wombat"))
@@ -0,0 +1,79 @@
+import os
+import tempfile
+
+import pytest
+from django.test import Client, TestCase, override_settings
+
+from files.tests.benchmark_utils import (
+    get_regressions,
+    load_baseline,
+    measure,
+    save_baseline,
+    seed_benchmark_data,
+)
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+SCALE = int(os.environ.get("BENCHMARK_SCALE", 10000))
+ROUNDS = int(os.environ.get("BENCHMARK_ROUNDS", 20))
+TOLERANCE = float(os.environ.get("BENCHMARK_TOLERANCE", 0.25))
+
+
+@pytest.mark.slow
+@pytest.mark.skipif(not os.environ.get("BENCHMARK"), reason="set BENCHMARK=1 to run the benchmarks")
+@override_settings(USE_RBAC=True, MEDIA_ROOT=tempfile.mkdtemp())
+class TestAPIBenchmarks(TestCase):
+    """Query count, latency and memory of the main endpoints
+
+    Run with BENCHMARK=1 and optionally BENCHMARK_SCALE (number of media,
+    default 10000). Measurements are compared with baseline.json, recorded
+    per scale, and fail if an endpoint has no baseline; set
+    BENCHMARK_UPDATE_BASELINE=1 to record them instead. The recorded
+    baseline is of the machine in docs/developers_docs.md, latency is only
+    comparable with a baseline of the same machine
+    """
+
+    fixtures = ["fixtures/categories.json", "fixtures/encoding_profiles.json"]
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed_benchmark_data(SCALE)
+
+    def get_endpoints(self):
+        token = self.data["media"].friendly_token
+        return {
+            "media_list": "/api/v1/media",
+            "media_list_views": "/api/v1/media?sort_by=views",
+            "media_search": "/api/v1/search?q=benchmark",
+            "media_search_category": "/api/v1/search?c=bench%20category%201",
+            "media_detail": f"/api/v1/media/{token}",
+            "playlist_detail": f"/api/v1/playlists/{self.data['playlist'].friendly_token}",
+            "comment_detail": f"/api/v1/media/{token}/comments",
+            "rss": "/rss/",
+            "rss_search": "/rss/search?q=benchmark",
+            "cytube_manifest": f"/api/v1/media/{token}/cytube-manifest/",
+        }
+
+    def test_endpoints(self):
+        anonymous = Client()
+        member = Client()
+        member.force_login(self.data["member"])
+
+        results = {}
+        for name, url in self.get_endpoints().items():
+            for user, client in (("anonymous", anonymous), ("member", member)):
+                results[f"{name}:{user}"] = measure(lambda: self.assertEqual(client.get(url).status_code, 200, url), ROUNDS)
+
+        baseline = load_baseline(BASELINE_PATH)
+        if os.environ.get("BENCHMARK_UPDATE_BASELINE"):
+            baseline[str(SCALE)] = results
+            save_baseline(BASELINE_PATH, baseline)
+            return
+
+        # a missing baseline fails, so that the gate can not pass unchecked
+        recorded = baseline.get(str(SCALE), {})
+        missing = [name for name in results if name not in recorded]
+        self.assertEqual(missing, [], f"No baseline for scale {SCALE}, run with BENCHMARK_UPDATE_BASELINE=1 to record it")
+        regressions = []
+        for name, result in results.items():
+            regressions.extend(f"{name}: {regression}" for regression in get_regressions(result, recorded[name], TOLERANCE))
+        self.assertEqual(regressions, [], "Endpoints regressed against the benchmark baseline")
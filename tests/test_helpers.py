@@ -0,0 +1,103 @@
+import os
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from files import helpers
+from files.helpers import copy_file, get_segment_pieces
+
+
+class TestSegmentPieces(SimpleTestCase):
+    def test_disjoint_segments(self):
+        timestamps = [
+            {"startTime": "00:00:10.000", "endTime": "00:00:20.000"},
+            {"startTime": "00:00:30.000", "endTime": "00:00:40.000"},
+        ]
+        boundaries, pieces = get_segment_pieces(timestamps)
+        self.assertEqual(boundaries, [10.0, 20.0, 30.0, 40.0])
+        self.assertEqual(pieces, [[1], [3]])
+
+    def test_segment_from_start(self):
+        timestamps = [
+            {"startTime": "00:00:00.000", "endTime": "00:00:20.000"},
+            {"startTime": "00:00:20.000", "endTime": "00:01:00.000"},
+        ]
+        boundaries, pieces = get_segment_pieces(timestamps)
+        self.assertEqual(boundaries, [20.0, 60.0])
+        self.assertEqual(pieces, [[0], [1]])
+
+    def test_overlapping_segments(self):
+        timestamps = [
+            {"startTime": "00:00:10.000", "endTime": "00:00:30.000"},
+            {"startTime": "00:00:20.000", "endTime": "00:00:40.000"},
+        ]
+        boundaries, pieces = get_segment_pieces(timestamps)
+        self.assertEqual(boundaries, [10.0, 20.0, 30.0, 40.0])
+        self.assertEqual(pieces, [[1, 2], [2, 3]])
+
+
+class TestCopyFile(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.dir.name, "source.mp4")
+        self.target = os.path.join(self.dir.name, "copies", "target.mp4")
+        self.content = os.urandom(1024 * 1024 + 17)
+        with open(self.source, "wb") as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def read_target(self):
+        with open(self.target, "rb") as f:
+            return f.read()
+
+    def test_reflink(self):
+        with mock.patch.object(helpers.fcntl, "ioctl", return_value=0) as ioctl:
+            self.assertEqual(copy_file(self.source, self.target), "reflink")
+        ioctl.assert_called_once()
+
+    def test_hard_link(self):
+        with mock.patch.object(helpers.fcntl, "ioctl", side_effect=OSError):
+            self.assertEqual(copy_file(self.source, self.target), "link")
+        self.assertTrue(os.path.samefile(self.source, self.target))
+        self.assertEqual(self.read_target(), self.content)
+
+    def test_copy_file_range(self):
+        if not hasattr(os, "copy_file_range"):
+            self.skipTest("os.copy_file_range is not available")
+        with mock.patch.object(helpers.fcntl, "ioctl", side_effect=OSError), mock.patch.object(helpers.os, "link", side_effect=OSError):
+            self.assertEqual(copy_file(self.source, self.target), "copy_file_range")
+        self.assertFalse(os.path.samefile(self.source, self.target))
+        self.assertEqual(self.read_target(), self.content)
+
+    def test_copy_without_link(self):
+        if not hasattr(os, "copy_file_range"):
+            self.skipTest("os.copy_file_range is not available")
+        with mock.patch.object(helpers.fcntl, "ioctl", side_effect=OSError), mock.patch.object(helpers.os, "link") as link:
+            self.assertEqual(copy_file(self.source, self.target, allow_link=False), "copy_file_range")
+        link.assert_not_called()
+        self.assertEqual(self.read_target(), self.content)
+
+    def test_streamed_copy(self):
+        with (
+            mock.patch.object(helpers.fcntl, "ioctl", side_effect=OSError),
+            mock.patch.object(helpers.os, "link", side_effect=OSError),
+            mock.patch.object(helpers.os, "copy_file_range", side_effect=OSError, create=True),
+        ):
+            self.assertEqual(copy_file(self.source, self.target), "copy")
+        self.assertEqual(self.read_target(), self.content)
+
+    def test_hard_link_survives_rewrite(self):
+        """Original files are replaced, not written in place, eg by trim_video_method"""
+        with mock.patch.object(helpers.fcntl, "ioctl", side_effect=OSError):
+            self.assertEqual(copy_file(self.source, self.target), "link")
+
+        trimmed = os.path.join(self.dir.name, "trimmed.mp4")
+        with open(trimmed, "wb") as f:
+            f.write(b"trimmed")
+        helpers.rm_file(self.source)
+        os.rename(trimmed, self.source)
+
+        self.assertEqual(self.read_target(), self.content)
@@ -1,12 +1,14 @@
+import hashlib
 import os
 import re
 import shutil
 import uuid
-from io import StringIO
 from os.path import join
 
 from django.conf import settings
 
+from files.helpers import copy_file_object
+
 from . import utils
 
 
@@ -20,6 +22,10 @@ def is_valid_uuid_format(uuid_string):
     return bool(pattern.match(uuid_string))
 
 
+class PartChecksumError(ValueError):
+    """A part does not match its md5"""
+
+
 class BaseFineUploader(object):
     def __init__(self, data, *args, **kwargs):
         self.data = data
@@ -67,9 +73,11 @@ class BaseFineUploader(object):
 class ChunkedFineUploader(BaseFineUploader):
     concurrent = True
 
-    def __init__(self, data, concurrent=True, *args, **kwargs):
+    def __init__(self, data, concurrent=True, session=None, *args, **kwargs):
         super(ChunkedFineUploader, self).__init__(data, *args, **kwargs)
         self.concurrent = concurrent
+        # UploadSession, required for chunked uploads
+        self.session = session
         self.total_parts = data.get("qqtotalparts")
         if not isinstance(self.total_parts, int):
             self.total_parts = 1
@@ -78,6 +86,7 @@ class ChunkedFineUploader(BaseFineUploader):
             # something nasty client side could be happening here
             qqpartindex = 0
         self.part_index = qqpartindex
+        self.part_md5 = data.get("qqpartmd5") or None
 
     @property
     def chunks_path(self):
@@ -99,27 +108,100 @@ class ChunkedFineUploader(BaseFineUploader):
     def is_time_to_combine_chunks(self):
         return self.total_parts - 1 == self.part_index
 
-    def combine_chunks(self):
-        # implement the same behaviour.
-        self.real_path = self.storage.save(self._full_file_path, StringIO())
+    def assemble_chunks(self, blocking=False):
+        """Append to the combined file the parts that are next in order
 
-        with self.storage.open(self.real_path, "wb") as final_file:
-            for i in range(self.total_parts):
-                part = join(self.chunks_path, str(i))
-                with self.storage.open(part, "rb") as source:
-                    final_file.write(source.read())
-        shutil.rmtree(self._abs_chunks_path)
+        Parts can arrive in any order, so every part request appends what it
+        can and the final request only has to deal with the parts that were late.
+        The combined file is written in place, at the name kept in the session
 
-    def _save_chunk(self):
-        return self.storage.save(self.chunk_file, self.file)
+        Args:
+            blocking: Wait for another request that is assembling, instead of
+                leaving the work to it
 
-    def save(self):
+        Returns:
+            int: Number of parts in the combined file, None if not assembled now
+        """
+        lock = self.session.lock()
+        if not lock.acquire(blocking=blocking):
+            return None
+        try:
+            assembled, size = self.session.get_assembled()
+            parts = self.session.get_parts()
+            path = self.storage.path(self.session.data["name"])
+            # not opened for append, since copy_file_range does not support it
+            with open(os.open(path, os.O_WRONLY | os.O_CREAT, 0o666), "wb") as final_file:
+                # drop anything written after the last recorded part
+                final_file.truncate(size)
+                final_file.seek(size)
+                while assembled < self.total_parts and assembled in parts:
+                    part = self.storage.path(join(self.chunks_path, str(assembled)))
+                    try:
+                        if os.path.getsize(part) != parts[assembled]["size"]:
+                            # replaced by a part that is being sent again
+                            break
+                        with open(part, "rb") as source:
+                            copy_file_object(source, final_file)
+                    except FileNotFoundError:
+                        # part is being sent again, it gets assembled once saved
+                        break
+                    final_file.flush()
+                    size = final_file.tell()
+                    assembled += 1
+                    self.session.set_assembled(assembled, size)
+                    os.remove(part)
+        finally:
+            lock.release()
+        return assembled
+
+    def combine_chunks(self):
+        """Assemble the parts that are left and finish the upload
+
+        Raises:
+            FileNotFoundError: If any part has not been received. What was
+                assembled is kept, so the upload can be resumed
+        """
+        if self.assemble_chunks(blocking=True) != self.total_parts:
+            raise FileNotFoundError(f"Upload {self.uuid} is missing parts")
+        self.real_path = self.session.data["name"]
+        shutil.rmtree(self._abs_chunks_path, ignore_errors=True)
+
+    def get_part_md5(self):
+        md5 = hashlib.md5(usedforsecurity=False)
+        for data in self.file.chunks():
+            md5.update(data)
+        return md5.hexdigest()
+
+    def _save_chunk(self, md5):
+        # a part that is sent again replaces the one received before,
+        # instead of being saved with another name
+        self.storage.delete(self.chunk_file)
+        chunk = self.storage.save(self.chunk_file, self.file)
+        self.session.add_part(self.part_index, self.file.size, md5)
+        return chunk
+
+    def save(self, name=None):
+        """Save the file, or a part of it
+
+        Raises:
+            PartChecksumError: If a part does not match the md5 sent with it,
+                or is already assembled with other content
+        """
         if self.chunked:
-            chunk = self._save_chunk()
+            md5 = self.get_part_md5()
+            if self.part_md5 and self.part_md5.lower() != md5:
+                raise PartChecksumError(f"Part {self.part_index} of upload {self.uuid} does not match its md5")
+            if self.part_index < self.session.get_assembled()[0]:
+                # already in the combined file, sent again by a resumed upload
+                if self.session.get_parts().get(self.part_index, {}).get("md5") != md5:
+                    raise PartChecksumError(f"Part {self.part_index} of upload {self.uuid} is already assembled with other content")
+                return self.chunk_file
+            chunk = self._save_chunk(md5)
             if not self.concurrent and self.is_time_to_combine_chunks:
                 self.combine_chunks()
                 return self.real_path
+            self.assemble_chunks()
             return chunk
         else:
-            self.real_path = self.storage.save(self._full_file_path, self.file)
+            self.real_path = self.storage.save(name or self._full_file_path, self.file)
             return self.real_path
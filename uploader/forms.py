@@ -10,6 +10,8 @@ class FineUploaderUploadForm(forms.Form):
     qqtotalparts = forms.IntegerField(required=False)
     qqtotalfilesize = forms.IntegerField(required=False)
     qqpartbyteoffset = forms.IntegerField(required=False)
+    # md5 of the part, sent by clients that want it checked
+    qqpartmd5 = forms.CharField(required=False)
 
 
 class FineUploaderUploadSuccessForm(forms.Form):
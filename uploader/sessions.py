@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.cache import cache
+
+
+class UploadSession(object):
+    """Manifest of a chunked upload, kept in the cache
+
+    Every received part is stored on its own key, with its size and md5,
+    so concurrent part requests never overwrite each other. The session also
+    holds the uid and media file name the upload will get, so that parts can
+    be assembled in place while the rest are still arriving.
+    """
+
+    def __init__(self, uuid):
+        self.uuid = uuid
+        self.key = f"upload_session:{uuid}"
+        self._data = None
+
+    @property
+    def timeout(self):
+        return settings.UPLOAD_SESSION_TIMEOUT
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = cache.get(self.key)
+        return self._data
+
+    @property
+    def exists(self):
+        return self.data is not None
+
+    def _part_key(self, index):
+        return f"{self.key}:part:{index}"
+
+    @property
+    def _assembled_key(self):
+        return f"{self.key}:assembled"
+
+    def start(self, user, total_parts, uid, name):
+        """Create the session, unless a concurrent request already did
+
+        Returns:
+            bool: Whether the session was created by this call
+        """
+        data = {"user": user.id, "total_parts": total_parts, "uid": uid.hex, "name": name}
+        created = cache.add(self.key, data, self.timeout)
+        self._data = None
+        return created
+
+    def add_part(self, index, size, md5):
+        cache.set(self._part_key(index), {"size": size, "md5": md5}, self.timeout)
+        # keep the session alive for as long as parts are arriving
+        cache.touch(self.key, self.timeout)
+
+    def get_parts(self):
+        """Get the parts received so far
+
+        Returns:
+            dict: part index -> {"size", "md5"}
+        """
+        keys = {self._part_key(index): index for index in range(self.data["total_parts"])}
+        return {keys[key]: part for key, part in cache.get_many(keys.keys()).items()}
+
+    def get_assembled(self):
+        """Get how many parts, and bytes, are already in the combined file"""
+        assembled = cache.get(self._assembled_key) or {"parts": 0, "size": 0}
+        return assembled["parts"], assembled["size"]
+
+    def set_assembled(self, parts, size):
+        cache.set(self._assembled_key, {"parts": parts, "size": size}, self.timeout)
+
+    def lock(self):
+        return cache.lock(f"{self.key}:lock", timeout=60 * 10)
+
+    def status(self):
+        parts = self.get_parts()
+        assembled_parts, assembled_size = self.get_assembled()
+        return {
+            "uuid": str(self.uuid),
+            "total_parts": self.data["total_parts"],
+            "assembled_parts": assembled_parts,
+            "assembled_size": assembled_size,
+            "parts": [{"index": index, **parts[index]} for index in sorted(parts)],
+        }
+
+    def delete(self):
+        keys = [self.key, self._assembled_key] + [self._part_key(index) for index in range(self.data["total_parts"])]
+        cache.delete_many(keys)
+        self._data = None
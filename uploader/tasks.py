@@ -0,0 +1,128 @@
+import hashlib
+import os
+import re
+import subprocess
+import tempfile
+
+from celery import shared_task as task
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.core.cache import cache
+
+from files.helpers import (
+    COPY_BUFFER_SIZE,
+    get_upload_ingest_key,
+    media_file_info,
+    produce_friendly_token,
+    rm_file,
+)
+from files.models import Media
+
+logger = get_task_logger(__name__)
+
+
+def start_segmenter(cwd, file_name):
+    """Start an ffmpeg segmenter that reads the video from stdin
+
+    Same command as chunkize_media, only the input is a pipe
+    """
+    log = tempfile.TemporaryFile(dir=settings.TEMP_DIRECTORY)
+    chunks_file_name = f"%02d_{produce_friendly_token()}_{file_name}.mkv"
+    cmd = [
+        settings.FFMPEG_COMMAND,
+        "-y",
+        "-i",
+        "pipe:0",
+        "-c",
+        "copy",
+        "-f",
+        "segment",
+        "-segment_time",
+        str(settings.VIDEO_CHUNKS_DURATION),
+        chunks_file_name,
+    ]
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=log, cwd=cwd)
+    return process, log
+
+
+def stop_segmenter(process, log, cwd):
+    """Wait for the segmenter to finish
+
+    Returns:
+        list: Paths of the chunks, empty if segmenting failed
+    """
+    try:
+        process.stdin.close()
+    except BrokenPipeError:
+        pass
+    process.wait()
+    log.seek(0)
+    chunks = re.findall(r"Opening \'([\W\w]+?)\' for writing", log.read().decode("utf-8", errors="ignore"))
+    log.close()
+    chunks = [os.path.join(cwd, ch) for ch in chunks]
+    if process.returncode != 0:
+        for chunk in chunks:
+            rm_file(chunk)
+        return []
+    return chunks
+
+
+def mark_upload_ingest(uid):
+    """Have the media of a finished chunked upload read by ingest_upload,
+    as the first step of media_init"""
+    cache.set(get_upload_ingest_key(uid), {"status": "pending"}, settings.UPLOAD_SESSION_TIMEOUT)
+
+
+@task(name="ingest_upload", queue="short_tasks")
+def ingest_upload(friendly_token):
+    """Calculate the md5 of a finished chunked upload and cut it in chunks
+    with a single read
+
+    The file is read after the upload is complete, not while its parts
+    arrive: parts are handled by any web worker, and neither an md5 state
+    nor an ffmpeg process can be handed from one to the next. For long
+    videos that can be read as a stream (eg mkv, webm, mp4 with the index
+    at the start), the ffmpeg segmenter is fed the bytes the md5 is
+    calculated from. set_media_type and chunkize_media use the results,
+    instead of reading the whole file again. Runs before the other steps
+    of media_init, so they never wait for it
+    """
+
+    media = Media.objects.filter(friendly_token=friendly_token).first()
+    if not media:
+        return False
+    key = get_upload_ingest_key(media.uid)
+    path = media.media_file.path
+    cwd = os.path.dirname(path)
+    cache.set(key, {"status": "running"}, settings.UPLOAD_SESSION_TIMEOUT)
+
+    segmenter = None
+    info = media_file_info(path, md5sum="")
+    if info.get("is_video") and float(info.get("video_duration", 0)) > settings.CHUNKIZE_VIDEO_DURATION and not settings.DO_NOT_TRANSCODE_VIDEO:
+        segmenter, log = start_segmenter(cwd, os.path.basename(path))
+
+    md5 = hashlib.md5(usedforsecurity=False)
+    size = 0
+    try:
+        with open(path, "rb") as f:
+            for data in iter(lambda: f.read(COPY_BUFFER_SIZE), b""):
+                md5.update(data)
+                size += len(data)
+                if segmenter and segmenter.returncode is None:
+                    try:
+                        segmenter.stdin.write(data)
+                    except BrokenPipeError:
+                        # not a format that can be segmented as a stream
+                        segmenter.wait()
+    except OSError:
+        logger.info(f"failed to read the upload of {friendly_token}")
+        if segmenter:
+            segmenter.kill()
+            stop_segmenter(segmenter, log, cwd)
+        cache.set(key, {"status": "fail"}, settings.UPLOAD_SESSION_TIMEOUT)
+        return False
+
+    chunks = stop_segmenter(segmenter, log, cwd) if segmenter else []
+    cache.set(key, {"status": "success", "md5sum": md5.hexdigest(), "file_size": size, "chunks": chunks}, settings.UPLOAD_SESSION_TIMEOUT)
+    logger.info(f"ingested upload of {friendly_token}, {len(chunks)} chunks")
+    return True
@@ -7,4 +7,5 @@ app_name = "uploader"
 
 urlpatterns = [
     re_path(r"^upload/$", views.FineUploaderView.as_view(), name="upload"),
+    re_path(r"^upload/status/(?P<uuid>[\w-]+)/$", views.UploadStatusView.as_view(), name="upload_status"),
 ]
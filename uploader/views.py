@@ -1,19 +1,18 @@
 # -*- coding: utf-8 -*-
-import os
-import shutil
+import uuid
 
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
-from django.core.files import File
 from django.http import JsonResponse
 from django.views import generic
 
-from files.helpers import rm_file
-from files.methods import user_allowed_to_upload
+from files.methods import get_field_file_path, user_allowed_to_upload
 from files.models import Media
 
-from .fineuploader import ChunkedFineUploader
+from .fineuploader import ChunkedFineUploader, PartChecksumError
 from .forms import FineUploaderUploadForm, FineUploaderUploadSuccessForm
+from .sessions import UploadSession
+from .tasks import mark_upload_ingest
 
 
 class FineUploaderView(generic.FormView):
@@ -48,8 +47,37 @@ class FineUploaderView(generic.FormView):
             raise PermissionDenied  # HTTP 403
         return super(FineUploaderView, self).dispatch(request, *args, **kwargs)
 
+    def get_media_file_name(self, uid):
+        # the upload is written straight to the path of Media.media_file,
+        # so that it is not copied once more when the media is created
+        media = Media(uid=uid, user=self.request.user)
+        return get_field_file_path(media, "media_file", self.upload.filename)[0]
+
+    def get_session(self):
+        """Get the session of a chunked upload, starting it on the first part
+
+        Returns:
+            UploadSession, None if the session belongs to another user
+        """
+        session = UploadSession(self.upload.uuid)
+        if not session.exists and not self.chunks_done:
+            uid = uuid.uuid4()
+            session.start(self.request.user, self.upload.total_parts, uid, self.get_media_file_name(uid))
+        if not session.exists or session.data["user"] != self.request.user.id:
+            return None
+        return session
+
     def form_valid(self, form):
         self.upload = ChunkedFineUploader(form.cleaned_data, self.concurrent)
+        if self.upload.chunked:
+            self.upload.session = self.get_session()
+            if self.upload.session is None:
+                data = {"success": False, "error": "Upload session not found", "reset": True}
+                return self.make_response(data, status=400)
+            uid = uuid.UUID(self.upload.session.data["uid"])
+        else:
+            uid = uuid.uuid4()
+
         if self.upload.concurrent and self.chunks_done:
             try:
                 self.upload.combine_chunks()
@@ -57,19 +85,38 @@ class FineUploaderView(generic.FormView):
                 data = {"success": False, "error": "Error with File Uploading"}
                 return self.make_response(data, status=400)
         elif self.upload.total_parts == 1:
-            self.upload.save()
+            self.upload.save(self.get_media_file_name(uid))
         else:
-            self.upload.save()
+            try:
+                self.upload.save()
+            except PartChecksumError as e:
+                return self.make_response({"success": False, "error": str(e)}, status=400)
             return self.make_response({"success": True})
+        if self.upload.session and settings.UPLOAD_INGEST:
+            mark_upload_ingest(uid)
         # create media!
-        media_file = os.path.join(settings.MEDIA_ROOT, self.upload.real_path)
-        with open(media_file, "rb") as f:
-            myfile = File(f)
-            new = Media.objects.create(media_file=myfile, user=self.request.user, title=self.upload.original_filename)
-        rm_file(media_file)
-        shutil.rmtree(os.path.join(settings.MEDIA_ROOT, self.upload.file_path))
+        new = Media.objects.create(uid=uid, media_file=self.upload.real_path, user=self.request.user, title=self.upload.original_filename)
+        if self.upload.session:
+            self.upload.session.delete()
         return self.make_response({"success": True, "media_url": new.get_absolute_url()})
 
     def form_invalid(self, form):
         data = {"success": False, "error": "%s" % repr(form.errors)}
         return self.make_response(data, status=400)
+
+
+class UploadStatusView(generic.View):
+    """Parts received for a chunked upload, so that a client can resume it"""
+
+    http_method_names = ("get",)
+
+    def dispatch(self, request, *args, **kwargs):
+        if not user_allowed_to_upload(request):
+            raise PermissionDenied  # HTTP 403
+        return super(UploadStatusView, self).dispatch(request, *args, **kwargs)
+
+    def get(self, request, uuid):
+        session = UploadSession(uuid)
+        if not session.exists or session.data["user"] != request.user.id:
+            return JsonResponse({"success": False, "error": "Upload session not found"}, status=404)
+        return JsonResponse({"success": True, **session.status()})
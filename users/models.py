@@ -12,6 +12,8 @@ from imagekit.processors import ResizeToFill
 
 import files.helpers as helpers
 from files.models import Category, Media, MediaPermission, Tag
+from files.visibility import RBAC_MEMBER_ROLES
+from rbac.cache import get_rbac_category_roles
 from rbac.models import RBACGroup
 
 
@@ -109,38 +111,61 @@ class User(AbstractUser):
         ret["user_media"] = f"/api/v1/media?author={self.username}"
         return ret
 
+    def __init__(self, *args, **kwargs):
+        super(User, self).__init__(*args, **kwargs)
+        # keep track of the texts the search vectors of the user's media
+        # include, see Media.get_search_texts. Deferred fields are not loaded
+        self.__original_search_texts = self.get_search_texts()
+
+    def get_search_texts(self):
+        return [self.__dict__.get(field) for field in ["username", "name", "email"]]
+
     def save(self, *args, **kwargs):
         strip_text_items = ["name", "description", "title"]
         for item in strip_text_items:
             setattr(self, item, strip_tags(getattr(self, item, None)))
+        search_changed = self.pk and self.get_search_texts() != self.__original_search_texts
         super(User, self).save(*args, **kwargs)
+        self.__original_search_texts = self.get_search_texts()
+
+        if search_changed:
+            from files.search_index import queue_search_index
+
+            queue_search_index(list(Media.objects.filter(user=self).values_list("id", flat=True)))
 
     def get_user_rbac_groups(self):
         """Get all RBAC groups the user belongs to"""
         return RBACGroup.objects.filter(memberships__user=self)
 
+    def get_rbac_category_ids(self, roles):
+        """
+        Get ids of the categories of the user's RBAC groups, where the user has one of roles.
+        Membership roles are cached, see rbac.cache
+        """
+        roles = set(roles)
+        return {category_id for category_id, category_roles in get_rbac_category_roles(self.id).items() if category_roles & roles}
+
     def get_rbac_categories_as_member(self):
         """
         Get all categories related to RBAC groups the user belongs to
         """
-        rbac_groups = RBACGroup.objects.filter(memberships__user=self, memberships__role__in=["member", "contributor", "manager"])
-        categories = Category.objects.prefetch_related("user").filter(rbac_groups__in=rbac_groups).distinct()
-        return categories
+        return Category.objects.prefetch_related("user").filter(id__in=self.get_rbac_category_ids(RBAC_MEMBER_ROLES))
 
     def has_member_access_to_category(self, category):
-        rbac_groups = RBACGroup.objects.filter(memberships__user=self, memberships__role__in=["member", "contributor", "manager"], categories=category)
-        return rbac_groups.exists()
+        return category.id in self.get_rbac_category_ids(RBAC_MEMBER_ROLES)
+
+    def has_rbac_access_to_media(self, media, roles):
+        category_ids = self.get_rbac_category_ids(roles)
+        return bool(category_ids) and any(category.id in category_ids for category in media.category.all())
 
     def has_member_access_to_media(self, media):
         # First check if user is the owner
-        if media.user == self:
+        if media.user_id == self.id:
             return True
 
         # Then check RBAC permissions
-        if getattr(settings, 'USE_RBAC', False):
-            rbac_groups = RBACGroup.objects.filter(memberships__user=self, memberships__role__in=["member", "contributor", "manager"], categories__in=media.category.all()).distinct()
-            if rbac_groups.exists():
-                return True
+        if getattr(settings, 'USE_RBAC', False) and self.has_rbac_access_to_media(media, RBAC_MEMBER_ROLES):
+            return True
 
         # Then check MediaShare permissions for any access
         media_permission_exists = MediaPermission.objects.filter(
@@ -152,14 +177,12 @@ class User(AbstractUser):
 
     def has_contributor_access_to_media(self, media):
         # First check if user is the owner
-        if media.user == self:
+        if media.user_id == self.id:
             return True
 
         # Then check RBAC permissions
-        if getattr(settings, 'USE_RBAC', False):
-            rbac_groups = RBACGroup.objects.filter(memberships__user=self, memberships__role__in=["contributor", "manager"], categories__in=media.category.all()).distinct()
-            if rbac_groups.exists():
-                return True
+        if getattr(settings, 'USE_RBAC', False) and self.has_rbac_access_to_media(media, ["contributor", "manager"]):
+            return True
 
         # Then check MediaShare permissions for editor or owner access
         media_permission_exists = MediaPermission.objects.filter(
@@ -172,14 +195,12 @@ class User(AbstractUser):
 
     def has_owner_access_to_media(self, media):
         # First check if user is the owner
-        if media.user == self:
+        if media.user_id == self.id:
             return True
 
         # Then check RBAC permissions
-        if getattr(settings, 'USE_RBAC', False):
-            rbac_groups = RBACGroup.objects.filter(memberships__user=self, memberships__role__in=["manager"], categories__in=media.category.all()).distinct()
-            if rbac_groups.exists():
-                return True
+        if getattr(settings, 'USE_RBAC', False) and self.has_rbac_access_to_media(media, ["manager"]):
+            return True
 
         # Then check MediaShare permissions for owner access
         media_permission_exists = MediaPermission.objects.filter(
@@ -194,9 +215,7 @@ class User(AbstractUser):
         """
         Get all categories related to RBAC groups the user belongs to
         """
-        rbac_groups = RBACGroup.objects.filter(memberships__user=self, memberships__role__in=["contributor", "manager"])
-        categories = Category.objects.filter(rbac_groups__in=rbac_groups).distinct()
-        return categories
+        return Category.objects.filter(id__in=self.get_rbac_category_ids(["contributor", "manager"]))
 
     def set_role_from_mapping(self, role_mapping):
         """
@@ -279,6 +298,21 @@ class Channel(models.Model):
         return self.get_absolute_url(edit=True)
 
 
+@receiver(post_save, sender=User)
+def user_change(sender, instance, created, update_fields, **kwargs):
+    from files.response_cache import invalidate_response_cache
+
+    invalidate_response_cache(f"user:{instance.username}")
+
+    # media cards show author details, see files.cards. Skip saves that
+    # do not touch them, as last_login on every login
+    if created or (update_fields and not {"username", "name", "logo"} & set(update_fields)):
+        return
+    from files.cards import invalidate_media_cards
+
+    invalidate_media_cards(Media.objects.filter(user=instance).values_list("uid", flat=True))
+
+
 @receiver(post_save, sender=User)
 def post_user_create(sender, instance, created, **kwargs):
     # create a Channel object upon user creation, name it default